@@ -0,0 +1,65 @@
+import sys
+import time
+
+import numpy as np
+
+import saber.composition as s_comp
+import saber.kmer_kernels as s_kern
+
+# Usage: python benchmark_kmer_kernels.py [seq_len] [n_reps]
+# Times every kernel in saber.kmer_kernels with numba and with the NumPy
+# fallback on the same random sequence, and checks that both agree.
+
+
+def time_kernel(func, args, n_reps):
+    func(*args)  # warm-up, also triggers numba compilation
+    start = time.perf_counter()
+    for i in range(n_reps):
+        result = func(*args)
+    return (time.perf_counter() - start) / n_reps, result
+
+
+def same_result(x, y):
+    if isinstance(x, tuple):
+        return all([same_result(a, b) for a, b in zip(x, y)])
+    return np.array_equal(np.asarray(x), np.asarray(y))
+
+
+if __name__ == '__main__':
+    seq_len = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_reps = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    if not s_kern.HAS_NUMBA:
+        sys.exit('numba is not installed, nothing to compare the NumPy kernels against')
+
+    rng = np.random.default_rng(42)
+    seq = ''.join(rng.choice(list('ACGTN'), size=seq_len, p=[0.3, 0.3, 0.2, 0.199, 0.001]))
+    codes = s_comp.encode_seq(seq)
+    bounds = np.stack(s_kern.np_window_bounds(np.array([seq_len]), 10000, 2000, 2000)[1:], axis=1)
+    kmer_bounds = np.stack([bounds[:, 0], np.maximum(bounds[:, 0], bounds[:, 1] - 3)], axis=1)
+    break_arr = np.unique(kmer_bounds)
+    len_arr = rng.integers(500, 200000, size=100000)
+    kmer_arr = np.arange(4 ** 6)
+    tetra_p = s_comp.CompositionProfile(4, 'reverse')
+    hexa_p = s_comp.CompositionProfile(6, 'revcomp')
+
+    kernel_list = [('count_kmers k=4', s_kern.nb_count_kmers, s_kern.np_count_kmers,
+                    (codes, 4, tetra_p.lut, tetra_p.n_cols)),
+                   ('count_kmers k=6', s_kern.nb_count_kmers, s_kern.np_count_kmers,
+                    (codes, 6, hexa_p.lut, hexa_p.n_cols)),
+                   ('prefix_kmers k=4', s_kern.nb_prefix_kmers, s_kern.np_prefix_kmers,
+                    (codes, break_arr, 4, tetra_p.lut, tetra_p.n_cols)),
+                   ('gc_ambig_count', s_kern.nb_gc_ambig_count, s_kern.np_gc_ambig_count, (codes,)),
+                   ('reverse_kmers k=6', s_kern.nb_reverse_kmers, s_kern.np_reverse_kmers, (kmer_arr, 6)),
+                   ('revcomp_kmers k=6', s_kern.nb_revcomp_kmers, s_kern.np_revcomp_kmers, (kmer_arr, 6)),
+                   ('window_bounds 100k contigs', s_kern.nb_window_bounds, s_kern.np_window_bounds,
+                    (len_arr, 10000, 2000, 2000))
+                   ]
+    print('{} bp random sequence, {} reps per kernel'.format(seq_len, n_reps))
+    print('{:<28}{:>12}{:>12}{:>10}'.format('kernel', 'numba (ms)', 'numpy (ms)', 'speedup'))
+    for name, nb_func, np_func, args in kernel_list:
+        nb_time, nb_result = time_kernel(nb_func, args, n_reps)
+        np_time, np_result = time_kernel(np_func, args, n_reps)
+        assert same_result(nb_result, np_result), name
+        print('{:<28}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(name, nb_time * 1000, np_time * 1000,
+                                                         np_time / nb_time
+                                                         ))
@@ -0,0 +1,122 @@
+import random
+import sys
+import time
+from collections import Counter
+from itertools import product, islice
+
+import numpy as np
+import pandas as pd
+
+import saber.composition as s_comp
+
+# Usage: python benchmark_tetra_cnt.py [subcontigs.fasta] [max_records]
+# Without a FASTA, random 10kb subcontigs with a sprinkle of N's are used.
+
+
+def random_subcontigs(n_subs, sub_len=10000, seed=42):
+    random.seed(seed)
+    sub_list = []
+    for i in range(n_subs):
+        seq = ''.join(random.choices('ACGT', weights=[0.3, 0.3, 0.2, 0.2], k=sub_len))
+        n_pos = random.randrange(sub_len - 20)
+        seq = seq[:n_pos] + 'N' * 10 + seq[n_pos + 10:]
+        sub_list.append(('contig_' + str(i // 5) + '_' + str(i % 5), seq))
+    return sub_list
+
+
+def read_fasta(fasta_file, max_recs):
+    sub_list = []
+    header, seq_list = None, []
+    with open(fasta_file, 'r') as fa_in:
+        for line in fa_in:
+            if line.startswith('>'):
+                if header is not None:
+                    sub_list.append((header, ''.join(seq_list)))
+                    if len(sub_list) == max_recs:
+                        return sub_list
+                header, seq_list = line[1:].strip().split(' ')[0], []
+            else:
+                seq_list.append(line.strip())
+    if header is not None:
+        sub_list.append((header, ''.join(seq_list)))
+    return sub_list
+
+
+def get_kmer(seq, n):
+    it = iter(seq)
+    result = tuple(islice(it, n))
+    if len(result) == n:
+        yield result
+    for elem in it:
+        result = result[1:] + (elem,)
+        yield result
+
+
+def legacy_tetra_counts(fasta):
+    # Counting section of utilities.tetra_cnt prior to the NumPy engine
+    tetra_cnt_dict = {''.join(x): [] for x in product('atgc', repeat=4)}
+    header_list = []
+    for rec in fasta:
+        header = rec[0]
+        header_list.append(header)
+        seq = rec[1]
+        tmp_dict = {k: 0 for k, v in tetra_cnt_dict.items()}
+        clean_seq = seq.strip('\n').lower()
+        kmer_list = [''.join(x) for x in get_kmer(clean_seq, 4)]
+        tetra_counter = Counter(kmer_list)
+        for tetra in tmp_dict.keys():
+            tmp_dict[tetra] = int(tetra_counter[tetra])
+        dedup_dict = {}
+        for tetra in tmp_dict.keys():
+            if (tetra not in dedup_dict.keys()) & (tetra[::-1] not in dedup_dict.keys()):
+                dedup_dict[tetra] = ''
+            elif tetra[::-1] in dedup_dict.keys():
+                dedup_dict[tetra[::-1]] = tetra
+        tetra_prop_dict = {}
+        for tetra in dedup_dict.keys():
+            if dedup_dict[tetra] != '':
+                tetra_prop_dict[tetra] = tmp_dict[tetra] + tmp_dict[dedup_dict[tetra]]
+            else:
+                tetra_prop_dict[tetra] = tmp_dict[tetra]
+        for k in tetra_cnt_dict.keys():
+            if k in tetra_prop_dict.keys():
+                tetra_cnt_dict[k].append(tetra_prop_dict[k])
+            else:
+                tetra_cnt_dict[k].append(0.0)
+    tetra_cnt_dict['contig_id'] = header_list
+    tetra_cnt_df = pd.DataFrame.from_dict(tetra_cnt_dict).set_index('contig_id')
+    return tetra_cnt_df.loc[:, (tetra_cnt_df != 0.0).any(axis=0)]
+
+
+def numpy_tetra_counts(fasta):
+    header_list, len_list, tetra_mtx = s_comp.count_kmer_records(fasta, s_comp.TETRA_PROFILE)
+    tetra_cnt_df = pd.DataFrame(tetra_mtx.astype(np.int64), columns=s_comp.TETRA_PROFILE.columns,
+                                index=pd.Index(header_list, name='contig_id')
+                                )
+    return tetra_cnt_df.loc[:, (tetra_cnt_df != 0.0).any(axis=0)]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        max_recs = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        subcontigs = read_fasta(sys.argv[1], max_recs)
+    else:
+        subcontigs = random_subcontigs(500)
+    total_bp = sum([len(x[1]) for x in subcontigs])
+    print('Benchmarking {} subcontigs ({} bp)'.format(len(subcontigs), total_bp))
+
+    start = time.perf_counter()
+    legacy_df = legacy_tetra_counts(subcontigs)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    numpy_df = numpy_tetra_counts(subcontigs)
+    numpy_time = time.perf_counter() - start
+
+    assert list(legacy_df.columns) == list(numpy_df.columns)
+    assert list(legacy_df.index) == list(numpy_df.index)
+    assert np.array_equal(legacy_df.values, numpy_df.values)
+    print('Count matrices are identical: {} x {}'.format(*numpy_df.shape))
+    print('legacy Counter:  {:.3f}s ({:.2f} Mbp/s)'.format(legacy_time, total_bp / legacy_time / 1e6))
+    print('NumPy bincount:  {:.3f}s ({:.2f} Mbp/s)'.format(numpy_time, total_bp / numpy_time / 1e6))
+    print('Speedup:         {:.1f}x'.format(legacy_time / numpy_time))
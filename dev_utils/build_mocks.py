@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import random
 import sys
@@ -37,6 +38,10 @@ def build_subcontigs(in_fasta, subcontig_path, max_contig_len, overlap_len):
     return (samp_id, headers, subs)
 
 
+def build_mock_mp(p):
+    return build_mock(*p)
+
+
 def kmer_slide(seq_list, n, o_lap):
     all_sub_seqs = []
     all_sub_headers = []
@@ -87,52 +92,57 @@ def get_seqs(fasta_file):
     return sag_contigs
 
 
-def main(sag_path, save_path, max_contig_len, min_contig_len, overlap_len, per_comp):
+def build_mock(sag, save_path, max_contig_len, min_contig_len, overlap_len, per_comp):
+    # cuts one SAG and writes its mock, only the summary goes back to the parent
+    sag_id, sag_headers, sag_subs = build_subcontigs(sag, save_path, max_contig_len, overlap_len)
+    sag_full_len = sum(len(x) for x in sag_subs)
+    sag_per_comp = sag_full_len * (per_comp / 100)
+    zip_list = list(zip(sag_headers, [len(x) for x in sag_subs], sag_subs))
+    small_list = [[x[0], x[2]] for x in zip_list if min_contig_len <= x[1] < max_contig_len]
+    big_list = [[x[0], x[2]] for x in zip_list if x[1] >= max_contig_len]
+    random.Random(42).shuffle(small_list)
+    mock_list = []
+    for m in small_list:
+        mock_comp_len = sum(len(z[1]) for z in mock_list)
+        if mock_comp_len < sag_per_comp:
+            mock_list.append(m)
+    if mock_comp_len < sag_per_comp:
+        random.Random(42).shuffle(big_list)
+        for m in big_list:
+            mock_comp_len = sum(len(z[1]) for z in mock_list)
+            if mock_comp_len < sag_per_comp:
+                mock_list.append(m)
+
+    mock_per_comp = sum(len(z[1]) for z in mock_list)
+    mock_per_min = min(len(z[1]) for z in mock_list)
+    mock_per_max = max(len(z[1]) for z in mock_list)
+    mock_per_mean = sum(len(z[1]) for z in mock_list) / len(mock_list)
+
+    with open(os.path.join(save_path, sag_id +
+                                      '.mock.' + str(per_comp) + '.fasta'), 'w') as sub_out:
+        sub_rec_list = ['\n'.join(['>' + rec[0], rec[1]])
+                        for rec in mock_list
+                        ]
+        sub_out.write('\n'.join(sub_rec_list) + '\n')
+
+    return (sag_id, sag_full_len, sag_per_comp, len(mock_list), mock_per_comp,
+            mock_per_min, mock_per_max, mock_per_mean
+            )
+
+
+def main(sag_path, save_path, max_contig_len, min_contig_len, overlap_len, per_comp, nthreads=1):
     max_contig_len = int(max_contig_len)
     min_contig_len = int(min_contig_len)
     overlap_len = int(overlap_len)
     per_comp = int(per_comp)
+    nthreads = int(nthreads)
     # Find the SAGs!
     sag_list = get_SAGs(sag_path)
-    # Build subcontiges for SAGs
-    sag_subcontigs = [build_subcontigs(sag, save_path,
-                                       max_contig_len, overlap_len
-                                       ) for sag in sag_list]
-
-    for s in sag_subcontigs:
-        sag_id, sag_headers, sag_subs = s
-        sag_full_len = sum(len(x) for x in sag_subs)
-        sag_per_comp = sag_full_len * (per_comp / 100)
-        zip_list = list(zip(sag_headers, [len(x) for x in sag_subs], sag_subs))
-        small_list = [[x[0], x[2]] for x in zip_list if min_contig_len <= x[1] < max_contig_len]
-        big_list = [[x[0], x[2]] for x in zip_list if x[1] >= max_contig_len]
-        random.Random(42).shuffle(small_list)
-        mock_list = []
-        for m in small_list:
-            mock_comp_len = sum(len(z[1]) for z in mock_list)
-            if mock_comp_len < sag_per_comp:
-                mock_list.append(m)
-        if mock_comp_len < sag_per_comp:
-            random.Random(42).shuffle(big_list)
-            for m in big_list:
-                mock_comp_len = sum(len(z[1]) for z in mock_list)
-                if mock_comp_len < sag_per_comp:
-                    mock_list.append(m)
-
-        mock_per_comp = sum(len(z[1]) for z in mock_list)
-        mock_per_min = min(len(z[1]) for z in mock_list)
-        mock_per_max = max(len(z[1]) for z in mock_list)
-        mock_per_mean = sum(len(z[1]) for z in mock_list) / len(mock_list)
-        print(sag_id, sag_full_len, sag_per_comp, len(mock_list), mock_per_comp,
-              mock_per_min, mock_per_max, mock_per_mean
-              )
-
-        with open(os.path.join(save_path, sag_id +
-                                          '.mock.' + str(per_comp) + '.fasta'), 'w') as sub_out:
-            sub_rec_list = ['\n'.join(['>' + rec[0], rec[1]])
-                            for rec in mock_list
-                            ]
-            sub_out.write('\n'.join(sub_rec_list) + '\n')
+    # Build a mock for each SAG, one SAG per worker, the pool is terminated if one fails
+    arg_list = [[sag, save_path, max_contig_len, min_contig_len, overlap_len, per_comp] for sag in sag_list]
+    with multiprocessing.Pool(processes=nthreads) as pool:
+        for mock_stats in pool.imap_unordered(build_mock_mp, arg_list):
+            print(*mock_stats)
 
 
 if __name__ == '__main__':
@@ -143,4 +153,4 @@ if __name__ == '__main__':
     overlap_len = 0
     per_comp = 40
 
-    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6])
+    main(*sys.argv[1:8])
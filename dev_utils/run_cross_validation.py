@@ -50,9 +50,9 @@ if mhr_recruits:
 else:
     minhash_df_dict = False
 
-abr_recruits = glob.glob(os.path.join(working_dir, '*.coverage.scaled.tsv'))
+abr_recruits = glob.glob(os.path.join(working_dir, '*.coverage.scaled.npy'))
 abr_file = os.path.basename(abr_recruits[0])
-mg_file = [abr_file.replace('.coverage.scaled.tsv', ''), None]
+mg_file = [abr_file.replace('.coverage.scaled.npy', ''), None]
 # Build abundance tables
 #abund_file = abr.runAbundRecruiter(working_dir,
 #                                   working_dir, mg_file,
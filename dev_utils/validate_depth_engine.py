@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import saber.depth_engine as s_depth
+
+# Usage: python validate_depth_engine.py [n_contigs] [n_reads] [out_dir]
+# Simulates subcontigs and short-read alignments (mismatches, indels, soft clips,
+# secondary and unmapped records) as SAM, then checks saber.depth_engine against
+# a per-base brute force of the same rules. If samtools and MetaBAT's
+# jgi_summarize_bam_contig_depths are on the PATH the SAM is also sorted into a
+# BAM and both depth tables are compared column by column.
+
+
+def sim_alignments(contig_lens, n_reads, rng, read_len=150):
+    # synthetic short-read alignments to contigs c_0, c_1, ..: mismatches, indels, soft clips,
+    # secondary and unmapped records, also used by tests/test_depth_engine.py
+    sam_lines = []
+    for r in range(n_reads):
+        c = int(rng.integers(len(contig_lens)))
+        pos = int(rng.integers(0, max(contig_lens[c] - read_len - 10, 1)))
+        clip = int(rng.choice([0, 0, 0, 5, 20]))
+        n_mis = int(rng.choice([0, 0, 1, 2, 3, 6]))
+        indel = rng.choice(['', '', 'I', 'D'])
+        m1 = int(rng.integers(30, read_len - clip - 30))
+        if indel == 'I':
+            cigar = '%dM2I%dM' % (m1, read_len - clip - m1 - 2)
+        elif indel == 'D':
+            cigar = '%dM3D%dM' % (m1, read_len - clip - m1)
+        else:
+            cigar = '%dM' % (read_len - clip)
+        if clip:
+            cigar = '%dS' % clip + cigar
+        nm = n_mis + (2 if indel == 'I' else 3 if indel == 'D' else 0)
+        flag = int(rng.choice([0, 16, 0, 16, 256, 4]))
+        sam_lines.append('\t'.join(['r' + str(r), str(flag), 'c_' + str(c), str(pos + 1), '60', cigar, '*', '0',
+                                    '0', '*', '*', 'NM:i:' + str(nm)
+                                    ]) + '\n')
+    return sam_lines
+
+
+def brute_depths(sam_lines, contig_lens, min_pct_id, max_edge):
+    cov_list = [np.zeros(x, dtype=np.int64) for x in contig_lens]
+    for line in sam_lines:
+        f = line.rstrip('\n').split('\t')
+        if int(f[1]) & s_depth.SKIP_FLAGS:
+            continue
+        ops = [(int(n), op) for n, op in s_depth.CIGAR_RE.findall(f[5])]
+        nm = int(f[11].split(':')[2])
+        m_len = sum(n for n, op in ops if op == 'M')
+        id_len = sum(n for n, op in ops if op in 'ID')
+        s_len = sum(n for n, op in ops if op == 'S')
+        if m_len - (nm - id_len) < min_pct_id * (m_len + id_len + s_len):
+            continue
+        c, pos = int(f[2].split('_')[1]), int(f[3]) - 1
+        for n, op in ops:
+            if op == 'M':
+                cov_list[c][pos:pos + n] += 1
+            if op in 'MD':
+                pos += n
+    depth_list = []
+    for cov in cov_list:
+        edge = max_edge if len(cov) > 2 * max_edge else 0
+        depth_list.append((cov[edge:len(cov) - edge].mean(), cov[edge:len(cov) - edge].var()))
+    return np.array(depth_list)
+
+
+if __name__ == '__main__':
+    n_contigs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_reads = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    out_dir = sys.argv[3] if len(sys.argv) > 3 else tempfile.mkdtemp()
+    rng = np.random.default_rng(42)
+    contig_lens = rng.integers(1000, 10000, size=n_contigs)
+    contig_names = ['c_' + str(i) for i in range(n_contigs)]
+    sam_lines = sim_alignments(contig_lens, n_reads, rng)
+
+    acc = s_depth.DepthAccumulator(contig_names, contig_lens, buf_size=4096)
+    acc.add_sam(sam_lines)
+    engine_depths = np.stack(acc.depths(), axis=1)
+    brute = brute_depths(sam_lines, contig_lens, s_depth.MIN_PCT_ID, s_depth.MAX_EDGE_BASES)
+    print('{} contigs, {} alignments, {} passed the filters'.format(n_contigs, acc.n_reads, acc.n_pass))
+    print('max abs difference to brute force: depth {:.2e}, var {:.2e}'.format(
+        *np.abs(engine_depths - brute).max(axis=0)))
+    assert np.allclose(engine_depths, brute)
+
+    if (shutil.which('samtools') is None) or (shutil.which('jgi_summarize_bam_contig_depths') is None):
+        sys.exit('samtools or jgi_summarize_bam_contig_depths not found, skipping the jgi comparison')
+    sam_file = os.path.join(out_dir, 'sim.sam')
+    bam_file = os.path.join(out_dir, 'sim.sorted.bam')
+    with open(sam_file, 'w') as sam_out:
+        sam_out.write(''.join('@SQ\tSN:{}\tLN:{}\n'.format(n, l) for n, l in zip(contig_names, contig_lens)))
+        sam_out.write(''.join(sam_lines))
+    subprocess.run(['samtools', 'sort', '-o', bam_file, sam_file], check=True)
+    jgi_file = os.path.join(out_dir, 'sim.jgi.tsv')
+    subprocess.run(['jgi_summarize_bam_contig_depths', '--outputDepth', jgi_file, bam_file], check=True)
+    names, lens, depth_mtx, col_list = s_depth.calc_depths([bam_file])
+    saber_file = s_depth.write_depth_table(os.path.join(out_dir, 'sim.saber.tsv'), names, lens, depth_mtx,
+                                           col_list
+                                           )
+    jgi_df = pd.read_csv(jgi_file, sep='\t', index_col=0).loc[names]
+    saber_df = pd.read_csv(saber_file, sep='\t', index_col=0)
+    for col in saber_df.columns:
+        diff = np.abs(jgi_df[col].values - saber_df[col].values)
+        print('{:<24} max abs diff {:.4f}, mean abs diff {:.4f}, pearson r {:.5f}'.format(
+            os.path.basename(col), diff.max(), diff.mean(), np.corrcoef(jgi_df[col], saber_df[col])[0, 1]))
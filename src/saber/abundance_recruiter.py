@@ -1,33 +1,55 @@
+import glob
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+import time
 from os.path import isfile, basename, getsize
 from os.path import join as o_join
-from subprocess import Popen
+from subprocess import Popen, PIPE
 
+import numpy as np
 import pandas as pd
 
 pd.set_option('display.max_columns', None)
 pd.options.mode.chained_assignment = None
 from sklearn.preprocessing import StandardScaler
 import sys
+import saber.depth_engine as s_depth
+import saber.feature_store as s_fs
+import saber.kmer_abundance as s_kab
+import saber.subcontig_index as s_sidx
 import saber.utilities as s_utils
 
+# minimap2 -I, bases of target sequence loaded per index part
+MMI_INDEX_SIZE = '8G'
+
 
 def runAbundRecruiter(subcontig_path, abr_path, mg_sub_file, mg_raw_file_list,
-                      nthreads
+                      nthreads, export_tsv=False, sort_threads=None, keep_sam=False,
+                      align_jobs=1, jgi_depths=True, contig_cov=False, kmer_abund=False
                       ):
     logging.info('Starting Abundance Data Transformation\n')
     mg_id = mg_sub_file[0]
+    if kmer_abund and contig_cov:
+        raise Exception("**ERROR** k-mer abundance and contig coverage are alternatives, choose one")
 
-    if isfile(o_join(abr_path, mg_id + '.coverage.scaled.tsv')):
-        logging.info('Loading Abundance matrix for %s\n' % mg_id)
-        mg_scale_out = o_join(abr_path, mg_id + '.coverage.scaled.tsv')
-        mg_covm_out = o_join(abr_path, mg_id + '.mbacov.tsv')
+    if kmer_abund:
+        # alignment-free triage, approximate coverage from sampled subcontig k-mers
+        mg_scale_out, mg_covm_out = runKmerCov(abr_path, mg_id, mg_raw_file_list, subcontig_path,
+                                               nthreads, export_tsv
+                                               )
+    elif contig_cov:
+        # align once to the whole contigs, subcontig windows are projected from the profiles
+        mg_scale_out, mg_covm_out = runContigCov(abr_path, mg_id, mg_raw_file_list, subcontig_path,
+                                                 nthreads, export_tsv, align_jobs
+                                                 )
     else:
-        logging.info('Building %s abundance matrix\n' % mg_id)
-        mg_sub_path = o_join(subcontig_path, mg_id + '.subcontigs.fasta')
-        # Process raw metagenomes to calculate abundances
+        # per sample depth columns are reused, only new or changed samples are aligned
         mg_scale_out, mg_covm_out = procMetaGs(abr_path, mg_id, mg_raw_file_list,
-                                               subcontig_path, nthreads
+                                               subcontig_path, nthreads, export_tsv,
+                                               sort_threads, keep_sam, align_jobs, jgi_depths
                                                )
     # Clean up the directory
     logging.info('Cleaning up intermediate files...\n')
@@ -37,40 +59,398 @@ def runAbundRecruiter(subcontig_path, abr_path, mg_sub_file, mg_raw_file_list,
     return mg_scale_out, mg_covm_out
 
 
-def procMetaGs(abr_path, mg_id, mg_raw_file_list, subcontig_path, nthreads):
-    # Process each raw metagenome
+def procMetaGs(abr_path, mg_id, mg_raw_file_list, subcontig_path, nthreads, export_tsv=False,
+               sort_threads=None, keep_sam=False, align_jobs=1, jgi_depths=True
+               ):
+    # Process the raw metagenomes align_jobs at a time, each job gets an equal share of nthreads.
+    # minimap2 output is piped straight into samtools sort unless keep_sam asks for the
+    # SAM -> BAM -> sorted BAM steps on disk. Each sample ends up as its own depth column,
+    # keyed on the checksums of its reads and of the subcontigs, and samples whose column
+    # already exists aren't aligned again
+    raw_data = get_raw_data(mg_raw_file_list)
+    # minimap2 needs the subcontigs on disk, write them out from the index if needed
+    mg_sub_path = s_sidx.ensure_subcontig_fasta(o_join(subcontig_path, mg_id + '.subcontigs.fasta'))
+    sub_hash = file_hash(mg_sub_path)
+    ref_key = sub_hash + ('.jgi' if jgi_depths else '')
+    col_file_list = [o_join(abr_path, basename(x.split('\t')[0]).split('.')[0] + '.' + y + '.depth.npz')
+                     for x, y in zip(raw_data, sample_keys(abr_path, raw_data, ref_key, nthreads))
+                     ]
+    todo_list = [i for i, col_file in enumerate(col_file_list) if not isfile(col_file)]
+    logging.info('%s of %s read samples have depth columns from an earlier run\n'
+                 % (len(raw_data) - len(todo_list), len(raw_data))
+                 )
+    if todo_list:
+        # index the subcontigs once for all read samples
+        mg_ref = build_mmi_index(mg_sub_path, abr_path, nthreads, fasta_hash=sub_hash)
+        align_jobs, job_threads = split_jobs(nthreads, align_jobs, len(todo_list))
+        logging.info('Aligning %s read samples, %s at a time with %s threads each\n'
+                     % (len(todo_list), align_jobs, job_threads)
+                     )
+        arg_list = []
+        for i in todo_list:
+            # columns of the sample's older reads or subcontigs won't be used again
+            pe_prefix = col_file_list[i].rsplit('.', 3)[0]
+            for old_col in glob.glob(glob.escape(pe_prefix) + '.*.depth.npz'):
+                os.remove(old_col)
+            arg_list.append([i, abr_path, subcontig_path, mg_id, raw_data[i].split('\t'), job_threads,
+                             sort_threads, keep_sam, mg_ref, col_file_list[i], jgi_depths
+                             ])
+        run_sample_jobs(align_sample, arg_list, align_jobs, job_threads,
+                        o_join(abr_path, mg_id + '.align_times.tsv'), 'depth_column'
+                        )
+    logging.info('\n')
+    mg_scale_out, mg_covm_out = runMBAcov(abr_path, mg_id, col_file_list, export_tsv)
+    # mg_covm_out = runCovM(abr_path, mg_id, nthreads, sorted_bam_list)
+    # mg_covm_out = runSAMSAM(abr_path, subcontig_path, mg_id, sam_list, nthreads)
+    # mg_covm_out = runPySAM(abr_path, subcontig_path, mg_id, sorted_bam_list, nthreads)
+    return mg_scale_out, mg_covm_out
+
+
+def get_raw_data(mg_raw_file_list):
+    # --metaraw lines, checked here since pool workers can't exit the run
     with open(mg_raw_file_list, 'r') as raw_fa_in:
-        raw_data = raw_fa_in.readlines()
-    sam_list = []
-    sorted_bam_list = []
+        raw_data = [x.strip('\n') for x in raw_fa_in.readlines() if x.strip('\n')]
     for line in raw_data:
-        raw_file_list = line.strip('\n').split('\t')
-        # mg_covm_std = runBBtools(abr_path, subcontig_path, mg_id,
-        #                                      raw_file_list, nthreads
-        #                                      )
+        if isfile(line.split('\t')[0]) == False:
+            logging.info('Raw FASTQ file(s) are not where you said they were...')
+            sys.exit()  # TODO: replace this quick-fix with a real exception
+
+    return raw_data
+
+
+def split_jobs(nthreads, align_jobs, n_samples):
+    # concurrent sample jobs and the threads each of them gets out of nthreads
+    align_jobs = max(min(int(align_jobs), n_samples, max(int(nthreads), 1)), 1)
+    job_threads = max(int(nthreads) // align_jobs, 1)
+
+    return align_jobs, job_threads
+
+
+def run_sample_jobs(job_func, arg_list, align_jobs, job_threads, time_file, out_col):
+    """Run job_func over the read samples align_jobs at a time and log how long each took.
+
+    job_func takes one entry of arg_list, which starts with the sample's --metaraw line number,
+    and returns (i, pe_id, output file, seconds).
+    :return: output files in the --metaraw order"""
+    pool = multiprocessing.Pool(processes=align_jobs)
+    job_list = []
+    try:
+        for i, pe_id, out_file, run_time in pool.imap_unordered(job_func, arg_list):
+            logging.info('Finished %s in %.1f seconds\n' % (pe_id, run_time))
+            job_list.append((i, pe_id, out_file, job_threads, run_time))
+        pool.close()
+        pool.join()
+    finally:
+        # a failed sample stops the jobs still running instead of leaving them behind
+        pool.terminate()
+    job_list.sort()  # keep the --metaraw order for the coverage columns
+    time_df = pd.DataFrame([x[1:] for x in job_list],
+                           columns=['sample_id', out_col, 'threads', 'seconds']
+                           )
+    time_df.to_csv(time_file, sep='\t', index=False)
+
+    return [x[2] for x in job_list]
+
+
+def align_sample(p):
+    # one read sample, its intermediates and logs are all named after its pe_id
+    # so concurrent jobs never touch each other's files
+    (i, abr_path, subcontig_path, mg_id, raw_file_list, nthreads, sort_threads, keep_sam, mg_ref, col_file,
+     jgi_depths) = p
+    start_time = time.time()
+    if (not jgi_depths) and (not keep_sam):
+        # the depth engine reads minimap2's SAM as it comes, no BAM is written
+        pe_id = runAlignDepth(abr_path, subcontig_path, mg_id, raw_file_list, nthreads, mg_ref, col_file)
+        return i, pe_id, col_file, time.time() - start_time
+    if keep_sam:
         pe_id, mg_sam_out = runMiniMap2(abr_path, subcontig_path, mg_id, raw_file_list,
-                                        nthreads
+                                        nthreads, mg_ref
                                         )
-        sam_list.append(mg_sam_out)
         # Build/sorted .bam files
         mg_sort_out = runSamTools(abr_path, pe_id, nthreads, mg_id, mg_sam_out)
-        sorted_bam_list.append(mg_sort_out)
-        # Clean up intermediates
-        logging.info('Cleaning up intermediate files...\n')
-        for s in ["*.sam", "*.bam", "*.stderr.txt", "*.stdout.txt"]:
-            s_utils.runCleaner(abr_path, s, skip_list=sorted_bam_list)
+        for inter_file in [mg_sam_out, o_join(abr_path, pe_id + '.bam')]:
+            if isfile(inter_file):
+                os.remove(inter_file)
+    else:
+        pe_id, mg_sort_out = runAlignSort(abr_path, subcontig_path, mg_id, raw_file_list,
+                                          nthreads, sort_threads, mg_ref
+                                          )
+    runSampleDepth(abr_path, pe_id, mg_sort_out, col_file, nthreads, jgi_depths)
 
+    return i, pe_id, col_file, time.time() - start_time
 
 
-    logging.info('\n')
-    mg_scale_out, mg_covm_out = runMBAcov(abr_path, mg_id, sorted_bam_list)
-    # mg_covm_out = runCovM(abr_path, mg_id, nthreads, sorted_bam_list)
-    # mg_covm_out = runSAMSAM(abr_path, subcontig_path, mg_id, sam_list, nthreads)
-    # mg_covm_out = runPySAM(abr_path, subcontig_path, mg_id, sorted_bam_list, nthreads)
-    return mg_scale_out, mg_covm_out
+def sample_keys(abr_path, raw_data, ref_key, nthreads=1):
+    """Key of every read sample, a checksum of its read files and of ref_key.
+
+    Read file checksums are cached in read_checksums.json by path, size and mtime,
+    so a file is only read through again when it changed. Those are hashed nthreads at a time.
+    :return: list of keys in the raw_data order"""
+    manifest_file = o_join(abr_path, 'read_checksums.json')
+    manifest = {}
+    if isfile(manifest_file):
+        with open(manifest_file, 'r') as man_in:
+            manifest = json.load(man_in)
+    stat_dict = {}
+    for line in raw_data:
+        for read_file in line.split('\t'):
+            r_stat = os.stat(read_file)
+            stat_dict[os.path.abspath(read_file)] = [r_stat.st_size, r_stat.st_mtime_ns]
+    hash_list = [x for x in stat_dict if manifest.get(x, [None, None])[:2] != stat_dict[x]]
+    if hash_list:
+        logging.info('Calculating checksums of %s read files\n' % len(hash_list))
+        pool = multiprocessing.Pool(processes=max(min(int(nthreads), len(hash_list)), 1))
+        try:
+            for read_path, read_hash in pool.imap_unordered(path_hash, hash_list):
+                manifest[read_path] = stat_dict[read_path] + [read_hash]
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+    key_list = []
+    for line in raw_data:
+        s_hash = hashlib.blake2b(ref_key.encode(), digest_size=8)
+        for read_file in line.split('\t'):
+            s_hash.update(manifest[os.path.abspath(read_file)][2].encode())
+        key_list.append(s_hash.hexdigest())
+    s_utils.save_manifest(manifest_file, manifest)
+
+    return key_list
+
+
+def path_hash(read_path):
+    return read_path, file_hash(read_path)
+
+
+def runSampleDepth(abr_path, pe_id, mg_sort_out, col_file, nthreads=1, jgi_depths=True):
+    # depth and variance of each subcontig in one sorted BAM, from depth_engine
+    # or from jgi_summarize_bam_contig_depths with jgi_depths
+    if not jgi_depths:
+        contig_names, contig_lens, depth_mtx, col_list = s_depth.calc_depths([mg_sort_out], nthreads)
+    else:
+        mg_mba_out = o_join(abr_path, pe_id + '.jgi_depth.tsv')
+        mba_cmd = ['jgi_summarize_bam_contig_depths', '--outputDepth', mg_mba_out, mg_sort_out]
+        with open(o_join(abr_path, pe_id + '.jgi.stderr.txt'), 'w') as stderr_file:
+            run_mba = Popen(mba_cmd, stderr=stderr_file)
+            run_mba.communicate()
+        if run_mba.returncode != 0:
+            raise Exception("**ERROR** jgi_summarize_bam_contig_depths failed for " + pe_id + ", see "
+                            + o_join(abr_path, pe_id + '.jgi.stderr.txt'))
+        mg_mba_df = pd.read_csv(mg_mba_out, header=0, sep='\t')
+        os.remove(mg_mba_out)
+        contig_names = mg_mba_df['contigName'].astype(str).values
+        contig_lens = mg_mba_df['contigLen'].values
+        depth_mtx = mg_mba_df.iloc[:, 3:5].values
+        col_list = list(mg_mba_df.columns[3:5])
+    s_depth.save_depth_column(col_file, contig_names, contig_lens, depth_mtx[:, 0], depth_mtx[:, 1], col_list[0])
+
+    return col_file
+
+
+def runContigCov(abr_path, mg_id, mg_raw_file_list, subcontig_path, nthreads, export_tsv=False,
+                 align_jobs=1
+                 ):
+    """Subcontig coverage projected from whole-contig depth profiles instead of subcontig alignments.
+
+    Each read sample is aligned once to the original contigs and its binned depth profile is
+    kept as <pe_id>.<key>.contig_profile.npz, keyed on the checksums of its reads and of the
+    contig FASTA like the depth columns of procMetaGs, so new window parameters or an added
+    sample only redo the projection, or the one new alignment.
+    :return: the coverage feature table and mbacov TSV, laid out as runMBAcov writes them"""
+    mg_sub_path = o_join(subcontig_path, mg_id + '.subcontigs.fasta')
+    idx_file = s_sidx.index_file(mg_sub_path)
+    if not isfile(idx_file):
+        raise Exception("**ERROR** contig coverage needs the subcontig index " + idx_file)
+    sub_idx = s_sidx.load_subcontig_index(idx_file)
+    mg_mba_out = o_join(abr_path, mg_id + '.mbacov.tsv')
+    mg_mba_std = o_join(abr_path, mg_id + '.coverage.scaled')
+    raw_data = get_raw_data(mg_raw_file_list)
+    contig_hash = file_hash(sub_idx.contig_file)
+    profile_list = [o_join(abr_path, basename(x.split('\t')[0]).split('.')[0] + '.' + y + '.contig_profile.npz')
+                    for x, y in zip(raw_data, sample_keys(abr_path, raw_data, contig_hash, nthreads))
+                    ]
+    cov_meta = {'windows': list(sub_idx.params), 'contig_file': sub_idx.contig_file,
+                'profiles': [basename(x) for x in profile_list]
+                }
+    if s_fs.feature_exists(mg_mba_std) and \
+            all(s_fs.load_features(mg_mba_std)[2].get(k) == v for k, v in cov_meta.items()):
+        logging.info('Loading Abundance matrix for %s\n' % mg_id)
+        return mg_mba_std, mg_mba_out
+
+    logging.info('Building %s abundance matrix from whole-contig profiles\n' % mg_id)
+    todo_list = [i for i, profile_file in enumerate(profile_list) if not isfile(profile_file)]
+    logging.info('%s of %s read samples have contig profiles from an earlier run\n'
+                 % (len(raw_data) - len(todo_list), len(raw_data))
+                 )
+    if todo_list:
+        mg_ref = build_mmi_index(sub_idx.contig_file, abr_path, nthreads,
+                                 mmi_prefix=o_join(subcontig_path, mg_id + '.contigs'), fasta_hash=contig_hash
+                                 )
+        align_jobs, job_threads = split_jobs(nthreads, align_jobs, len(todo_list))
+        logging.info('Profiling %s read samples, %s at a time with %s threads each\n'
+                     % (len(todo_list), align_jobs, job_threads)
+                     )
+        arg_list = []
+        for i in todo_list:
+            # profiles of the sample's older reads or contigs won't be used again
+            pe_prefix = profile_list[i].rsplit('.', 3)[0]
+            for old_profile in glob.glob(glob.escape(pe_prefix) + '.*.contig_profile.npz'):
+                os.remove(old_profile)
+            arg_list.append([i, abr_path, raw_data[i].split('\t'), job_threads, mg_ref, idx_file,
+                             profile_list[i]
+                             ])
+        run_sample_jobs(profile_sample, arg_list, align_jobs, job_threads,
+                        o_join(abr_path, mg_id + '.align_times.tsv'), 'contig_profile'
+                        )
+    logging.info('Projecting %s contig profiles onto %s subcontigs\n' % (len(profile_list), len(sub_idx)))
+    depth_mtx = np.zeros((len(sub_idx), 2 * len(profile_list)), dtype=np.float32)
+    col_list = []
+    for i, profile_file in enumerate(profile_list):
+        contig_names, contig_lens, sum_arr, sq_arr, bin_size = s_depth.load_profile(profile_file)
+        depth_arr, var_arr = s_depth.project_profile(sum_arr, sq_arr, contig_lens, sub_idx.contig_idx,
+                                                     sub_idx.starts, sub_idx.ends, bin_size
+                                                     )
+        depth_mtx[:, 2 * i] = depth_arr
+        depth_mtx[:, 2 * i + 1] = var_arr
+        col_list.extend([profile_file, profile_file + '-var'])
+    s_depth.write_depth_table(mg_mba_out, sub_idx.headers(), sub_idx.lengths(), depth_mtx, col_list)
+    scaled_data = StandardScaler().fit_transform(depth_mtx)
+    s_fs.write_features(mg_mba_std, sub_idx.headers(), scaled_data, export_tsv=export_tsv, meta=cov_meta)
+
+    return mg_mba_std, mg_mba_out
+
+
+def profile_sample(p):
+    i, abr_path, raw_file_list, nthreads, mg_ref, idx_file, profile_file = p
+    start_time = time.time()
+    pe_id = runContigProfile(abr_path, raw_file_list, nthreads, mg_ref, idx_file, profile_file)
 
+    return i, pe_id, profile_file, time.time() - start_time
 
-def runMiniMap2(abr_path, subcontig_path, mg_id, raw_file_list, nthreads):
+
+def runContigProfile(abr_path, raw_file_list, nthreads, mg_ref, idx_file, profile_file):
+    """Map reads to the whole contigs and keep their binned depth profile instead of a BAM.
+
+    minimap2's SAM is read straight into a depth_engine.ProfileAccumulator, no samtools involved,
+    which holds the profile bins rather than a per-base array of the whole assembly.
+    :return: pe_id, the profile is saved to profile_file"""
+    pe_id = basename(raw_file_list[0]).split('.')[0]
+    sub_idx = s_sidx.load_subcontig_index(idx_file)
+    read_list = get_read_list(raw_file_list)
+    logging.info('Running minimap2-sr on %s against whole contigs\n' % pe_id)
+    acc = s_depth.ProfileAccumulator(sub_idx.contig_names, sub_idx.contig_lens)
+    read_list, decomp_list = decompress_reads(abr_path, read_list)
+    mem_cmd = ['minimap2', '-ax', 'sr', '-I', MMI_INDEX_SIZE, '-t', str(nthreads)
+               ] + minimap2_ref_args(abr_path, None, None, pe_id, mg_ref) + read_list
+    try:
+        with open(o_join(abr_path, pe_id + '.stderr.txt'), 'w') as stderr_file:
+            run_mem = Popen(mem_cmd, stdout=PIPE, stderr=stderr_file, text=True, bufsize=1 << 20)
+            acc.add_sam(run_mem.stdout)
+            run_mem.stdout.close()
+            run_mem.wait()
+    finally:
+        close_decompress(decomp_list)
+    if run_mem.returncode != 0:
+        raise Exception("**ERROR** minimap2 failed for " + pe_id + ", see "
+                        + o_join(abr_path, pe_id + '.stderr.txt'))
+    sum_arr, sq_arr = acc.profile()
+    s_depth.save_profile(profile_file, sub_idx.contig_names, sub_idx.contig_lens, sum_arr, sq_arr)
+
+    return pe_id
+
+
+def runKmerCov(abr_path, mg_id, mg_raw_file_list, subcontig_path, nthreads, export_tsv=False):
+    """Approximate subcontig coverage without alignment, for screening many samples quickly.
+
+    A FracMinHash sample of each subcontig's k-mers is counted in one pass over each sample's
+    reads. Counts are kept per sample as <pe_id>.<key>.kmer_cov.npz, keyed on the checksums of
+    its reads and on the sketch like the depth columns of procMetaGs, so added or changed
+    samples are the only ones hashed again.
+    :return: the coverage feature table and mbacov TSV, laid out as runMBAcov writes them"""
+    mg_mba_out = o_join(abr_path, mg_id + '.mbacov.tsv')
+    mg_mba_std = o_join(abr_path, mg_id + '.coverage.scaled')
+    mg_sub_path = o_join(subcontig_path, mg_id + '.subcontigs.fasta')
+    sub_src = mg_sub_path if isfile(mg_sub_path) else s_sidx.index_file(mg_sub_path)
+    if not isfile(sub_src):
+        raise Exception("**ERROR** neither " + mg_sub_path + " nor its subcontig index exist")
+    # keyed on the subcontigs like the minimap2 index, new windows are sketched again
+    sketch_prefix = o_join(abr_path, mg_id + '.k' + str(s_kab.KMER_ABUND_K) + '.s' + str(s_kab.KMER_ABUND_SCALED))
+    sketch_file = sketch_prefix + '.' + file_hash(sub_src) + '.kmer_sketch.npz'
+    raw_data = get_raw_data(mg_raw_file_list)
+    if not isfile(sketch_file):
+        for old_sketch in glob.glob(glob.escape(sketch_prefix) + '.*.kmer_sketch.npz'):
+            os.remove(old_sketch)
+        logging.info('Sketching %s subcontig k-mers\n' % mg_id)
+        sub_records = s_sidx.subcontig_records(mg_sub_path)
+        s_kab.save_sketch(sketch_file, *s_kab.sketch_subcontigs(sub_records, nthreads))
+    header_arr, len_arr, uniq_hashes, sub_arr, hash_idx, sketch_params = s_kab.load_sketch(sketch_file)
+    sketch_key = s_kab.hash_key(uniq_hashes)
+    count_list = [o_join(abr_path, basename(x.split('\t')[0]).split('.')[0] + '.' + y + '.kmer_cov.npz')
+                  for x, y in zip(raw_data, sample_keys(abr_path, raw_data, sketch_key, nthreads))
+                  ]
+    cov_meta = {'kmer_sketch': [basename(sketch_file), sketch_key],
+                'counts': [basename(x) for x in count_list]
+                }
+    if s_fs.feature_exists(mg_mba_std) and \
+            all(s_fs.load_features(mg_mba_std)[2].get(k) == v for k, v in cov_meta.items()):
+        logging.info('Loading Abundance matrix for %s\n' % mg_id)
+        return mg_mba_std, mg_mba_out
+
+    todo_list = [i for i, count_file in enumerate(count_list) if not isfile(count_file)]
+    logging.info('%s of %s read samples have k-mer counts from an earlier run\n'
+                 % (len(raw_data) - len(todo_list), len(raw_data))
+                 )
+    if todo_list:
+        # sourmash hashes on one thread, so every thread takes its own sample
+        count_jobs, job_threads = split_jobs(nthreads, nthreads, len(todo_list))
+        logging.info('Counting %s k-mers in %s read samples, %s at a time\n'
+                     % (len(uniq_hashes), len(todo_list), count_jobs)
+                     )
+        arg_list = []
+        for i in todo_list:
+            # counts of the sample's older reads or sketches won't be used again
+            pe_prefix = count_list[i].rsplit('.', 3)[0]
+            for old_count in glob.glob(glob.escape(pe_prefix) + '.*.kmer_cov.npz'):
+                os.remove(old_count)
+            arg_list.append([i, abr_path, raw_data[i].split('\t'), sketch_file, count_list[i]])
+        run_sample_jobs(count_sample, arg_list, count_jobs, job_threads,
+                        o_join(abr_path, mg_id + '.align_times.tsv'), 'kmer_cov'
+                        )
+    depth_mtx = np.zeros((len(header_arr), 2 * len(count_list)), dtype=np.float32)
+    col_list = []
+    for i, count_file in enumerate(count_list):
+        with np.load(count_file) as count_npz:
+            depth_arr, var_arr = s_kab.kmer_depths(count_npz['counts'], sub_arr, hash_idx, len(header_arr),
+                                                   float(count_npz['mean_read_len']), sketch_params[0]
+                                                   )
+        depth_mtx[:, 2 * i] = depth_arr
+        depth_mtx[:, 2 * i + 1] = var_arr
+        col_list.extend([count_file, count_file + '-var'])
+    s_depth.write_depth_table(mg_mba_out, header_arr, len_arr, depth_mtx, col_list)
+    scaled_data = StandardScaler().fit_transform(depth_mtx)
+    s_fs.write_features(mg_mba_std, header_arr, scaled_data, export_tsv=export_tsv, meta=cov_meta)
+
+    return mg_mba_std, mg_mba_out
+
+
+def count_sample(p):
+    # one pass over a sample's reads, saved to its keyed count_file
+    i, abr_path, raw_file_list, sketch_file, count_file = p
+    start_time = time.time()
+    pe_id = basename(raw_file_list[0]).split('.')[0]
+    _, _, uniq_hashes, _, _, sketch_params = s_kab.load_sketch(sketch_file)
+    sketch_key = s_kab.hash_key(uniq_hashes)
+    counter = s_kab.count_reads(get_read_list(raw_file_list), uniq_hashes, *sketch_params)
+    with open(count_file + '.tmp', 'wb') as count_out:
+        np.savez_compressed(count_out, counts=counter.counts, mean_read_len=counter.mean_read_len(),
+                            n_reads=counter.n_reads, sketch_key=sketch_key
+                            )
+    os.replace(count_file + '.tmp', count_file)
+
+    return i, pe_id, count_file, time.time() - start_time
+
+
+def runMiniMap2(abr_path, subcontig_path, mg_id, raw_file_list, nthreads, mg_ref=None):
     pe1 = raw_file_list[0]
     if isfile(pe1) == True:
         pe_basename = basename(pe1)
@@ -80,25 +460,25 @@ def runMiniMap2(abr_path, subcontig_path, mg_id, raw_file_list, nthreads):
             sam_size = getsize(mg_sam_out)
         except:  # if file doesn't exist
             sam_size = -1
-        if len(raw_file_list) == 2:
-            logging.info('Raw reads in FWD and REV file...\n')
-            pe2 = raw_file_list[1]
-            mem_cmd = ['minimap2', '-ax', 'sr', '-I', '8G', '-t', str(nthreads), '-o', mg_sam_out,
-                       o_join(subcontig_path, mg_id + '.subcontigs.fasta'), pe1, pe2
-                       ]
-        else:  # if the fastq is interleaved
-            logging.info('Raw reads in interleaved file...\n')
-            mem_cmd = ['minimap2', '-ax', 'sr', '-I', '8G', '-t', str(nthreads), '-o', mg_sam_out,
-                       o_join(subcontig_path, mg_id + '.subcontigs.fasta'), pe1
-                       ]
+        read_list = get_read_list(raw_file_list)
 
         if sam_size <= 0:
             logging.info('Running minimap2-sr on %s\n' % pe_id)
-            with open(mg_sam_out, 'w') as sam_file:
+            read_list, decomp_list = decompress_reads(abr_path, read_list)
+            mem_cmd = ['minimap2', '-ax', 'sr', '-I', MMI_INDEX_SIZE, '-t', str(nthreads), '-o', mg_sam_out
+                       ] + minimap2_ref_args(abr_path, subcontig_path, mg_id, pe_id, mg_ref) + read_list
+            try:
                 with open(o_join(abr_path, pe_id + '.stderr.txt'), 'w') as stderr_file:
                     with open(o_join(abr_path, pe_id + '.stdout.txt'), 'w') as stdout_file:
                         run_mem = Popen(mem_cmd, stdout=stdout_file, stderr=stderr_file)
                         run_mem.communicate()
+            finally:
+                close_decompress(decomp_list)
+            if run_mem.returncode != 0:
+                if isfile(mg_sam_out):  # a rerun would skip the step on a partial file
+                    os.remove(mg_sam_out)
+                raise Exception("**ERROR** minimap2 failed for " + pe_id + ", see "
+                                + o_join(abr_path, pe_id + '.stderr.txt'))
         else:
             logging.info('SAM file already exists, skipping alignment...')
     else:
@@ -108,50 +488,299 @@ def runMiniMap2(abr_path, subcontig_path, mg_id, raw_file_list, nthreads):
     return pe_id, mg_sam_out
 
 
+def runAlignDepth(abr_path, subcontig_path, mg_id, raw_file_list, nthreads, mg_ref, col_file):
+    """Map reads with minimap2 and stream the SAM straight into the depth engine.
+
+    Nothing but the sample's depth column is written, no BAM and no samtools.
+    :return: pe_id"""
+    pe_id = basename(raw_file_list[0]).split('.')[0]
+    read_list = get_read_list(raw_file_list)
+    logging.info('Running minimap2-sr on %s with %s threads into the depth engine\n' % (pe_id, nthreads))
+    read_list, decomp_list = decompress_reads(abr_path, read_list)
+    mem_cmd = ['minimap2', '-ax', 'sr', '-I', MMI_INDEX_SIZE, '-t', str(nthreads)
+               ] + minimap2_ref_args(abr_path, subcontig_path, mg_id, pe_id, mg_ref) + read_list
+    try:
+        with open(o_join(abr_path, pe_id + '.stderr.txt'), 'w') as stderr_file:
+            run_mem = Popen(mem_cmd, stdout=PIPE, stderr=stderr_file, text=True, bufsize=1 << 20)
+            try:
+                contig_names, contig_lens, depth_arr, var_arr = s_depth.stream_depths(run_mem.stdout)
+            finally:
+                run_mem.stdout.close()
+                run_mem.wait()
+    finally:
+        close_decompress(decomp_list)
+    if run_mem.returncode != 0:
+        raise Exception("**ERROR** minimap2 failed for " + pe_id + ", see "
+                        + o_join(abr_path, pe_id + '.stderr.txt'))
+    s_depth.save_depth_column(col_file, contig_names, contig_lens, depth_arr, var_arr, pe_id)
+
+    return pe_id
+
+
+def runAlignSort(abr_path, subcontig_path, mg_id, raw_file_list, nthreads, sort_threads=None,
+                 mg_ref=None
+                 ):
+    """Map reads with minimap2 and pipe the SAM straight into samtools sort.
+
+    Only the sorted BAM is written, under a temporary name that is moved into place once
+    both tools finished, so an existing <pe_id>.sorted.bam is always complete and skipped.
+    :return: pe_id and the sorted BAM"""
+    pe1 = raw_file_list[0]
+    if isfile(pe1) == False:
+        logging.info('Raw FASTQ file(s) are not where you said they were...')
+        sys.exit()  # TODO: replace this quick-fix with a real exception
+    pe_id = basename(pe1).split('.')[0]
+    mg_sort_out = o_join(abr_path, pe_id + '.sorted.bam')
+    if isfile(mg_sort_out) and (getsize(mg_sort_out) > 0):
+        logging.info('Sorted BAM file already exists, skipping alignment...\n')
+        return pe_id, mg_sort_out
+
+    read_list = get_read_list(raw_file_list)
+    map_threads, sort_threads = split_threads(nthreads, sort_threads)
+    logging.info('Running minimap2-sr on %s with %s threads, sorting with %s threads\n'
+                 % (pe_id, map_threads, sort_threads)
+                 )
+    read_list, decomp_list = decompress_reads(abr_path, read_list)
+    tmp_sort_out = mg_sort_out + '.tmp'
+    mem_cmd = ['minimap2', '-ax', 'sr', '-I', MMI_INDEX_SIZE, '-t', str(map_threads)
+               ] + minimap2_ref_args(abr_path, subcontig_path, mg_id, pe_id, mg_ref) + read_list
+    sort_cmd = ['samtools', 'sort', '-@', str(sort_threads), '-O', 'bam',
+                '-T', o_join(abr_path, pe_id + '.sort_tmp'), '-o', tmp_sort_out, '-'
+                ]
+    try:
+        with open(o_join(abr_path, pe_id + '.stderr.txt'), 'w') as stderr_file:
+            run_mem = Popen(mem_cmd, stdout=PIPE, stderr=stderr_file)
+            run_sort = Popen(sort_cmd, stdin=run_mem.stdout, stderr=stderr_file)
+            run_mem.stdout.close()  # samtools owns the read end, minimap2 sees it if sort dies
+            run_sort.communicate()
+            run_mem.wait()
+    finally:
+        close_decompress(decomp_list)
+    if (run_mem.returncode != 0) or (run_sort.returncode != 0):
+        if isfile(tmp_sort_out):
+            os.remove(tmp_sort_out)
+        raise Exception("**ERROR** minimap2 | samtools sort failed for " + pe_id + ", see "
+                        + o_join(abr_path, pe_id + '.stderr.txt'))
+    os.replace(tmp_sort_out, mg_sort_out)
+
+    return pe_id, mg_sort_out
+
+
+def build_mmi_index(mg_sub_path, abr_path, nthreads, preset='sr', index_size=MMI_INDEX_SIZE,
+                    mmi_prefix=None, fasta_hash=None
+                    ):
+    """minimap2 index of the subcontigs, built once and reused by every read sample and re-run.
+
+    Cached next to the subcontigs as <mg_id>.subcontigs.<preset>.<hash>.mmi, or as
+    <mmi_prefix>.<preset>.<hash>.mmi, keyed on a hash of the FASTA so changed subcontigs
+    are indexed again. Targets larger than index_size get a multi-part index, see minimap2_ref_args.
+    :param fasta_hash: file_hash of mg_sub_path if the caller already has it
+    :return: (.mmi file, True if the index has more than one part)"""
+    if mmi_prefix is None:
+        mmi_prefix = os.path.splitext(mg_sub_path)[0]
+    if fasta_hash is None:
+        fasta_hash = file_hash(mg_sub_path)
+    mmi_prefix = mmi_prefix + '.' + preset
+    mmi_file = mmi_prefix + '.' + fasta_hash + '.mmi'
+    # FASTA size overestimates the bases a little, at worst a single part index is mapped as multi-part.
+    # The size of a compressed FASTA says little about its bases, so it is always mapped as multi-part
+    multi_part = (getsize(mg_sub_path) > parse_bases(index_size)) or \
+                 (s_utils.strip_comp_ext(mg_sub_path) != mg_sub_path)
+    if isfile(mmi_file):
+        logging.info('Found minimap2 index %s\n' % mmi_file)
+        return mmi_file, multi_part
+    for old_mmi in glob.glob(glob.escape(mmi_prefix) + '.*.mmi'):  # built from older subcontigs
+        os.remove(old_mmi)
+    logging.info('Building minimap2 index %s\n' % mmi_file)
+    stderr_out = o_join(abr_path, basename(mmi_prefix) + '.mmi.stderr.txt')
+    # minimap2 can't read zstd, compressed FASTAs come in through a pipe like the reads
+    ref_list, decomp_list = decompress_reads(abr_path, [mg_sub_path])
+    mmi_cmd = ['minimap2', '-x', preset, '-I', index_size, '-t', str(nthreads), '-d', mmi_file + '.tmp'
+               ] + ref_list
+    try:
+        with open(stderr_out, 'w') as stderr_file:
+            run_mmi = Popen(mmi_cmd, stderr=stderr_file)
+            run_mmi.communicate()
+    finally:
+        close_decompress(decomp_list)
+    if run_mmi.returncode != 0:
+        if isfile(mmi_file + '.tmp'):
+            os.remove(mmi_file + '.tmp')
+        raise Exception("**ERROR** minimap2 failed to index " + mg_sub_path + ", see " + stderr_out)
+    os.replace(mmi_file + '.tmp', mmi_file)
+
+    return mmi_file, multi_part
+
+
+def minimap2_ref_args(abr_path, subcontig_path, mg_id, pe_id, mg_ref=None):
+    # mg_ref is (.mmi file, multi_part) from build_mmi_index, without it the subcontig FASTA is indexed on the fly
+    if mg_ref is None:
+        return [o_join(subcontig_path, mg_id + '.subcontigs.fasta')]
+    mmi_file, multi_part = mg_ref
+    if multi_part:
+        # each part reports its own best hits unless they are merged through temp files
+        return ['--split-prefix', o_join(abr_path, pe_id + '.mm_split'), mmi_file]
+    return [mmi_file]
+
+
+def file_hash(in_file, buf_size=1 << 24):
+    f_hash = hashlib.blake2b(digest_size=8)
+    with open(in_file, 'rb') as f_in:
+        for buf in iter(lambda: f_in.read(buf_size), b''):
+            f_hash.update(buf)
+
+    return f_hash.hexdigest()
+
+
+def parse_bases(num_str):
+    # minimap2 style size, e.g. 8G, 500M or 4000000
+    suffix = {'K': 1e3, 'M': 1e6, 'G': 1e9}
+    num_str = str(num_str).upper()
+    if num_str[-1] in suffix:
+        return int(float(num_str[:-1]) * suffix[num_str[-1]])
+    return int(num_str)
+
+
+def split_threads(nthreads, sort_threads=None):
+    """minimap2 and samtools sort threads out of nthreads, a quarter of them sort by default.
+
+    nthreads is one alignment job's share, sort_threads is clamped to 1..nthreads - 1 of it
+    so minimap2 always keeps at least one thread."""
+    nthreads = max(int(nthreads), 1)
+    if sort_threads is None:
+        sort_threads = nthreads // 4
+    elif not (1 <= int(sort_threads) <= max(nthreads - 1, 1)):
+        logging.info('--sort_threads %s does not fit a %s thread alignment job, clamping it\n'
+                     % (sort_threads, nthreads)
+                     )
+    sort_threads = min(max(int(sort_threads), 1), max(nthreads - 1, 1))
+    map_threads = max(nthreads - sort_threads, 1)
+
+    return map_threads, sort_threads
+
+
+def get_read_list(raw_file_list):
+    if len(raw_file_list) == 2:
+        logging.info('Raw reads in FWD and REV file...\n')
+        read_list = [raw_file_list[0], raw_file_list[1]]
+    else:  # if the fastq is interleaved
+        logging.info('Raw reads in interleaved file...\n')
+        read_list = [raw_file_list[0]]
+
+    return read_list
+
+
+def decompress_reads(abr_path, read_list):
+    """Hand compressed read files to minimap2 through named pipes fed by pigz/zstd.
+
+    minimap2 can't read zstd and only inflates gzip on one thread, so those files are
+    decompressed in separate processes while minimap2 maps.
+    :return: paths to give minimap2 and the (process, fifo) of each decompressed file"""
+    fifo_list = []
+    decomp_list = []
+    for i, read_file in enumerate(read_list):
+        decomp_cmd = s_utils.decompress_cmd(read_file)
+        if decomp_cmd is None:
+            fifo_list.append(read_file)
+            continue
+        fifo = o_join(abr_path, basename(s_utils.strip_comp_ext(read_file)) + '.' + str(i) + '.fifo')
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+        # the shell only opens the pipe once minimap2 starts reading from it
+        run_decomp = Popen(['sh', '-c', 'exec "$@" > "$0"', fifo] + decomp_cmd)
+        fifo_list.append(fifo)
+        decomp_list.append((run_decomp, fifo))
+
+    return fifo_list, decomp_list
+
+
+def close_decompress(decomp_list):
+    for run_decomp, fifo in decomp_list:
+        if run_decomp.poll() is None:  # minimap2 stopped before reading all of it
+            run_decomp.kill()
+        run_decomp.wait()
+        os.remove(fifo)
+
+
 def runSamTools(abr_path, pe_id, nthreads, mg_id, mg_sam_out):
     mg_bam_out = o_join(abr_path, pe_id + '.bam')
     if isfile(mg_bam_out) == False:
         logging.info('Converting SAM to BAM with SamTools\n')
         bam_cmd = ['samtools', 'view', '-S', '-b', '-@', str(nthreads), mg_sam_out]
         with open(mg_bam_out, 'w') as bam_file:
-            with open(o_join(abr_path, mg_id + '.stderr.txt'), 'w') as stderr_file:
+            with open(o_join(abr_path, pe_id + '.stderr.txt'), 'w') as stderr_file:
                 run_bam = Popen(bam_cmd, stdout=bam_file, stderr=stderr_file)
                 run_bam.communicate()
+        if run_bam.returncode != 0:
+            if isfile(mg_bam_out):
+                os.remove(mg_bam_out)
+            raise Exception("**ERROR** samtools view failed for " + pe_id + ", see "
+                            + o_join(abr_path, pe_id + '.stderr.txt'))
     # sort bam file
     mg_sort_out = o_join(abr_path, pe_id + '.sorted.bam')
     if isfile(mg_sort_out) == False:
         logging.info('Sort BAM with SamTools\n')
         sort_cmd = ['samtools', 'sort', '-@', str(nthreads), mg_bam_out, '-o', mg_sort_out]
-        with open(o_join(abr_path, mg_id + '.stderr.txt'), 'w') as stderr_file:
+        with open(o_join(abr_path, pe_id + '.stderr.txt'), 'a') as stderr_file:
             run_sort = Popen(sort_cmd, stderr=stderr_file)
             run_sort.communicate()
+        if run_sort.returncode != 0:
+            if isfile(mg_sort_out):
+                os.remove(mg_sort_out)
+            raise Exception("**ERROR** samtools sort failed for " + pe_id + ", see "
+                            + o_join(abr_path, pe_id + '.stderr.txt'))
 
     return mg_sort_out
 
 
-def runMBAcov(abr_path, mg_id, sorted_bam_list):
-    # run mba on sorted bams
+def runMBAcov(abr_path, mg_id, col_file_list, export_tsv=False):
+    """Merge per sample depth columns into the coverage matrix and its scaled features.
+
+    The StandardScaler is set up from the cached statistics of each column instead of being
+    fit again, and the merged tables are only rewritten when the set of columns changed.
+    :return: the coverage feature table and the mbacov TSV"""
     mg_mba_out = o_join(abr_path, mg_id + '.mbacov.tsv')
-    mg_mba_std = o_join(abr_path, mg_id + '.coverage.scaled.tsv')
-    try:  # if file exists but is empty
-        mba_size = getsize(mg_mba_std)
-    except:  # if file doesn't exist
-        mba_size = -1
-    if mba_size <= 0:
-        logging.info('Calculating Coverage with jgi_summarize_bam_contig_depths\n')
-        mba_cmd = ['jgi_summarize_bam_contig_depths', '--outputDepth', mg_mba_out]
-        mba_cmd.extend(sorted_bam_list)
-        with open(o_join(abr_path, mg_id + '.stderr.txt'), 'w') as stderr_file:
-            run_mba = Popen(mba_cmd, stderr=stderr_file)
-            run_mba.communicate()
+    mg_mba_std = o_join(abr_path, mg_id + '.coverage.scaled')
+    cov_meta = {'depth_columns': [basename(x) for x in col_file_list]}
+    if s_fs.feature_exists(mg_mba_std) and isfile(mg_mba_out) and \
+            (s_fs.load_features(mg_mba_std)[2].get('depth_columns') == cov_meta['depth_columns']):
+        logging.info('Loading Abundance matrix for %s\n' % mg_id)
+        return mg_mba_std, mg_mba_out
 
-        mg_mba_df = pd.read_csv(mg_mba_out, header=0, sep='\t')
-        mg_mba_df.rename(columns={'contigName': 'subcontig_id'}, inplace=True)
-        mg_mba_df.drop(columns=['contigLen', 'totalAvgDepth'], inplace=True)
-        mg_mba_df.set_index('subcontig_id', inplace=True)
-        scale = StandardScaler().fit(mg_mba_df.values)
-        scaled_data = scale.transform(mg_mba_df.values)
-        std_merge_df = pd.DataFrame(scaled_data, index=mg_mba_df.index).reset_index()
-        std_merge_df.to_csv(mg_mba_std, header=True, sep='\t', index=False)
+    logging.info('Merging %s depth columns into the %s coverage matrix\n' % (len(col_file_list), mg_id))
+    depth_mtx = None
+    col_list = []
+    stat_list = []
+    for i, col_file in enumerate(col_file_list):
+        contig_names, contig_lens, depth_arr, var_arr, col_name, col_stats = s_depth.load_depth_column(col_file)
+        if depth_mtx is None:
+            first_names, first_lens = contig_names, contig_lens
+            depth_mtx = np.zeros((len(contig_names), 2 * len(col_file_list)), dtype=np.float32)
+        elif not np.array_equal(contig_names, first_names):
+            raise Exception("**ERROR** " + col_file + " was not aligned to the same subcontigs as "
+                            + col_file_list[0])
+        depth_mtx[:, 2 * i] = depth_arr
+        depth_mtx[:, 2 * i + 1] = var_arr
+        col_list.extend([col_name, col_name + '-var'])
+        stat_list.append(col_stats)
+    s_depth.write_depth_table(mg_mba_out, first_names, first_lens, depth_mtx, col_list)
+    col_stats = np.concatenate(stat_list)
+    scale = scaler_from_stats(col_stats[:, 0], col_stats[:, 1], len(first_names))
+    scaled_data = scale.transform(depth_mtx)
+    s_fs.write_features(mg_mba_std, first_names, scaled_data, export_tsv=export_tsv, meta=cov_meta)
 
     return mg_mba_std, mg_mba_out
+
+
+def scaler_from_stats(mean_arr, var_arr, n_rows):
+    # StandardScaler as fit() leaves it, from per column means and population variances
+    scale = StandardScaler()
+    scale.mean_ = np.asarray(mean_arr, dtype=np.float64)
+    scale.var_ = np.asarray(var_arr, dtype=np.float64)
+    scale_arr = np.sqrt(scale.var_)
+    scale.scale_ = np.where(scale_arr < 10 * np.finfo(scale_arr.dtype).eps, 1.0, scale_arr)
+    scale.n_samples_seen_ = n_rows
+    scale.n_features_in_ = len(scale.mean_)
+
+    return scale
@@ -7,6 +7,7 @@ from os.path import join as o_join
 from pathlib import Path
 
 import hdbscan
+import numpy as np
 import pandas as pd
 import umap
 from sklearn import svm
@@ -14,6 +15,8 @@ from sklearn.cluster import MiniBatchKMeans
 from sklearn.decomposition import PCA
 from tqdm import tqdm
 
+import saber.feature_store as s_fs
+import saber.id_registry as s_ids
 import saber.utilities as s_utils
 
 warnings.simplefilter("error", category=UserWarning)
@@ -21,15 +24,15 @@ warnings.filterwarnings('ignore', '.*sparsity.*', )
 warnings.simplefilter("ignore", category=DeprecationWarning)
 
 
-def runOCSVM(tc_df, mg_df, tc_id, n, gam):
-    # fit OCSVM
+def runOCSVM(tc_df, mg_df, tc_id, n, gam, sub2contig):
+    # fit OCSVM, mg_df is indexed by subcontig code
     clf = svm.OneClassSVM(nu=n, gamma=gam)
     clf.fit(tc_df.values)
     mg_pred = clf.predict(mg_df.values)
-    contig_id_list = [x.rsplit('_', 1)[0] for x in mg_df.index.values]
-    pred_df = pd.DataFrame(zip(mg_df.index.values, contig_id_list, mg_pred),
-                           columns=['subcontig_id', 'contig_id', 'pred']
-                           )
+    pred_df = pd.DataFrame({'subcontig_id': mg_df.index.values,
+                            'contig_id': sub2contig[mg_df.index.values],
+                            'pred': mg_pred
+                            })
     pred_df['nu'] = n
     pred_df['gamma'] = gam
     pred_df['sag_id'] = tc_id
@@ -38,7 +41,7 @@ def runOCSVM(tc_df, mg_df, tc_id, n, gam):
     return pred_df
 
 
-def runKMEANS(recruit_contigs_df, sag_id, std_merge_df):
+def runKMEANS(recruit_contigs_df, sag_id, std_merge_df, sub2contig):
     temp_cat_df = std_merge_df.copy()
     last_len = 0
     while temp_cat_df.shape[0] != last_len:
@@ -57,8 +60,8 @@ def runKMEANS(recruit_contigs_df, sag_id, std_merge_df):
         temp_cat_df = temp_cat_df.loc[temp_cat_df.index.isin(list(subset_clust_df['subcontig_id']))]
     cat_clust_df = subset_clust_df.copy()
     std_id_df = pd.DataFrame(std_merge_df.index.values, columns=['subcontig_id'])
-    std_id_df['contig_id'] = [x.rsplit('_', 1)[0] for x in std_id_df['subcontig_id']]
-    cat_clust_df['contig_id'] = [x.rsplit('_', 1)[0] for x in cat_clust_df['subcontig_id']]
+    std_id_df['contig_id'] = sub2contig[std_id_df['subcontig_id'].values]
+    cat_clust_df['contig_id'] = sub2contig[cat_clust_df['subcontig_id'].values]
     sub_std_df = std_id_df.loc[std_id_df['contig_id'].isin(list(cat_clust_df['contig_id']))]
     std_clust_df = sub_std_df.merge(cat_clust_df, on=['subcontig_id', 'contig_id'], how='outer')
     std_clust_df.fillna(-1, inplace=True)
@@ -74,18 +77,15 @@ def runKMEANS(recruit_contigs_df, sag_id, std_merge_df):
     filter_clust_pred_df = std_clust_pred_df.loc[std_clust_pred_df['kmeans_pred_x'] == 1]
     kmeans_pass_list = []
     for md_nm in major_pred_df['subcontig_id']:
-        kmeans_pass_list.append([sag_id, md_nm, md_nm.rsplit('_', 1)[0]])
+        kmeans_pass_list.append([sag_id, md_nm, sub2contig[md_nm]])
     return kmeans_pass_list, filter_clust_pred_df
 
 
 def recruitOCSVM(p):
-    m_df, sub_trusted_df, sag_id, nu, gamma = p
-    tc_contig_list = list(sub_trusted_df['contig_id'].unique())
-    m_df['contig_id'] = [x.rsplit('_', 1)[0] for x in m_df.index.values]
-    tc_feat_df = m_df.query('contig_id in @tc_contig_list')
-    mg_feat_df = m_df.copy()  # .query('contig_id in @sub_contig_list')
-    mg_feat_df.drop(columns=['contig_id'], inplace=True)
-    tc_feat_df.drop(columns=['contig_id'], inplace=True)
+    m_df, sub_trusted_df, sag_id, nu, gamma, sub2contig = p
+    tc_contig_list = sub_trusted_df['contig_id'].unique()
+    tc_feat_df = m_df.loc[np.isin(sub2contig[m_df.index.values], tc_contig_list)]
+    mg_feat_df = m_df  # .query('contig_id in @sub_contig_list')
     major_df = False
     if (tc_feat_df.shape[0] != 0) & (mg_feat_df.shape[0] != 0):
         '''
@@ -97,7 +97,7 @@ def recruitOCSVM(p):
                                       )
         nonrecruit_kmeans_df = mg_feat_df.loc[kmeans_pass_df['subcontig_id']]
         '''
-        ocsvm_recruit_df = runOCSVM(tc_feat_df, mg_feat_df, sag_id, nu, gamma)
+        ocsvm_recruit_df = runOCSVM(tc_feat_df, mg_feat_df, sag_id, nu, gamma, sub2contig)
         val_perc = ocsvm_recruit_df.groupby('contig_id')['pred'].value_counts(
             normalize=True).reset_index(name='percent')
         pos_perc = val_perc.query('pred == 1')
@@ -108,24 +108,17 @@ def recruitOCSVM(p):
 
 def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                  denovo_min_clust, denovo_min_samp, anchor_min_clust, anchor_min_samp,
-                 nu, gamma, nthreads
+                 nu, gamma, nthreads, export_tsv=False, sub_idx_file=None
                  ):  # TODO: need to add multithreading where ever possible
-    # Get the MinHash recruits
-    if minhash_dict:
-        mh_trusted_df = minhash_dict[201]
-        mh_trusted_df.rename(columns={'q_contig_id': 'contig_id'}, inplace=True)
-        mh_best_df = mh_trusted_df.query('jacc_sim == 1.0')
     # Convert CovM to UMAP feature table
     set_init = 'spectral'
-    merged_emb = Path(o_join(tmp_path, mg_id + '.merged_emb.tsv'))
-    if not merged_emb.is_file():
-        cov_emb = Path(o_join(tmp_path, mg_id + '.covm_emb.tsv'))
+    merged_emb = o_join(tmp_path, mg_id + '.merged_emb')
+    if not s_fs.feature_exists(merged_emb):
+        cov_emb = o_join(tmp_path, mg_id + '.covm_emb')
         print('Building embedding for Coverage...')
-        cov_df = pd.read_csv(cov_file, header=0, sep='\t', index_col='subcontig_id')
-        cov_df['contig_id'] = [x.rsplit('_', 1)[0] for x in cov_df.index]
+        cov_df = s_fs.load_feature_df(cov_file)
         #mh_contig_list = list(mh_trusted_df['contig_id'].unique())
         mh_cov_df = cov_df.copy() #.query('contig_id == @mh_contig_list')
-        del mh_cov_df['contig_id']
         n_neighbors = 20
         # COV sometimes crashes when init='spectral', trying higher NN value for 2-stage DR
         try:
@@ -164,19 +157,14 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                                                   #random_state=42, metric='manhattan',
                                                   #init=pca_emb
                                                   #).fit_transform(mh_cov_df)
-        umap_feat_df = pd.DataFrame(clusterable_embedding, index=mh_cov_df.index.values)
-        umap_feat_df.reset_index(inplace=True)
-        umap_feat_df.rename(columns={'index': 'subcontig_id'}, inplace=True)
-        umap_feat_df.to_csv(cov_emb, sep='\t', index=False)
+        s_fs.write_features(cov_emb, mh_cov_df.index, clusterable_embedding, export_tsv=export_tsv)
 
         # Convert Tetra to UMAP feature table
-        tetra_emb = Path(o_join(tmp_path, mg_id + '.tetra_emb.tsv'))
+        tetra_emb = o_join(tmp_path, mg_id + '.tetra_emb')
         print('Building embedding for Tetra Hz...')
-        tetra_df = pd.read_csv(tetra_file, header=0, sep='\t', index_col='contig_id')
-        tetra_df['contig_id'] = [x.rsplit('_', 1)[0] for x in tetra_df.index]
+        tetra_df = s_fs.load_feature_df(tetra_file)
         #mh_contig_list = list(mh_trusted_df['contig_id'].unique())
         mh_tetra_df = tetra_df.copy() #.query('contig_id == @mh_contig_list')
-        del mh_tetra_df['contig_id']
         #n_neighbors = 10
         try:
             clusterable_embedding = umap.UMAP(random_state=42).fit_transform(mh_tetra_df)
@@ -213,32 +201,32 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                                                   #random_state=42, metric='manhattan',
                                                   #init=pca_emb
                                                   #).fit_transform(mh_tetra_df)
-        umap_feat_df = pd.DataFrame(clusterable_embedding, index=mh_tetra_df.index.values)
-        umap_feat_df.reset_index(inplace=True)
-        umap_feat_df.rename(columns={'index': 'subcontig_id'}, inplace=True)
-        umap_feat_df.to_csv(tetra_emb, sep='\t', index=False)
+        s_fs.write_features(tetra_emb, mh_tetra_df.index, clusterable_embedding, export_tsv=export_tsv)
 
         # Merge Coverage and Tetra Embeddings
         print('Merging Tetra and Coverage Embeddings...')
-        tetra_feat_df = pd.read_csv(tetra_emb, sep='\t', header=0, index_col='subcontig_id')
-        tetra_feat_df['contig_id'] = [x.rsplit('_', 1)[0] for x in tetra_feat_df.index.values]
+        tetra_feat_df = s_fs.load_feature_df(tetra_emb)
         tetra_feat_df.columns = [str(x) + '_tetra' for x in tetra_feat_df.columns]
         # load covm file
-        cov_feat_df = pd.read_csv(cov_emb, sep='\t', header=0)
-        cov_feat_df.rename(columns={'contigName': 'subcontig_id'}, inplace=True)
-        cov_feat_df['contig_id'] = [x.rsplit('_', 1)[0] for x in cov_feat_df['subcontig_id']]
-        cov_feat_df.set_index('subcontig_id', inplace=True)
+        cov_feat_df = s_fs.load_feature_df(cov_emb)
         cov_feat_df.columns = [str(x) + '_cov' for x in cov_feat_df.columns]
         merge_df = cov_feat_df.merge(tetra_feat_df, left_index=True, right_index=True, how='left')
-        merge_df.drop(columns=['contig_id_tetra', 'contig_id_cov'], inplace=True)
-        tetra_feat_df.drop(columns=['contig_id_tetra'], inplace=True)
-        cov_feat_df.drop(columns=['contig_id_cov'], inplace=True)
-        merge_df.to_csv(merged_emb, sep='\t')
+        s_fs.write_features(merged_emb, merge_df.index, merge_df.values, columns=list(merge_df.columns),
+                            export_tsv=export_tsv
+                            )
+
+    # Subcontig and contig IDs are int32 codes from here on, names only go into the output tables
+    merge_df = s_fs.load_feature_df(merged_emb)
+    id_reg = s_ids.from_feature_ids(merge_df.index, sub_idx_file)
+    merge_df.index = np.arange(len(id_reg), dtype=np.int32)
+    # Get the MinHash recruits
+    if minhash_dict:
+        mh_trusted_df = id_reg.encode_df(minhash_dict[201].rename(columns={'q_contig_id': 'contig_id'}))
+        mh_best_df = mh_trusted_df.query('jacc_sim == 1.0')
 
     denovo_out_file = Path(o_join(clst_path, mg_id + '.denovo_hdbscan.tsv'))
     if not denovo_out_file.is_file():
         print('Performing De Novo Clustering...')
-        merge_df = pd.read_csv(merged_emb, sep='\t', header=0, index_col='subcontig_id')
         clusterer = hdbscan.HDBSCAN(min_cluster_size=denovo_min_clust, prediction_data=True,
                                     min_samples=denovo_min_samp, core_dist_n_jobs=nthreads
                                     ).fit(merge_df.values)
@@ -247,24 +235,21 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
         cluster_probs = clusterer.probabilities_
         cluster_outlier = clusterer.outlier_scores_
 
-        cluster_df = pd.DataFrame(zip(merge_df.index.values, cluster_labels, cluster_probs,
-                                      cluster_outlier),
-                                  columns=['subcontig_id', 'label', 'probabilities',
-                                           'outlier_score']
-                                  )
-        cluster_df['contig_id'] = [x.rsplit('_', 1)[0] for x in cluster_df['subcontig_id']]
-        cluster_df.to_csv(denovo_out_file, sep='\t', index=False)
+        cluster_df = pd.DataFrame({'subcontig_id': merge_df.index.values, 'label': cluster_labels,
+                                   'probabilities': cluster_probs, 'outlier_score': cluster_outlier,
+                                   'contig_id': id_reg.sub2contig
+                                   })
+        id_reg.decode_df(cluster_df).to_csv(denovo_out_file, sep='\t', index=False)
     else:
         print('Loading De Novo Clusters...')
-        cluster_df = pd.read_csv(denovo_out_file, header=0, sep='\t')
+        cluster_df = id_reg.encode_df(pd.read_csv(denovo_out_file, header=0, sep='\t'))
     denovo_out_file = Path(o_join(clst_path, mg_id + '.denovo_clusters.tsv'))
     noise_out_file = Path(o_join(clst_path, mg_id + '.denovo_noise.tsv'))
     if not denovo_out_file.is_file():
         print('Denoising Clusters...')
         pool = multiprocessing.Pool(processes=nthreads)
         arg_list = []
-        for contig in tqdm(list(cluster_df['contig_id'].unique())):
-            sub_df = cluster_df.query('contig_id == @contig')
+        for contig, sub_df in tqdm(cluster_df.groupby('contig_id')):
             arg_list.append([sub_df, contig])
         ns_ratio_list = []
         results = pool.imap_unordered(denoise_clust, arg_list)
@@ -279,12 +264,12 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
         if denovo_clusters_df.empty:
             #  TODO: fix this or print a warning message to user :)
             denovo_clusters_df = noise_df.copy()
-        denovo_clusters_df.to_csv(denovo_out_file, sep='\t', index=False)
-        noise_df.to_csv(noise_out_file, sep='\t', index=False)
+        id_reg.decode_df(denovo_clusters_df).to_csv(denovo_out_file, sep='\t', index=False)
+        id_reg.decode_df(noise_df).to_csv(noise_out_file, sep='\t', index=False)
     else:
         print('Loading Cleaned De Novo Clusters...')
-        denovo_clusters_df = pd.read_csv(denovo_out_file, header=0, sep='\t')
-        noise_df = pd.read_csv(noise_out_file, header=0, sep='\t')
+        denovo_clusters_df = id_reg.encode_df(pd.read_csv(denovo_out_file, header=0, sep='\t'))
+        noise_df = id_reg.encode_df(pd.read_csv(noise_out_file, header=0, sep='\t'))
 
     ######################################
     ########## ANCHORED BINNING ##########
@@ -295,7 +280,6 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
         if not trust_anchors_file.is_file():
             print('Anchored Binning Starting with Trusted Contigs...')
             print('Clustering with HDBSCAN and Anchored Settings...')
-            merge_df = pd.read_csv(merged_emb, sep='\t', header=0, index_col='subcontig_id')
             clusterer = hdbscan.HDBSCAN(min_cluster_size=anchor_min_clust, prediction_data=True,
                                         min_samples=anchor_min_samp, core_dist_n_jobs=nthreads
                                         ).fit(merge_df.values)
@@ -304,24 +288,21 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
             cluster_probs = clusterer.probabilities_
             cluster_outlier = clusterer.outlier_scores_
 
-            cluster_df = pd.DataFrame(zip(merge_df.index.values, cluster_labels, cluster_probs,
-                                          cluster_outlier),
-                                      columns=['subcontig_id', 'label', 'probabilities',
-                                               'outlier_score']
-                                      )
-            cluster_df['contig_id'] = [x.rsplit('_', 1)[0] for x in cluster_df['subcontig_id']]
-            cluster_df.to_csv(trust_anchors_file, sep='\t', index=False)
+            cluster_df = pd.DataFrame({'subcontig_id': merge_df.index.values, 'label': cluster_labels,
+                                       'probabilities': cluster_probs, 'outlier_score': cluster_outlier,
+                                       'contig_id': id_reg.sub2contig
+                                       })
+            id_reg.decode_df(cluster_df).to_csv(trust_anchors_file, sep='\t', index=False)
         else:
             print('Loading HDBSCAN Anchored Clusters...')
-            cluster_df = pd.read_csv(trust_anchors_file, header=0, sep='\t')
+            cluster_df = id_reg.encode_df(pd.read_csv(trust_anchors_file, header=0, sep='\t'))
         hdbscan_out_file = Path(o_join(clst_path, mg_id + '.hdbscan_clusters.tsv'))
         noise_out_file = Path(o_join(clst_path, mg_id + '.hdbscan_noise.tsv'))
         if not hdbscan_out_file.is_file():
             print('Denoising Clusters...')
             pool = multiprocessing.Pool(processes=nthreads)
             arg_list = []
-            for contig in tqdm(list(cluster_df['contig_id'].unique())):
-                sub_df = cluster_df.query('contig_id == @contig')
+            for contig, sub_df in tqdm(cluster_df.groupby('contig_id')):
                 arg_list.append([sub_df, contig])
             ns_ratio_list = []
             results = pool.imap_unordered(denoise_clust, arg_list)
@@ -395,11 +376,11 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                 trust_recruit_list.append(hdbscan_cat_df)
             trust_recruit_df = pd.concat(trust_recruit_list)
             trust_recruit_df.rename(columns={'sag_id': 'best_label'}, inplace=True)
-            trust_recruit_df.to_csv(hdbscan_out_file, sep='\t', index=False)
-            noise_df.to_csv(noise_out_file, sep='\t', index=False)
+            id_reg.decode_df(trust_recruit_df).to_csv(hdbscan_out_file, sep='\t', index=False)
+            id_reg.decode_df(noise_df).to_csv(noise_out_file, sep='\t', index=False)
         elif hdbscan_out_file.is_file():
             print('HDBSCAN Anchored Clusters already exist...')
-            trust_recruit_df = pd.read_csv(hdbscan_out_file, sep='\t', header=0)
+            trust_recruit_df = id_reg.encode_df(pd.read_csv(hdbscan_out_file, sep='\t', header=0))
     else:
         print('No Trusted Contigs Provided...')
         trust_recruit_df = False
@@ -409,14 +390,13 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
         ocsvm_out_file = Path(o_join(clst_path, mg_id + '.ocsvm_clusters.tsv'))
         if not ocsvm_out_file.is_file():
             print('Performing Anchored Recruitment with OC-SVM...')
-            merge_df = pd.read_csv(merged_emb, sep='\t', header=0, index_col='subcontig_id')
             print('Running OC-SVM algorithm...')
             pool = multiprocessing.Pool(processes=nthreads)
             arg_list = []
             oc_sag_list = list(mh_best_df['sag_id'].unique())
             for sag_id in tqdm(oc_sag_list):
                 sub_mh_df = mh_best_df.query('sag_id == @sag_id')
-                arg_list.append([merge_df, sub_mh_df, sag_id, nu, gamma])
+                arg_list.append([merge_df, sub_mh_df, sag_id, nu, gamma, id_reg.sub2contig])
             ocsvm_recruit_list = []
             ocsvm_recruit_dict = {}
             results = pool.imap_unordered(recruitOCSVM, arg_list)
@@ -453,10 +433,10 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                     ocsvm_clust_list.append(ocsvm_cat_df)
             ocsvm_clust_df = pd.concat(ocsvm_clust_list)
             ocsvm_clust_df.rename(columns={'sag_id': 'best_label'}, inplace=True)
-            ocsvm_clust_df.to_csv(ocsvm_out_file, sep='\t', index=False)
+            id_reg.decode_df(ocsvm_clust_df).to_csv(ocsvm_out_file, sep='\t', index=False)
         elif ocsvm_out_file.is_file():
             print('OC-SVM Clusters already exist...')
-            ocsvm_clust_df = pd.read_csv(ocsvm_out_file, sep='\t', header=0)
+            ocsvm_clust_df = id_reg.encode_df(pd.read_csv(ocsvm_out_file, sep='\t', header=0))
     else:
         ocsvm_clust_df = False
 
@@ -484,21 +464,19 @@ def runClusterer(mg_id, tmp_path, clst_path, cov_file, tetra_file, minhash_dict,
                 best_concat_df = pd.concat([best_inter_df, sub_mh_best_df]).drop_duplicates()
                 inter_clust_list.append(best_concat_df)
             inter_clust_df = pd.concat(inter_clust_list)
-            inter_clust_df.to_csv(inter_out_file, sep='\t', index=False)
+            id_reg.decode_df(inter_clust_df).to_csv(inter_out_file, sep='\t', index=False)
         elif inter_out_file.is_file():
             print('Combined Clusters already exist...')
-            inter_clust_df = pd.read_csv(inter_out_file, sep='\t', header=0)
+            inter_clust_df = id_reg.encode_df(pd.read_csv(inter_out_file, sep='\t', header=0))
     else:
         inter_clust_df = False
 
     logging.info('Cleaning up intermediate files...\n')
-    for s in ["*.denovo.covm_emb.tsv", "*.denovo.tetra_emb.tsv",
-              "*.anchored.covm_emb.tsv", "*.anchored.tetra_emb.tsv",
-              "*.subcontigs.*"
-              ]:
+    # the covm/tetra/merged embedding feature tables stay in tmp_path, later runs load them
+    for s in ["*.subcontigs.*"]:
         s_utils.runCleaner(clst_path, s)
 
-    return denovo_clusters_df, trust_recruit_df, ocsvm_clust_df, inter_clust_df
+    return denovo_clusters_df, trust_recruit_df, ocsvm_clust_df, inter_clust_df, id_reg
 
 
 def sag_compare(p):
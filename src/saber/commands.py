@@ -10,10 +10,12 @@ import saber.abundance_recruiter as abr
 import saber.classy as s_class
 import saber.clusterer as clst
 import saber.compile_recruits as com
+import saber.composition as s_comp
+import saber.feature_extractor as s_fe
 import saber.logger as s_log
 import saber.minhash_recruiter as mhr
 import saber.s_args as s_args
-import saber.tetranuc_recruiter as tra
+import saber.subcontig_index as s_sidx
 import saber.utilities as s_utils
 from saber.__init__ import version
 
@@ -63,14 +65,24 @@ def recruit(sys_args):
 
     recruit_s = s_class.SABerBase("recruit")
     recruit_s.trust_path = args.trust_path
+    recruit_s.trust_map, recruit_s.trust_regex = args.trust_map, args.trust_regex
     recruit_s.mg_file = args.mg_file
     recruit_s.mg_raw_file_list = args.mg_raw_file_list
     recruit_s.save_path = args.save_path
     recruit_s.max_contig_len = int(args.max_contig_len)
     recruit_s.overlap_len = int(args.overlap_len)
     recruit_s.min_len = int(args.min_len)
+    recruit_s.comp_profile = s_comp.CompositionProfile(int(args.kmer_size), args.kmer_mode)
     recruit_s.nthreads = int(args.nthreads)
+    recruit_s.sort_threads = int(args.sort_threads) if args.sort_threads else None
+    recruit_s.keep_sam = args.keep_sam
+    recruit_s.align_jobs = int(args.align_jobs)
+    recruit_s.jgi_depths = args.depth_engine == 'jgi'
+    recruit_s.contig_cov = args.contig_cov
+    recruit_s.kmer_abund = args.kmer_abund
     recruit_s.force = args.force
+    recruit_s.export_tsv = args.export_tsv
+    recruit_s.kmer_cache = args.kmer_cache
     # Collect args for clustering
     recruit_s.denovo_min_clust, recruit_s.denovo_min_samp = args.denovo_min_clust, args.denovo_min_samp
     recruit_s.anchor_min_clust, recruit_s.anchor_min_samp = args.anchor_min_clust, args.anchor_min_samp
@@ -91,42 +103,71 @@ def recruit(sys_args):
     # TODO: think about setting a default upper and lower bp size for bins to filter bad ones
 
     # Build subcontigs for MG
-    mg_file = tuple([os.path.splitext(os.path.basename(recruit_s.mg_file))[0],
-                     recruit_s.mg_file])  # TODO: needs to support multiple MetaGs
-    mg_sub_file = s_utils.build_subcontigs('Metagenomes', [recruit_s.mg_file],
-                                           recruit_s.save_path,
-                                           recruit_s.max_contig_len,
-                                           recruit_s.overlap_len,
-                                           recruit_s.min_len
+    if args.adaptive_windows:
+        mg_len_arr = s_utils.contig_lengths(recruit_s.mg_file)
+        recruit_s.max_contig_len, recruit_s.overlap_len, recruit_s.min_len = \
+            s_utils.adaptive_window_params(mg_len_arr, recruit_s.max_contig_len, recruit_s.overlap_len,
+                                           recruit_s.min_len, int(args.max_subcontigs)
                                            )
+    mg_file = tuple([s_utils.get_samp_id(recruit_s.mg_file),
+                     recruit_s.mg_file])  # TODO: needs to support multiple MetaGs
+    # Subcontig index, composition, sequence stats and (with TCs) MinHash sketches in one read of the MG
+    mg_sub_file, tetra_file = s_fe.extract_features(recruit_s.mg_file, recruit_s.save_path,
+                                                    recruit_s.max_contig_len,
+                                                    recruit_s.overlap_len,
+                                                    recruit_s.min_len,
+                                                    recruit_s.nthreads,
+                                                    recruit_s.comp_profile,
+                                                    recruit_s.kmer_cache,
+                                                    201 if recruit_s.trust_path else None,
+                                                    recruit_s.export_tsv
+                                                    )
 
     # Build minhash signatures if there are trusted contigs
     if recruit_s.trust_path:
         # Find the Trusted Contigs (TCs)
-        tc_list = s_utils.get_SAGs(
-            recruit_s.trust_path)  # TODO: needs to support a single multi-FASTA and multiple FASTAs
-        trust_files = tuple([(os.path.splitext(os.path.basename(x))[0], x) for x in tc_list])
+        if recruit_s.trust_map or recruit_s.trust_regex:
+            # one multi-FASTA, every SAG points at the same file and tc_map says which contigs are whose
+            tc_map = s_utils.get_trusted_map(recruit_s.trust_path, recruit_s.trust_map,
+                                             recruit_s.trust_regex
+                                             )
+            trust_files = tuple([(x, recruit_s.trust_path) for x in sorted(set(tc_map.values()))])
+            update_ids = None
+        else:
+            tc_map = None
+            # the manifest lets later runs skip unchanged SAG files
+            manifest_file = os.path.join(recruit_s.save_path, 'trusted_contigs.manifest.json')
+            tc_list, update_list, tc_manifest = s_utils.scan_SAGs(recruit_s.trust_path, manifest_file)
+            trust_files = tuple([(s_utils.get_samp_id(x), x) for x in tc_list])
+            update_ids = None if update_list is None else [s_utils.get_samp_id(x) for x in update_list]
         # Run MinHash recruiting algorithm
         minhash_df_dict = mhr.run_minhash_recruiter(recruit_s.save_path,  # TODO: expose some params for users
                                                     recruit_s.save_path,
                                                     trust_files, mg_file,
                                                     recruit_s.nthreads,
-                                                    recruit_s.min_len
+                                                    recruit_s.min_len,
+                                                    tc_map, update_ids
                                                     )
+        if tc_map is None:
+            s_utils.save_manifest(manifest_file, tc_manifest)
     else:
         minhash_df_dict = False
         trust_files = tuple()
+        tc_map = None
 
     # Build abundance tables
     abund_scale_file, abund_raw_file = abr.runAbundRecruiter(recruit_s.save_path,
                                                              recruit_s.save_path, mg_sub_file,
                                                              recruit_s.mg_raw_file_list,
-                                                             recruit_s.nthreads
+                                                             recruit_s.nthreads,
+                                                             recruit_s.export_tsv,
+                                                             recruit_s.sort_threads,
+                                                             recruit_s.keep_sam,
+                                                             recruit_s.align_jobs,
+                                                             recruit_s.jgi_depths,
+                                                             recruit_s.contig_cov,
+                                                             recruit_s.kmer_abund
                                                              )
-    # Build tetra hz tables
-    tetra_file = tra.run_tetra_recruiter(recruit_s.save_path,
-                                         mg_sub_file
-                                         )
     # Run HDBSCAN Cluster and Trusted Cluster Cleaning
     recruit_s.mode, recruit_s.set, recruit_s.params_dict = s_utils.set_clust_params(recruit_s.denovo_min_clust,
                                                                                   recruit_s.denovo_min_samp,
@@ -151,12 +192,14 @@ def recruit(sys_args):
                                  recruit_s.params_dict['a_min_samp'],
                                  recruit_s.params_dict['nu'],
                                  recruit_s.params_dict['gamma'],
-                                 recruit_s.nthreads
+                                 recruit_s.nthreads,
+                                 recruit_s.export_tsv,
+                                 s_sidx.index_file(mg_sub_file[1])
                                  )
-    # Collect and join all recruits
+    # Collect and join all recruits, clusters[4] is the ID registry of the cluster tables
     com.run_combine_recruits(save_dirs_dict, recruit_s.mg_file,
                              clusters, trust_files, recruit_s.set,
-                             recruit_s.nthreads
+                             recruit_s.nthreads, tc_map
                              )
 
     return
@@ -8,17 +8,25 @@ from tqdm import tqdm
 
 
 def run_combine_recruits(save_dirs_dict, mg_file, clusters,
-                         trusted_list, mode, threads
+                         trusted_list, mode, threads, tc_map=None
                          ):
     denovo_clust_df = clusters[0]
+    id_reg = clusters[4]
     denovo_sv_path = save_dirs_dict['denovo']
     mode_path = save_dirs_dict[mode]
 
     logging.info('Combining All Recruits\n')
     mg_contigs_dict = s_utils.get_seqs(mg_file)
     mg_contigs = tuple([(r[0], r[1]) for r in mg_contigs_dict])
-    mg_contigs_df = pd.DataFrame(mg_contigs, columns=['contig_id', 'seq'])
+    mg_contigs_df = pd.DataFrame(mg_contigs, columns=['contig_name', 'seq'])
+    # cluster tables carry contig codes, names are only used for the FASTA headers
+    mg_contigs_df['contig_id'] = id_reg.contig_codes(mg_contigs_df['contig_name'], add=True)
     trust_dict = {t[0]: t[1] for t in trusted_list}
+    if (tc_map is not None) and trusted_list:
+        # single trusted-contig multi-FASTA, read it once for all SAGs
+        tc_rec_dict = s_utils.group_trusted_records(trusted_list[0][1], tc_map, set(trust_dict.keys()))
+    else:
+        tc_rec_dict = None
     
     # De Novo Bins
     denovo_set = list(set(denovo_clust_df['best_label']))
@@ -33,7 +41,7 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
             contig_list = list(set(sub_merge_df['contig_id']))
             mg_sub_filter_df = mg_contigs_df.query('contig_id in @contig_list')
             final_mgsubs_list = ['\n'.join(['>' + x[0], x[1]]) for x in
-                                 zip(mg_sub_filter_df['contig_id'],
+                                 zip(mg_sub_filter_df['contig_name'],
                                      mg_sub_filter_df['seq']
                                      )
                                  ]
@@ -67,7 +75,7 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
                 contig_list = list(set(sub_merge_df['contig_id']))
                 mg_sub_filter_df = mg_contigs_df.query('contig_id in @contig_list')
                 final_mgsubs_list = ['\n'.join(['>' + x[0], x[1]]) for x in
-                                     zip(mg_sub_filter_df['contig_id'],
+                                     zip(mg_sub_filter_df['contig_name'],
                                          mg_sub_filter_df['seq']
                                          )
                                      ]
@@ -76,12 +84,9 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
         print(len(hdbscan_set))
         logging.info('Running BBtools dedup on HDBSCAN bins\n')
         for t_id in tqdm(hdbscan_set):
-            t_file = trust_dict[t_id]
             concat_file = o_join(xpg_sv_path, t_id + '.hdbscan.concat.fasta')
             with open(concat_file, 'w') as cat_out:
-                data = []
-                with open(t_file, 'r') as t_in:
-                    data.extend(t_in.readlines())
+                data = trusted_lines(t_id, trust_dict, tc_rec_dict)
                 hdbscan_bin = o_join(hdbscan_sv_path, t_id + '.hdbscan.fasta')
                 with open(hdbscan_bin, 'r') as r_file:
                     data.extend(r_file.readlines())
@@ -106,7 +111,7 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
                 contig_list = list(set(sub_merge_df['contig_id']))
                 mg_sub_filter_df = mg_contigs_df.query('contig_id in @contig_list')
                 final_mgsubs_list = ['\n'.join(['>' + x[0], x[1]]) for x in
-                                     zip(mg_sub_filter_df['contig_id'],
+                                     zip(mg_sub_filter_df['contig_name'],
                                          mg_sub_filter_df['seq']
                                          )
                                      ]
@@ -114,12 +119,9 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
         # Combine final recruits and reference trusted contigs
         logging.info('Running BBtools dedup on OC-SVM bins\n')
         for t_id in tqdm(ocsvm_set):
-            t_file = trust_dict[t_id]
             concat_file = o_join(xpg_sv_path, t_id + '.ocsvm.concat.fasta')
             with open(concat_file, 'w') as cat_out:
-                data = []
-                with open(t_file, 'r') as t_in:
-                    data.extend(t_in.readlines())
+                data = trusted_lines(t_id, trust_dict, tc_rec_dict)
                 ocsvm_bin = o_join(ocsvm_sv_path, t_id + '.ocsvm.fasta')
                 with open(ocsvm_bin, 'r') as r_file:
                     data.extend(r_file.readlines())
@@ -144,7 +146,7 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
                     contig_list = list(set(sub_merge_df['contig_id']))
                     mg_sub_filter_df = mg_contigs_df.query('contig_id in @contig_list')
                     final_mgsubs_list = ['\n'.join(['>' + x[0], x[1]]) for x in
-                                         zip(mg_sub_filter_df['contig_id'],
+                                         zip(mg_sub_filter_df['contig_name'],
                                              mg_sub_filter_df['seq']
                                              )
                                          ]
@@ -152,12 +154,9 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
             # Combine final recruits and reference trusted contigs
             logging.info('Running BBtools dedup on intersection bins\n')
             for t_id in tqdm(inter_set):
-                t_file = trust_dict[t_id]
                 concat_file = o_join(xpg_sv_path, t_id + '.intersect.concat.fasta')
                 with open(concat_file, 'w') as cat_out:
-                    data = []
-                    with open(t_file, 'r') as t_in:
-                        data.extend(t_in.readlines())
+                    data = trusted_lines(t_id, trust_dict, tc_rec_dict)
                     recruit_bin = o_join(inter_sv_path, t_id + '.intersect.fasta')
                     with open(recruit_bin, 'r') as r_file:
                         data.extend(r_file.readlines())
@@ -177,3 +176,12 @@ def run_combine_recruits(save_dirs_dict, mg_file, clusters,
     #s_utils.runCleaner(mode_path, "ocsvm")
     #s_utils.runCleaner(mode_path, "intersect")
     s_utils.runCleaner(xpg_sv_path, "*.concat.fasta")
+
+
+def trusted_lines(t_id, trust_dict, tc_rec_dict=None):
+    # FASTA lines of the trusted contigs of t_id, from its own file or the grouped multi-FASTA records
+    if tc_rec_dict is not None:
+        tc_recs = tc_rec_dict.get(t_id, [])
+    else:
+        tc_recs = s_utils.get_seqs(trust_dict[t_id])
+    return ['>' + rec[0] + '\n' + str(rec[1]) + '\n' for rec in tc_recs]
@@ -0,0 +1,387 @@
+__author__ = 'Ryan J McLaughlin'
+
+import multiprocessing
+from functools import lru_cache, partial
+from itertools import product
+from multiprocessing import shared_memory
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+import saber.kmer_kernels as s_kern
+
+# 2-bit codes follow the 'atgc' order that tetra_cnt has always used with
+# itertools.product, so the integer index of a k-mer is also its position in
+# product('atgc', repeat=k)
+BASE_ORDER = 'atgc'
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+for i, nt in enumerate(BASE_ORDER):
+    NT_CODES[ord(nt)] = i
+    NT_CODES[ord(nt.upper())] = i
+KMER_SIZES = (3, 4, 5, 6)
+KMER_MODES = ('forward', 'reverse', 'revcomp')
+# contig bases held at once while subcontig windows are counted
+WINDOW_CHUNK_BASES = 1 << 26
+
+
+def encode_seq(seq):
+    """Encode a sequence as a uint8 array of 2-bit base codes, ambiguous bases are coded as 4.
+
+    :param seq: nucleotide sequence as a str
+    :return: numpy uint8 array the same length as seq"""
+    seq_bytes = np.frombuffer(str(seq).encode('ascii', 'replace'), dtype=np.uint8)
+
+    return NT_CODES[seq_bytes]
+
+
+@lru_cache(maxsize=None)
+def kmer_lut(k, mode):
+    """Column lookup table for every k-mer index, built once per (k, mode).
+
+    forward keeps all 4^k k-mers, reverse merges each k-mer with its reverse
+    (not complement, the original SABer tetramer features) and revcomp merges
+    it with its reverse complement. A merged pair is keyed on whichever k-mer
+    comes first in product order, same as the dedup_dict of the old tetra_cnt.
+    :param k: k-mer size
+    :param mode: one of KMER_MODES
+    :return: int64 array mapping k-mer index to column, and the k-mer string of each column"""
+    kmer_arr = np.arange(4 ** k)
+    if mode == 'forward':
+        canon_arr = kmer_arr
+    elif mode == 'reverse':
+        canon_arr = np.minimum(kmer_arr, s_kern.reverse_kmers(kmer_arr, k))
+    elif mode == 'revcomp':
+        canon_arr = np.minimum(kmer_arr, s_kern.revcomp_kmers(kmer_arr, k))
+    else:
+        raise Exception("**ERROR** k-mer mode must be one of " + ', '.join(KMER_MODES))
+    canon_cols = np.unique(canon_arr)
+    lut = np.searchsorted(canon_cols, canon_arr).astype(np.int64)
+    lut.setflags(write=False)
+    kmer_list = [''.join(x) for x in product(BASE_ORDER, repeat=k)]
+    col_names = tuple(kmer_list[i] for i in canon_cols)
+
+    return lut, col_names
+
+
+class CompositionProfile:
+    """
+    k-mer size and canonical collapsing used for the composition features.
+    The default (4, 'reverse') is the 136 tetramer feature set SABer has always used.
+    """
+
+    def __init__(self, k=4, mode='reverse') -> None:
+        if int(k) not in KMER_SIZES:
+            raise Exception("**ERROR** k-mer size must be one of " + ', '.join([str(x) for x in KMER_SIZES]))
+        if mode not in KMER_MODES:
+            raise Exception("**ERROR** k-mer mode must be one of " + ', '.join(KMER_MODES))
+        self.k = int(k)
+        self.mode = mode
+        self.lut, self.columns = kmer_lut(self.k, self.mode)
+        self.n_cols = len(self.columns)
+        return
+
+    @property
+    def name(self) -> str:
+        # keep the historical file names for the default tetramer profile
+        if (self.k, self.mode) == (4, 'reverse'):
+            return 'tetras'
+        return 'k' + str(self.k) + '_' + self.mode
+
+    def count(self, seq):
+        return s_kern.count_kmers(encode_seq(seq), self.k, self.lut, self.n_cols)
+
+    def count_windows(self, seq, bounds):
+        return s_kern.count_window_kmers(encode_seq(seq), bounds, self.k, self.lut, self.n_cols)
+
+
+TETRA_PROFILE = CompositionProfile(4, 'reverse')
+
+
+def count_kmer_records(records, profile=TETRA_PROFILE, n_recs=None):
+    """Count k-mers for a set of records into an (n_records x profile.n_cols) matrix.
+
+    :param records: iterable of (header, seq) records, e.g. a pyfastx.Fasta
+    :param profile: CompositionProfile to count with
+    :param n_recs: number of records if known, otherwise the matrix is grown as needed
+    :return: list of headers, list of sequence lengths and the uint32 count matrix"""
+    kmer_mtx = np.zeros((n_recs if n_recs else 4096, profile.n_cols), dtype=np.uint32)
+    header_list = []
+    len_list = []
+    for i, rec in enumerate(records):
+        if i == kmer_mtx.shape[0]:
+            kmer_mtx = np.concatenate([kmer_mtx, np.zeros_like(kmer_mtx)])
+        header, seq = rec[0], rec[1]
+        header_list.append(header)
+        len_list.append(len(seq))
+        kmer_mtx[i] = profile.count(seq)
+
+    return header_list, len_list, kmer_mtx[:len(header_list)]
+
+
+def balanced_chunks(len_list, n_chunks):
+    """Split records into contiguous chunks holding roughly the same number of bases.
+
+    :param len_list: sequence lengths in record order
+    :param n_chunks: number of chunks wanted
+    :return: list of (start, end) record ranges"""
+    cum_len = np.cumsum(len_list)
+    if len(cum_len) == 0:
+        return []
+    cut_points = np.linspace(0, cum_len[-1], n_chunks + 1)[1:-1]
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(cum_len, cut_points, side='right'),
+                                       [len(cum_len)]]
+                                      ))
+    chunk_list = [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+    return chunk_list
+
+
+def init_kmer_worker(shm_name, shape, k, mode):
+    global kmer_shm, shared_kmer_mtx, worker_profile
+    kmer_shm = shared_memory.SharedMemory(name=shm_name)
+    shared_kmer_mtx = np.ndarray(shape, dtype=np.uint32, buffer=kmer_shm.buf)
+    worker_profile = CompositionProfile(k, mode)
+
+
+def count_kmer_chunk(p):
+    row_start, seq_list = p
+    for i, seq in enumerate(seq_list, start=row_start):
+        shared_kmer_mtx[i] = worker_profile.count(seq)
+    return len(seq_list)
+
+
+def run_shared_pool(shape, chunk_func, arg_list, profile, nthreads):
+    """Run chunk_func over arg_list with workers that all fill one shared-memory matrix.
+
+    :return: a private copy of the filled (shape) uint32 matrix"""
+    kmer_shm = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 4)
+    try:
+        pool = multiprocessing.Pool(processes=nthreads, initializer=init_kmer_worker,
+                                    initargs=(kmer_shm.name, shape, profile.k, profile.mode)
+                                    )
+        for n_done in pool.imap_unordered(chunk_func, arg_list):
+            pass
+        pool.close()
+        pool.join()
+        kmer_mtx = np.ndarray(shape, dtype=np.uint32, buffer=kmer_shm.buf).copy()
+    finally:
+        kmer_shm.close()
+        kmer_shm.unlink()
+
+    return kmer_mtx
+
+
+def count_kmer_records_mp(records, nthreads, profile=TETRA_PROFILE):
+    """Multi-process version of count_kmer_records.
+
+    Records are split into size-balanced chunks and each worker writes its rows
+    straight into a shared-memory count matrix, so nothing but the sequences is
+    pickled between processes.
+    :param records: iterable of (header, seq) records, e.g. a pyfastx.Fasta
+    :param nthreads: number of worker processes
+    :param profile: CompositionProfile to count with
+    :return: list of headers, list of sequence lengths and the uint32 count matrix"""
+    header_list = []
+    seq_list = []
+    for rec in records:
+        header_list.append(rec[0])
+        seq_list.append(str(rec[1]))
+    len_list = [len(seq) for seq in seq_list]
+    shape = (len(header_list), profile.n_cols)
+    if shape[0] == 0:
+        return header_list, len_list, np.zeros(shape, dtype=np.uint32)
+    # oversplit so that a slow chunk doesn't hold up the whole pool
+    chunk_list = balanced_chunks(len_list, nthreads * 4)
+    arg_list = ((s, seq_list[s:e]) for s, e in chunk_list)
+    kmer_mtx = run_shared_pool(shape, count_kmer_chunk, arg_list, profile, nthreads)
+
+    return header_list, len_list, kmer_mtx
+
+
+def window_chunks(records, window_func, chunk_bases=WINDOW_CHUNK_BASES):
+    """Expand contig records into their subcontig headers, lengths and window bounds,
+    a chunk of about chunk_bases contig bases at a time so the assembly is never held whole.
+
+    :param records: iterable of (header, seq) contig records
+    :param window_func: callable returning the (n x 2) window bounds for a contig length
+    :param chunk_bases: contig bases per chunk, a longer contig is a chunk of its own
+    :return: generator of (subcontig headers, subcontig lengths, list of (seq, bounds) for
+    each contig of the chunk that has at least one window)"""
+    header_list = []
+    len_list = []
+    contig_list = []
+    chunk_len = 0
+    for rec in records:
+        header, seq = rec[0], str(rec[1])
+        bounds = window_func(len(seq))
+        if len(bounds) != 0:
+            header_list.extend([header + '_' + str(i) for i in range(len(bounds))])
+            len_list.extend((bounds[:, 1] - bounds[:, 0]).tolist())
+            contig_list.append((seq, bounds))
+            chunk_len += len(seq)
+        if chunk_len >= chunk_bases:
+            yield header_list, len_list, contig_list
+            header_list = []
+            len_list = []
+            contig_list = []
+            chunk_len = 0
+    if contig_list:
+        yield header_list, len_list, contig_list
+
+
+def count_window_chunks(records, window_func, count_func):
+    # count_func(contig_list, n_rows) counts one window_chunks chunk, the chunks are stacked
+    header_list = []
+    len_list = []
+    mtx_list = []
+    for chunk_headers, chunk_lens, contig_list in window_chunks(records, window_func):
+        header_list.extend(chunk_headers)
+        len_list.extend(chunk_lens)
+        mtx_list.append(count_func(contig_list, len(chunk_headers)))
+
+    return header_list, len_list, mtx_list
+
+
+def count_window_records(records, window_func, profile=TETRA_PROFILE):
+    """Count k-mers for every subcontig window of a set of contigs.
+
+    Gives the same rows as count_kmer_records on the subcontigs written by
+    build_subcontigs, but each contig position is only counted once and each
+    window is a prefix-sum difference (see kmer_kernels.count_window_kmers).
+    :param records: iterable of (header, seq) contig records
+    :param window_func: callable returning the (n x 2) window bounds for a contig length
+    :param profile: CompositionProfile to count with
+    :return: list of subcontig headers, list of subcontig lengths and the uint32 count matrix"""
+    header_list, len_list, mtx_list = count_window_chunks(records, window_func,
+                                                          partial(count_window_list, profile=profile)
+                                                          )
+    kmer_mtx = np.concatenate(mtx_list) if mtx_list else np.zeros((0, profile.n_cols), dtype=np.uint32)
+
+    return header_list, len_list, kmer_mtx
+
+
+def count_window_list(contig_list, n_rows, profile=TETRA_PROFILE):
+    """Count k-mers for a list of (seq, bounds) pairs as in a window_chunks chunk.
+
+    :return: (n_rows x profile.n_cols) uint32 count matrix, rows in window order"""
+    kmer_mtx = np.zeros((n_rows, profile.n_cols), dtype=np.uint32)
+    row_start = 0
+    for seq, bounds in contig_list:
+        kmer_mtx[row_start:row_start + len(bounds)] = profile.count_windows(seq, bounds)
+        row_start += len(bounds)
+
+    return kmer_mtx
+
+
+def count_window_chunk(p):
+    row_start, contig_list = p
+    for seq, bounds in contig_list:
+        shared_kmer_mtx[row_start:row_start + len(bounds)] = worker_profile.count_windows(seq, bounds)
+        row_start += len(bounds)
+    return len(contig_list)
+
+
+def count_window_records_mp(records, window_func, nthreads, profile=TETRA_PROFILE):
+    """Multi-process version of count_window_records, see count_kmer_records_mp.
+
+    :param records: iterable of (header, seq) contig records
+    :param window_func: callable returning the (n x 2) window bounds for a contig length
+    :param nthreads: number of worker processes
+    :param profile: CompositionProfile to count with
+    :return: list of subcontig headers, list of subcontig lengths and the uint32 count matrix"""
+    header_list, len_list, mtx_list = count_window_chunks(records, window_func,
+                                                          partial(count_window_list_mp, nthreads=nthreads,
+                                                                  profile=profile)
+                                                          )
+    kmer_mtx = np.concatenate(mtx_list) if mtx_list else np.zeros((0, profile.n_cols), dtype=np.uint32)
+
+    return header_list, len_list, kmer_mtx
+
+
+def count_window_list_mp(contig_list, n_rows, nthreads, profile=TETRA_PROFILE):
+    """Multi-process version of count_window_list.
+
+    :return: (n_rows x profile.n_cols) uint32 count matrix, rows in window order"""
+    shape = (n_rows, profile.n_cols)
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=np.uint32)
+    row_offsets = np.cumsum([0] + [len(x[1]) for x in contig_list])
+    chunk_list = balanced_chunks([len(x[0]) for x in contig_list], nthreads * 4)
+    arg_list = ((int(row_offsets[s]), contig_list[s:e]) for s, e in chunk_list)
+    kmer_mtx = run_shared_pool(shape, count_window_chunk, arg_list, profile, nthreads)
+
+    return kmer_mtx
+
+
+def log_proportions(kmer_mtx, len_arr, keep_cols, out):
+    """Pseudo-count, proportion and length scaling followed by the log step of CLR, into out.
+
+    log(((c + 1) / row_sum) / length) for each k-mer count c, computed as
+    log(c + 1) - log(row_sum * length) so the only float matrix is out.
+    """
+    np.add(kmer_mtx[:, keep_cols], 1, out=out, dtype=np.float32)
+    row_norm = out.sum(axis=1, dtype=np.float64) * len_arr
+    np.log(out, out=out)
+    out -= np.log(row_norm).astype(np.float32)[:, None]
+
+    return out
+
+
+def normalize_kmers(kmer_mtx, len_list, scaler=None, chunk_size=65536, keep_cols=None, fit=True):
+    """Pseudo-count, proportion, length, CLR and standardization of a k-mer count matrix.
+
+    Matches the DataFrame steps tetra_cnt used to run (drop all-zero columns,
+    +1, proportion, divide by subcontig length, column-wise clr, StandardScaler)
+    but writes everything into a single float32 matrix. The centering done by
+    a column-wise clr is undone by the scaler anyway, so only its log is applied.
+    Rows are handled chunk_size at a time and the scaler is fit with partial_fit,
+    so kmer_mtx can be a memory-mapped array larger than RAM in float32.
+    Passing the keep_cols and scaler of another matrix with fit=False puts
+    kmer_mtx in the same feature space, e.g. SAG subcontigs in metagenome space.
+    :param kmer_mtx: (n x n_cols) k-mer count matrix
+    :param len_list: sequence length of each row
+    :param scaler: scaler with partial_fit/transform, a fresh StandardScaler by default
+    :param chunk_size: number of rows to normalize at once
+    :param keep_cols: columns to keep, by default every column with a non-zero count
+    :param fit: fit scaler to kmer_mtx, otherwise scaler must already be fitted
+    :return: (n x n_kept_cols) float32 matrix, the kept columns and the fitted scaler"""
+    if scaler is None:
+        scaler = StandardScaler(copy=False)
+    len_arr = np.asarray(len_list, dtype=np.float64)
+    if keep_cols is None:
+        keep_cols = np.zeros(kmer_mtx.shape[1], dtype=bool)
+        for s in range(0, kmer_mtx.shape[0], chunk_size):
+            keep_cols |= kmer_mtx[s:s + chunk_size].any(axis=0)
+        keep_cols = np.flatnonzero(keep_cols)
+    norm_mtx = np.empty((kmer_mtx.shape[0], len(keep_cols)), dtype=np.float32)
+    for s in range(0, kmer_mtx.shape[0], chunk_size):
+        e = min(s + chunk_size, kmer_mtx.shape[0])
+        log_proportions(kmer_mtx[s:e], len_arr[s:e], keep_cols, norm_mtx[s:e])
+        if fit:
+            scaler.partial_fit(norm_mtx[s:e])
+    for s in range(0, kmer_mtx.shape[0], chunk_size):
+        norm_mtx[s:s + chunk_size] = scaler.transform(norm_mtx[s:s + chunk_size])
+
+    return norm_mtx, keep_cols, scaler
+
+
+def norm_to_meta(keep_cols, scaler):
+    """JSON-friendly record of a normalization, to store with a feature table."""
+    return {'keep_cols': [int(x) for x in keep_cols],
+            'scale_mean': [float(x) for x in scaler.mean_],
+            'scale_var': [float(x) for x in scaler.var_],
+            'scale_n': int(scaler.n_samples_seen_)
+            }
+
+
+def norm_from_meta(meta_dict):
+    """Rebuild the keep_cols and fitted StandardScaler saved with norm_to_meta."""
+    keep_cols = np.array(meta_dict['keep_cols'], dtype=np.int64)
+    scaler = StandardScaler(copy=False)
+    scaler.mean_ = np.array(meta_dict['scale_mean'], dtype=np.float64)
+    scaler.var_ = np.array(meta_dict['scale_var'], dtype=np.float64)
+    scaler.scale_ = np.where(scaler.var_ > 0, np.sqrt(scaler.var_), 1.0)
+    scaler.n_samples_seen_ = meta_dict['scale_n']
+    scaler.n_features_in_ = len(keep_cols)
+
+    return keep_cols, scaler
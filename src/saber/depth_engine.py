@@ -0,0 +1,491 @@
+__author__ = 'Ryan J McLaughlin'
+
+import logging
+import os
+import re
+from itertools import chain
+from subprocess import Popen, PIPE
+
+import numpy as np
+
+# Read filters and depth rules of MetaBAT's jgi_summarize_bam_contig_depths defaults
+MIN_PCT_ID = 0.97  # --percentIdentity 97, end-to-end identity of the read
+MAX_EDGE_BASES = 75  # --maxEdgeBases 75, contig ends left out of depth and variance
+MIN_MAP_QUAL = 0  # --minMapQual 0
+# unmapped, secondary, QC fail and duplicate records never count
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+CIGAR_RE = re.compile(r'(\d+)([MIDNSHP=X])')
+# bp per bin of the whole-contig depth profiles, a divisor of MAX_EDGE_BASES and the default window step
+PROFILE_BIN = 25
+
+
+class DepthAccumulator:
+    """
+    Per-base read depth of a set of contigs (usually subcontigs), built from streamed alignments.
+
+    Aligned blocks are buffered as global [start, end) coordinates and added as +1/-1
+    to one int32 difference array over all contigs, so records can arrive in any order,
+    e.g. straight from minimap2. depths() turns it into the mean depth and variance of
+    every contig, leaving out the edges like jgi_summarize_bam_contig_depths does.
+    """
+
+    def __init__(self, contig_names, contig_lens, min_pct_id=MIN_PCT_ID, max_edge=MAX_EDGE_BASES,
+                 min_mapq=MIN_MAP_QUAL, buf_size=1 << 20
+                 ) -> None:
+        self.contig_names = list(contig_names)
+        self.contig_lens = np.asarray(contig_lens, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.contig_lens)])
+        self.contig_dict = {x: i for i, x in enumerate(self.contig_names)}
+        self.min_pct_id = min_pct_id
+        self.max_edge = max_edge
+        self.min_mapq = min_mapq
+        self.buf_size = buf_size
+        self.init_store()
+        self.starts = []
+        self.ends = []
+        self.n_reads = 0
+        self.n_pass = 0
+        return
+
+    def init_store(self):
+        self.diff_arr = np.zeros(self.offsets[-1] + 1, dtype=np.int32)
+
+    def add_blocks(self, contig_i, blocks):
+        """Add aligned [start, end) blocks, 0-based and relative to contig contig_i."""
+        offset = self.offsets[contig_i]
+        for s, e in blocks:
+            self.starts.append(offset + s)
+            self.ends.append(offset + e)
+        if len(self.starts) >= self.buf_size:
+            self.flush()
+
+    def flush(self):
+        np.add.at(self.diff_arr, np.asarray(self.starts, dtype=np.int64), 1)
+        np.add.at(self.diff_arr, np.asarray(self.ends, dtype=np.int64), -1)
+        self.starts = []
+        self.ends = []
+
+    def add_sam(self, sam_lines):
+        """Add SAM records (text lines, header lines are skipped) from a file, pipe or list."""
+        for line in sam_lines:
+            if line[0] == '@':
+                continue
+            fields = line.split('\t', 11)
+            self.n_reads += 1
+            if (int(fields[1]) & SKIP_FLAGS) or (int(fields[4]) < self.min_mapq):
+                continue
+            contig_i = self.contig_dict.get(fields[2])
+            if contig_i is None:
+                continue
+            nm_tag = sam_tag(fields[11], 'NM:i:') if len(fields) > 11 else None
+            blocks = cigar_blocks(int(fields[3]) - 1, fields[5], 0 if nm_tag is None else int(nm_tag),
+                                  self.min_pct_id
+                                  )
+            if blocks:
+                self.n_pass += 1
+                self.add_blocks(contig_i, blocks)
+
+    def add_paf(self, paf_lines):
+        """Add PAF records, e.g. minimap2 -c. With a cg:Z: CIGAR the blocks and NM:i: give the
+        identity like SAM, without one the whole target span counts and identity is matches/block length."""
+        for line in paf_lines:
+            fields = line.rstrip('\n').split('\t')
+            self.n_reads += 1
+            tags = '\t'.join(fields[12:])
+            if (sam_tag(tags, 'tp:A:') in ('S', 'i')) or (int(fields[11]) < self.min_mapq):
+                continue
+            contig_i = self.contig_dict.get(fields[5])
+            if contig_i is None:
+                continue
+            cigar = sam_tag(tags, 'cg:Z:')
+            if cigar is not None:
+                # PAF CIGARs don't include the clipped query ends, count them like soft clips
+                clip_len = int(fields[1]) - (int(fields[3]) - int(fields[2]))
+                nm_tag = sam_tag(tags, 'NM:i:')
+                blocks = cigar_blocks(int(fields[7]), cigar + (str(clip_len) + 'S' if clip_len else ''),
+                                      0 if nm_tag is None else int(nm_tag), self.min_pct_id
+                                      )
+            elif int(fields[9]) >= self.min_pct_id * max(int(fields[10]), int(fields[1])):
+                blocks = [(int(fields[7]), int(fields[8]))]
+            else:
+                blocks = []
+            if blocks:
+                self.n_pass += 1
+                self.add_blocks(contig_i, blocks)
+
+    def depths(self, chunk_bases=1 << 26):
+        """Mean depth and variance of every contig over the positions outside its edges.
+
+        max_edge bases are left out at both ends of contigs longer than 2 * max_edge,
+        shorter contigs are used whole. Variance is the population variance of the per-base depth.
+        :return: float64 depth and variance arrays in contig order"""
+        self.flush()
+        n_contigs = len(self.contig_lens)
+        edge_arr = np.where(self.contig_lens > 2 * self.max_edge, self.max_edge, 0)
+        depth_arr = np.zeros(n_contigs, dtype=np.float64)
+        var_arr = np.zeros(n_contigs, dtype=np.float64)
+        i = 0
+        while i < n_contigs:  # a block of whole contigs at a time keeps the cumsum small
+            j = max(int(np.searchsorted(self.offsets, self.offsets[i] + chunk_bases, side='right')) - 1, i + 1)
+            j = min(j, n_contigs)
+            # +1/-1 pairs never cross a contig, so the running sum restarts at 0 on every contig
+            cov_arr = np.cumsum(self.diff_arr[self.offsets[i]:self.offsets[j]], dtype=np.int64).astype(np.float64)
+            for c in range(i, j):
+                s = self.offsets[c] - self.offsets[i] + edge_arr[c]
+                e = self.offsets[c + 1] - self.offsets[i] - edge_arr[c]
+                if e > s:
+                    depth_arr[c] = cov_arr[s:e].mean()
+                    var_arr[c] = cov_arr[s:e].var()
+            i = j
+
+        return depth_arr, var_arr
+
+    def profile(self, bin_size=PROFILE_BIN, chunk_bases=1 << 26):
+        """Per-base depth of every contig summed in bin_size bins, the last bin of a contig may be shorter.
+
+        :return: float64 arrays with the sum of depth and of squared depth of each bin,
+        bins of contig c start at bin_offsets(contig_lens, bin_size)[c]"""
+        self.flush()
+        n_contigs = len(self.contig_lens)
+        bin_offs = bin_offsets(self.contig_lens, bin_size)
+        bin_starts = bin_positions(self.contig_lens, bin_size)
+        sum_arr = np.zeros(bin_offs[-1], dtype=np.float64)
+        sq_arr = np.zeros(bin_offs[-1], dtype=np.float64)
+        i = 0
+        while i < n_contigs:
+            j = max(int(np.searchsorted(self.offsets, self.offsets[i] + chunk_bases, side='right')) - 1, i + 1)
+            j = min(j, n_contigs)
+            if bin_offs[j] > bin_offs[i]:
+                cov_arr = np.cumsum(self.diff_arr[self.offsets[i]:self.offsets[j]], dtype=np.int64).astype(np.float64)
+                local_starts = bin_starts[bin_offs[i]:bin_offs[j]] - self.offsets[i]
+                sum_arr[bin_offs[i]:bin_offs[j]] = np.add.reduceat(cov_arr, local_starts)
+                sq_arr[bin_offs[i]:bin_offs[j]] = np.add.reduceat(cov_arr * cov_arr, local_starts)
+            i = j
+
+        return sum_arr, sq_arr
+
+    def reset(self):
+        self.diff_arr[:] = 0
+        self.starts = []
+        self.ends = []
+        self.n_reads = 0
+        self.n_pass = 0
+
+
+class ProfileAccumulator(DepthAccumulator):
+    """
+    Binned depth profile of a set of contigs, built from streamed alignments like
+    DepthAccumulator but without a per-base array.
+
+    Every aligned block adds the number of bases it covers to each bin_size bin it
+    overlaps, as a +bin_size/-bin_size difference over whole bins plus the partial
+    bases of its first and last bin. The bin depth sums are exact and take two int32
+    values per bin. Depth is taken as constant within a bin for the squared sums, so
+    variance only sees the changes between bins.
+    """
+
+    def __init__(self, contig_names, contig_lens, bin_size=PROFILE_BIN, **acc_args) -> None:
+        self.bin_size = bin_size
+        super().__init__(contig_names, contig_lens, **acc_args)
+        return
+
+    def init_store(self):
+        self.bin_offs = bin_offsets(self.contig_lens, self.bin_size)
+        # each contig starts on a bin boundary, so a position's bin is position // bin_size
+        self.bin_starts = self.bin_offs[:-1] * self.bin_size
+        self.full_diff = np.zeros(self.bin_offs[-1] + 1, dtype=np.int32)
+        self.part_arr = np.zeros(self.bin_offs[-1] + 1, dtype=np.int32)
+
+    def add_blocks(self, contig_i, blocks):
+        # blocks are clipped to the contig, past its end would be the padding of its last bin
+        offset = self.bin_starts[contig_i]
+        c_len = self.contig_lens[contig_i]
+        for s, e in blocks:
+            if s < c_len:
+                self.starts.append(offset + s)
+                self.ends.append(offset + min(e, c_len))
+        if len(self.starts) >= self.buf_size:
+            self.flush()
+
+    def flush(self):
+        start_arr = np.asarray(self.starts, dtype=np.int64)
+        end_arr = np.asarray(self.ends, dtype=np.int64)
+        np.add.at(self.full_diff, start_arr // self.bin_size, self.bin_size)
+        np.add.at(self.full_diff, end_arr // self.bin_size, -self.bin_size)
+        np.add.at(self.part_arr, start_arr // self.bin_size, -(start_arr % self.bin_size))
+        np.add.at(self.part_arr, end_arr // self.bin_size, end_arr % self.bin_size)
+        self.starts = []
+        self.ends = []
+
+    def profile(self):
+        """Depth summed in bin_size bins, the last bin of a contig may be shorter.
+
+        :return: float64 arrays with the sum of depth and of squared depth of each bin,
+        bins of contig c start at bin_offsets(contig_lens, bin_size)[c]"""
+        self.flush()
+        n_bins = self.bin_offs[-1]
+        sum_arr = (np.cumsum(self.full_diff[:n_bins], dtype=np.int64) + self.part_arr[:n_bins]).astype(np.float64)
+        bin_lens = np.full(n_bins, self.bin_size, dtype=np.float64)
+        has_bins = self.bin_offs[1:] > self.bin_offs[:-1]
+        bin_lens[self.bin_offs[1:][has_bins] - 1] = self.contig_lens[has_bins] - \
+                                                    (np.diff(self.bin_offs)[has_bins] - 1) * self.bin_size
+        sq_arr = sum_arr * sum_arr / bin_lens
+
+        return sum_arr, sq_arr
+
+    def depths(self):
+        """Mean depth and variance of every contig from its profile, same edge rule as DepthAccumulator.depths."""
+        sum_arr, sq_arr = self.profile()
+        n_contigs = len(self.contig_lens)
+        return project_profile(sum_arr, sq_arr, self.contig_lens, np.arange(n_contigs),
+                               np.zeros(n_contigs, dtype=np.int64), self.contig_lens, self.bin_size, self.max_edge
+                               )
+
+    def reset(self):
+        self.full_diff[:] = 0
+        self.part_arr[:] = 0
+        self.starts = []
+        self.ends = []
+        self.n_reads = 0
+        self.n_pass = 0
+
+
+def bin_offsets(contig_lens, bin_size=PROFILE_BIN):
+    # index of the first profile bin of each contig, plus the total number of bins at the end
+    n_bins = -(-np.asarray(contig_lens, dtype=np.int64) // bin_size)
+    return np.concatenate([[0], np.cumsum(n_bins)])
+
+
+def bin_positions(contig_lens, bin_size=PROFILE_BIN):
+    # start of every profile bin in concatenated contig coordinates
+    contig_lens = np.asarray(contig_lens, dtype=np.int64)
+    bin_offs = bin_offsets(contig_lens, bin_size)
+    n_bins = np.diff(bin_offs)
+    contig_offs = np.concatenate([[0], np.cumsum(contig_lens)])[:-1]
+    bin_num = np.arange(bin_offs[-1]) - np.repeat(bin_offs[:-1], n_bins)
+    return np.repeat(contig_offs, n_bins) + bin_num * bin_size
+
+
+def project_profile(sum_arr, sq_arr, contig_lens, contig_idx, starts, ends, bin_size=PROFILE_BIN,
+                    max_edge=MAX_EDGE_BASES
+                    ):
+    """Mean depth and variance of windows [starts, ends) of contigs contig_idx from binned contig profiles.
+
+    Windows get the same edge rule as DepthAccumulator.depths. Bounds that fall inside a bin
+    take the fraction of the bin they cover, so windows on bin boundaries are exact and
+    any windowing of the contigs is computed without realigning.
+    :return: float64 depth and variance arrays, one value per window"""
+    contig_lens = np.asarray(contig_lens, dtype=np.int64)
+    contig_idx = np.asarray(contig_idx, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    bin_offs = bin_offsets(contig_lens, bin_size)
+    edge = np.where(ends - starts > 2 * max_edge, max_edge, 0)
+    win_s, win_e = starts + edge, ends - edge
+    win_len = np.maximum(win_e - win_s, 1)
+    out_list = []
+    for bin_arr in (sum_arr, sq_arr):
+        cum_arr = np.concatenate([[0], np.cumsum(bin_arr)])
+        pos_sums = []
+        for pos in (win_s, win_e):
+            # profile sum over [0, pos) of the window's contig
+            bin_num = pos // bin_size
+            bin_len = np.minimum(bin_size, contig_lens[contig_idx] - bin_num * bin_size)
+            g = bin_offs[contig_idx] + bin_num
+            part = pos - bin_num * bin_size
+            part_sum = np.where(part > 0, bin_arr[np.minimum(g, len(bin_arr) - 1)] * part / np.maximum(bin_len, 1), 0)
+            pos_sums.append(cum_arr[g] - cum_arr[bin_offs[contig_idx]] + part_sum)
+        out_list.append((pos_sums[1] - pos_sums[0]) / win_len)
+    depth_arr = out_list[0]
+    var_arr = np.maximum(out_list[1] - depth_arr * depth_arr, 0)
+
+    return depth_arr, var_arr
+
+
+def save_profile(profile_file, contig_names, contig_lens, sum_arr, sq_arr, bin_size=PROFILE_BIN):
+    with open(profile_file + '.tmp', 'wb') as prof_out:
+        np.savez_compressed(prof_out, contig_names=np.asarray(contig_names, dtype=str),
+                            contig_lens=np.asarray(contig_lens, dtype=np.int64),
+                            sum_arr=sum_arr, sq_arr=sq_arr, bin_size=np.array(bin_size)
+                            )
+    os.replace(profile_file + '.tmp', profile_file)
+
+    return profile_file
+
+
+def load_profile(profile_file):
+    """:return: contig names, contig lengths, bin depth sums, bin squared depth sums and bin size"""
+    with np.load(profile_file) as prof_npz:
+        return (prof_npz['contig_names'], prof_npz['contig_lens'], prof_npz['sum_arr'],
+                prof_npz['sq_arr'], int(prof_npz['bin_size'])
+                )
+
+
+def save_depth_column(col_file, contig_names, contig_lens, depth_arr, var_arr, col_name):
+    """Save one sample's depth and variance columns with their column statistics.
+
+    The float64 mean and population variance of both columns are what StandardScaler
+    fits, so a coverage matrix of any set of columns is scaled without refitting.
+    :return: col_file"""
+    depth_arr = np.asarray(depth_arr, dtype=np.float32)
+    var_arr = np.asarray(var_arr, dtype=np.float32)
+    col_stats = np.array([[x.mean(dtype=np.float64), x.var(dtype=np.float64)] for x in (depth_arr, var_arr)])
+    with open(col_file + '.tmp', 'wb') as col_out:
+        np.savez_compressed(col_out, contig_names=np.asarray(contig_names, dtype=str),
+                            contig_lens=np.asarray(contig_lens, dtype=np.int64),
+                            depth_arr=depth_arr, var_arr=var_arr, col_stats=col_stats,
+                            col_name=np.array(col_name)
+                            )
+    os.replace(col_file + '.tmp', col_file)
+
+    return col_file
+
+
+def load_depth_column(col_file):
+    """:return: contig names, contig lengths, depth, variance, column name and the
+    (mean, variance) of the depth and variance columns as a 2 x 2 array"""
+    with np.load(col_file) as col_npz:
+        return (col_npz['contig_names'], col_npz['contig_lens'], col_npz['depth_arr'], col_npz['var_arr'],
+                str(col_npz['col_name']), col_npz['col_stats']
+                )
+
+
+def sam_tag(tag_str, tag):
+    # value of one optional field, e.g. sam_tag('NM:i:3\tMD:Z:..', 'NM:i:') -> '3'
+    t_start = tag_str.find(tag)
+    if t_start == -1:
+        return None
+    t_end = tag_str.find('\t', t_start)
+    return tag_str[t_start + len(tag):t_end if t_end != -1 else len(tag_str)].rstrip('\n')
+
+
+def cigar_blocks(ref_start, cigar, nm, min_pct_id):
+    """Reference blocks covered by aligned (M/=/X) bases of one alignment, or [] if it fails min_pct_id.
+
+    Identity is end-to-end: (aligned bases - mismatches) / (aligned + inserted + deleted
+    + soft-clipped bases), mismatches being NM minus the indel bases."""
+    if cigar[:-1].isdigit() and (cigar[-1] in 'M=X'):  # most short reads, one block
+        aln_len = int(cigar[:-1])
+        if (aln_len - nm) < min_pct_id * aln_len:
+            return []
+        return [(ref_start, ref_start + aln_len)]
+    blocks = []
+    match_len = indel_len = clip_len = 0
+    ref_pos = ref_start
+    for op_len, op in CIGAR_RE.findall(cigar):
+        op_len = int(op_len)
+        if op in 'M=X':
+            blocks.append((ref_pos, ref_pos + op_len))
+            match_len += op_len
+            ref_pos += op_len
+        elif op in 'DN':
+            if op == 'D':
+                indel_len += op_len
+            ref_pos += op_len
+        elif op == 'I':
+            indel_len += op_len
+        elif op == 'S':
+            clip_len += op_len
+    tot_len = match_len + indel_len + clip_len
+    if (tot_len == 0) or (match_len - (nm - indel_len) < min_pct_id * tot_len):
+        return []
+
+    return blocks
+
+
+def bam_contigs(bam_file):
+    """Contig names and lengths from the @SQ lines of a SAM/BAM header."""
+    view_cmd = ['samtools', 'view', '-H', bam_file]
+    run_view = Popen(view_cmd, stdout=PIPE, stderr=PIPE, text=True)
+    head_out, head_err = run_view.communicate()
+    if run_view.returncode != 0:
+        raise Exception("**ERROR** samtools could not read the header of " + bam_file + ": " + head_err)
+    contig_list = []
+    for line in head_out.splitlines():
+        if line.startswith('@SQ'):
+            tags = dict(x.split(':', 1) for x in line.split('\t')[1:])
+            contig_list.append((tags['SN'], int(tags['LN'])))
+
+    return [x[0] for x in contig_list], [x[1] for x in contig_list]
+
+
+def bam_depths(bam_file, acc, nthreads=1):
+    """Fill acc with the records of a BAM, decoded by samtools view (which also drops the SKIP_FLAGS records).
+
+    :return: acc.depths() of the BAM"""
+    acc.reset()
+    view_cmd = ['samtools', 'view', '-F', str(SKIP_FLAGS), '-@', str(max(nthreads - 1, 0)), bam_file]
+    with open(os.path.splitext(bam_file)[0] + '.depth.stderr.txt', 'w') as stderr_file:
+        run_view = Popen(view_cmd, stdout=PIPE, stderr=stderr_file, text=True, bufsize=1 << 20)
+        acc.add_sam(run_view.stdout)
+        run_view.stdout.close()
+        run_view.wait()
+    if run_view.returncode != 0:
+        raise Exception("**ERROR** samtools view failed on " + bam_file)
+    logging.info('%s of %s alignments in %s passed the depth filters\n' % (acc.n_pass, acc.n_reads, bam_file))
+
+    return acc.depths()
+
+
+def sam_header_contigs(sam_lines):
+    """Read the @SQ lines off the front of a SAM stream, e.g. minimap2 -a stdout.
+
+    :return: contig names, contig lengths and an iterator over the rest of the stream"""
+    sam_iter = iter(sam_lines)
+    contig_list = []
+    for line in sam_iter:
+        if line[0] != '@':
+            return [x[0] for x in contig_list], [x[1] for x in contig_list], chain([line], sam_iter)
+        if line.startswith('@SQ'):
+            tags = dict(x.split(':', 1) for x in line.rstrip('\n').split('\t')[1:])
+            contig_list.append((tags['SN'], int(tags['LN'])))
+
+    return [x[0] for x in contig_list], [x[1] for x in contig_list], iter(())
+
+
+def stream_depths(sam_lines, min_pct_id=MIN_PCT_ID, max_edge=MAX_EDGE_BASES):
+    """Depth and variance of every contig of a SAM stream, without a BAM or samtools.
+
+    The contigs come from the stream's own @SQ header, so aligner output can be read as is.
+    :return: contig names, contig lengths, depth and variance arrays"""
+    contig_names, contig_lens, sam_iter = sam_header_contigs(sam_lines)
+    if not contig_names:
+        raise Exception("**ERROR** SAM stream has no @SQ header lines")
+    acc = DepthAccumulator(contig_names, contig_lens, min_pct_id, max_edge)
+    acc.add_sam(sam_iter)
+    logging.info('%s of %s alignments passed the depth filters\n' % (acc.n_pass, acc.n_reads))
+    depth_arr, var_arr = acc.depths()
+
+    return contig_names, contig_lens, depth_arr, var_arr
+
+
+def calc_depths(bam_list, nthreads=1, min_pct_id=MIN_PCT_ID, max_edge=MAX_EDGE_BASES):
+    """Depth and variance of every contig in every BAM, in jgi_summarize_bam_contig_depths column order.
+
+    All BAMs must be aligned to the same contigs.
+    :return: contig names, contig lengths, (n_contigs x 2 * n_bams) float32 matrix and its columns
+    (<bam>, <bam>-var for each BAM)"""
+    contig_names, contig_lens = bam_contigs(bam_list[0])
+    acc = DepthAccumulator(contig_names, contig_lens, min_pct_id, max_edge)
+    depth_mtx = np.zeros((len(contig_names), 2 * len(bam_list)), dtype=np.float32)
+    col_list = []
+    for i, bam_file in enumerate(bam_list):
+        if bam_contigs(bam_file)[0] != contig_names:
+            raise Exception("**ERROR** " + bam_file + " was not aligned to the same contigs as " + bam_list[0])
+        depth_mtx[:, 2 * i], depth_mtx[:, 2 * i + 1] = bam_depths(bam_file, acc, nthreads)
+        col_list.extend([bam_file, bam_file + '-var'])
+
+    return contig_names, contig_lens, depth_mtx, col_list
+
+
+def write_depth_table(out_file, contig_names, contig_lens, depth_mtx, col_list):
+    """Write depths in the jgi_summarize_bam_contig_depths --outputDepth layout."""
+    tot_depth = depth_mtx[:, 0::2].sum(axis=1, dtype=np.float64)
+    with open(out_file + '.tmp', 'w') as depth_out:
+        depth_out.write('\t'.join(['contigName', 'contigLen', 'totalAvgDepth'] + col_list) + '\n')
+        for name, c_len, t_depth, depth_row in zip(contig_names, contig_lens, tot_depth, depth_mtx):
+            depth_out.write('\t'.join([name, str(c_len), '%.4f' % t_depth] + ['%.4f' % x for x in depth_row])
+                            + '\n')
+    os.replace(out_file + '.tmp', out_file)
+
+    return out_file
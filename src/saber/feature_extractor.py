@@ -0,0 +1,153 @@
+__author__ = 'Ryan J McLaughlin'
+
+import logging
+import multiprocessing
+import os
+from collections import deque
+from functools import partial
+
+import numpy as np
+import sourmash
+
+import saber.composition as s_comp
+import saber.feature_store as s_fs
+import saber.kmer_cache as s_cache
+import saber.kmer_kernels as s_kern
+import saber.minhash_recruiter as s_mhr
+import saber.subcontig_index as s_sidx
+import saber.utilities as s_utils
+
+SEQSTAT_COLS = ['length', 'gc_frac', 'n_frac']
+# subcontig bases queued for the MinHash workers before the reader waits on them
+SKETCH_QUEUE_BASES = 1 << 26
+
+
+def window_stats(codes, bounds):
+    """Length, GC fraction (of the unambiguous bases) and ambiguous-base fraction of each window.
+
+    :return: (n_windows x 3) float64 matrix in SEQSTAT_COLS order"""
+    stat_mtx = np.zeros((len(bounds), 3), dtype=np.float64)
+    for i, (s, e) in enumerate(bounds):
+        gc_cnt, ambig_cnt = s_kern.gc_ambig_count(codes[s:e])
+        win_len = e - s
+        stat_mtx[i] = [win_len, gc_cnt / max(win_len - ambig_cnt, 1), ambig_cnt / max(win_len, 1)]
+
+    return stat_mtx
+
+
+def tee_contigs(records, window_func, o_lap, contig_list, stat_list, sketch_list, sketch_kmer, min_len,
+                sketch_pool=None
+                ):
+    """Pass contig records through unchanged, collecting everything else each one is needed for on the way.
+
+    Each (header, length) is appended to contig_list for the subcontig index,
+    sequence stats to stat_list and, with a sketch_kmer, the MinHash signature of
+    every subcontig (kmer_slide format) of at least min_len bp to sketch_list.
+    Signatures are built by sketch_pool if given, at most SKETCH_QUEUE_BASES of
+    subcontigs wait for it while the records are read on.
+    """
+    sketch_jobs = deque()
+    queue_bases = 0
+    for rec in records:
+        header, seq = rec[0], str(rec[1])
+        bounds = window_func(len(seq))
+        contig_list.append((header, len(seq)))
+        if len(bounds) != 0:
+            stat_list.append(window_stats(s_comp.encode_seq(seq), bounds))
+            if sketch_kmer:
+                sub_seq = seq.upper() if len(seq) >= o_lap else seq
+                arg_list = [[header + '_' + str(i), sub_seq[s:e], sketch_kmer] for i, (s, e) in enumerate(bounds)
+                            if e - s >= min_len
+                            ]
+                if sketch_pool is None:
+                    sketch_list.extend([s_mhr.build_signature(x) for x in arg_list])
+                else:
+                    sketch_jobs.append((sketch_pool.map_async(s_mhr.build_signature, arg_list), len(seq)))
+                    queue_bases += len(seq)
+                    while queue_bases > SKETCH_QUEUE_BASES:
+                        sketch_job, job_bases = sketch_jobs.popleft()
+                        sketch_list.extend(sketch_job.get())
+                        queue_bases -= job_bases
+        yield header, seq
+    while sketch_jobs:
+        sketch_list.extend(sketch_jobs.popleft()[0].get())
+
+
+def extract_features(in_fasta, save_path, max_contig_len, overlap_len, min_len, nthreads=1,
+                     profile=None, cache_path=None, sketch_kmer=None, export_tsv=False
+                     ):
+    """Read a contig FASTA once and build every per-subcontig output SABer needs from it.
+
+    Writes, next to each other in save_path:
+        <samp_id>.subcontigs.idx.npz    subcontig index, the FASTA itself is only written on demand
+        <samp_id>.<profile.name>        normalized composition table (feature store)
+        <samp_id>.seqstats              length, GC and N fraction table (feature store)
+        <samp_id>.<k>.metaG.sig         MinHash signatures, only with sketch_kmer (skipped if it exists)
+    Contigs are read in composition.window_chunks chunks, so only one chunk of the
+    assembly is held at a time.
+    :param in_fasta: contig FASTA
+    :param save_path: output directory
+    :param max_contig_len: max subcontig length
+    :param overlap_len: subcontig overlap
+    :param min_len: minimum contig length
+    :param nthreads: number of processes for k-mer counting
+    :param profile: composition.CompositionProfile, tetramers by default
+    :param cache_path: directory of the k-mer count cache, save_path by default
+    :param sketch_kmer: k-mer size of the MinHash signatures, None to skip them
+    :param export_tsv: also write the feature tables as TSV
+    :return: (samp_id, subcontig file) like build_subcontigs, and the composition table prefix.
+    The subcontig file is not written here, subcontig_index.ensure_subcontig_fasta streams it
+    from the index through utilities.write_subcontigs when a tool needs it"""
+    if profile is None:
+        profile = s_comp.TETRA_PROFILE
+    if cache_path is None:
+        cache_path = save_path
+    samp_id = s_utils.get_samp_id(in_fasta)
+    sub_file = os.path.join(save_path, samp_id + '.subcontigs.fasta')
+    comp_file = os.path.join(save_path, samp_id + '.' + profile.name)
+    stat_file = os.path.join(save_path, samp_id + '.seqstats')
+    sig_file = os.path.join(save_path, samp_id + '.' + str(sketch_kmer) + '.metaG.sig')
+    if sketch_kmer and os.path.isfile(sig_file):
+        sketch_kmer = None  # minhash_recruiter loads the existing signatures
+    logging.info('Extracting subcontigs and features for %s in one pass\n' % samp_id)
+    window_func = partial(s_utils.subcontig_bounds, win_size=int(max_contig_len),
+                          o_lap=int(overlap_len), m_len=int(min_len)
+                          )
+    kmer_cache = s_cache.KmerCache(os.path.join(cache_path, 'kmer_cache.' + profile.name), profile)
+    contig_list = []
+    stat_list = []
+    sketch_list = []
+    # the signatures get their own workers, fed while the k-mers are counted
+    sketch_pool = multiprocessing.Pool(processes=nthreads) if sketch_kmer and (nthreads > 1) else None
+    try:
+        contigs = tee_contigs(s_utils.get_seqs(in_fasta), window_func, int(overlap_len), contig_list,
+                              stat_list, sketch_list, sketch_kmer, int(min_len), sketch_pool
+                              )
+        header_list, len_list, kmer_mtx = s_cache.count_window_records_cached(contigs, window_func,
+                                                                              kmer_cache, nthreads
+                                                                              )
+        if sketch_pool is not None:
+            sketch_pool.close()
+            sketch_pool.join()
+    finally:
+        if sketch_pool is not None:
+            sketch_pool.terminate()
+    kmer_cache.save()
+    sub_idx = s_sidx.SubcontigIndex(in_fasta, [x[0] for x in contig_list], [x[1] for x in contig_list],
+                                    max_contig_len, overlap_len, min_len
+                                    )
+    sub_idx.save(s_sidx.index_file(sub_file))
+
+    comp_df = s_utils.tetra_norm(header_list, len_list, kmer_mtx)
+    norm_meta = s_comp.norm_to_meta(*comp_df.attrs['norm_params'])
+    s_fs.write_features(comp_file, header_list, comp_df.values, index_name='contig_id',
+                        export_tsv=export_tsv, meta=norm_meta
+                        )
+    stat_mtx = np.concatenate(stat_list) if stat_list else np.zeros((0, 3))
+    s_fs.write_features(stat_file, header_list, stat_mtx, columns=SEQSTAT_COLS, export_tsv=export_tsv)
+    if sketch_kmer:
+        with open(sig_file, 'w') as sig_out:
+            sourmash.signature.save_signatures(sketch_list, fp=sig_out)
+
+    return (samp_id, sub_file), comp_file
+
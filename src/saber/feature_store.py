@@ -0,0 +1,110 @@
+__author__ = 'Ryan J McLaughlin'
+
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+# A feature table is stored as three files sharing a prefix:
+#   <prefix>.npy        float32 (n_rows x n_cols) matrix, opened memory-mapped
+#   <prefix>.ids.txt    one row ID per line, in matrix row order
+#   <prefix>.meta.json  index name, column names and extras such as normalization parameters
+# e.g. <mg_id>.tetras.npy replaces the old <mg_id>.tetras.tsv
+FEATURE_EXTS = ('.npy', '.ids.txt', '.meta.json')
+
+
+def feature_files(prefix):
+    return tuple(prefix + x for x in FEATURE_EXTS)
+
+
+def feature_exists(prefix):
+    """True if all files of the feature table at prefix exist and the matrix isn't empty."""
+    npy_file, ids_file, meta_file = feature_files(prefix)
+    if not (os.path.isfile(ids_file) and os.path.isfile(meta_file)):
+        return False
+    try:  # if file exists but is empty
+        return os.path.getsize(npy_file) > 0
+    except OSError:  # if file doesn't exist
+        return False
+
+
+def write_features(prefix, id_list, feat_mtx, columns=None, index_name='subcontig_id',
+                   export_tsv=False, meta=None
+                   ):
+    """Save a feature matrix and its row IDs as a feature table.
+
+    The matrix goes in last so that an interrupted write never looks complete
+    to feature_exists.
+    :param prefix: output path without extension, e.g. <save_path>/<mg_id>.tetras
+    :param id_list: row IDs, usually subcontig IDs
+    :param feat_mtx: (n_rows x n_cols) matrix, stored as float32
+    :param columns: column names, defaults to 0..n_cols-1
+    :param index_name: name of the row ID column in DataFrames and TSV exports
+    :param export_tsv: also write <prefix>.tsv in the old text format
+    :param meta: extra JSON-friendly entries for the meta file, e.g. normalization parameters
+    :return: prefix"""
+    npy_file, ids_file, meta_file = feature_files(prefix)
+    feat_mtx = np.asarray(feat_mtx, dtype=np.float32)
+    id_list = [str(x) for x in id_list]
+    if len(id_list) != feat_mtx.shape[0]:
+        raise Exception("**ERROR** feature matrix has " + str(feat_mtx.shape[0]) + " rows but "
+                        + str(len(id_list)) + " IDs were given")
+    if columns is None:
+        columns = list(range(feat_mtx.shape[1]))
+    with open(ids_file, 'w') as ids_out:
+        ids_out.write('\n'.join(id_list) + '\n' if id_list else '')
+    meta_dict = dict(meta) if meta else {}
+    meta_dict.update({'index_name': index_name, 'columns': list(columns)})
+    with open(meta_file, 'w') as meta_out:
+        json.dump(meta_dict, meta_out)
+    tmp_npy = npy_file + '.tmp'
+    with open(tmp_npy, 'wb') as npy_out:
+        np.save(npy_out, feat_mtx)
+    os.replace(tmp_npy, npy_file)
+    if export_tsv:
+        export_features(prefix)
+
+    return prefix
+
+
+def load_features(prefix, mmap=True):
+    """Open a feature table.
+
+    :param prefix: path the table was written to, without extension
+    :param mmap: memory-map the matrix read-only instead of reading it into RAM
+    :return: list of row IDs, the float32 matrix and the meta dict"""
+    npy_file, ids_file, meta_file = feature_files(prefix)
+    if not feature_exists(prefix):
+        raise Exception("**ERROR** feature table " + prefix + " does not exist")
+    with open(ids_file, 'r') as ids_in:
+        id_list = ids_in.read().splitlines()
+    with open(meta_file, 'r') as meta_in:
+        meta_dict = json.load(meta_in)
+    feat_mtx = np.load(npy_file, mmap_mode='r' if mmap else None)
+
+    return id_list, feat_mtx, meta_dict
+
+
+def load_feature_df(prefix, mmap=True):
+    """Open a feature table as a DataFrame indexed by row ID, backed by the memory map if mmap."""
+    id_list, feat_mtx, meta_dict = load_features(prefix, mmap)
+    feat_df = pd.DataFrame(feat_mtx, index=pd.Index(id_list, name=meta_dict['index_name']),
+                           columns=meta_dict['columns'], copy=False
+                           )
+
+    return feat_df
+
+
+def export_features(prefix, tsv_file=None):
+    """Write a feature table out as a TSV in the same layout the pipeline used to produce.
+
+    :return: path of the TSV, <prefix>.tsv by default"""
+    if tsv_file is None:
+        tsv_file = prefix + '.tsv'
+    logging.info('Exporting %s to %s\n' % (prefix, tsv_file))
+    feat_df = load_feature_df(prefix)
+    feat_df.to_csv(tsv_file, sep='\t')
+
+    return tsv_file
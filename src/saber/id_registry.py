@@ -0,0 +1,112 @@
+__author__ = 'Ryan J McLaughlin'
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import saber.subcontig_index as s_sidx
+
+
+class IdRegistry:
+    """
+    int32 codes for the subcontigs and contigs of one assembly, assigned once so the
+    recruit and cluster tables can carry integer columns instead of ID strings.
+    Subcontig code i is row i of the feature tables, sub2contig[i] is the code of the
+    contig it was cut from. Names are only looked up again when something is written.
+    """
+
+    def __init__(self, sub_names, contig_names, sub2contig) -> None:
+        self.sub_names = np.asarray(sub_names, dtype=object)
+        self.contig_names = np.asarray(contig_names, dtype=object)
+        self.sub2contig = np.asarray(sub2contig, dtype=np.int32)
+        if len(self.sub2contig) != len(self.sub_names):
+            raise Exception("**ERROR** " + str(len(self.sub_names)) + " subcontig IDs but "
+                            + str(len(self.sub2contig)) + " subcontig to contig codes were given")
+        self.sub_index = pd.Index(self.sub_names)
+        self.contig_index = pd.Index(self.contig_names)
+        return
+
+    def __len__(self) -> int:
+        return len(self.sub_names)
+
+    def sub_codes(self, names):
+        """Codes of subcontig IDs, -1 for IDs that aren't registered."""
+        return self.sub_index.get_indexer(pd.Index(names, dtype=object)).astype(np.int32)
+
+    def contig_codes(self, names, add=False):
+        """Codes of contig IDs, -1 for IDs that aren't registered unless add is set,
+        then new contig IDs (e.g. contigs too short for any subcontig) get the next codes."""
+        names = pd.Index(names, dtype=object)
+        codes = self.contig_index.get_indexer(names)
+        if add and (codes == -1).any():
+            new_names = names[codes == -1].unique()
+            self.contig_names = np.concatenate([self.contig_names, np.asarray(new_names, dtype=object)])
+            self.contig_index = pd.Index(self.contig_names)
+            codes = self.contig_index.get_indexer(names)
+        return codes.astype(np.int32)
+
+    def contig_of(self, sub_codes):
+        return self.sub2contig[np.asarray(sub_codes, dtype=np.int64)]
+
+    def sub_name(self, codes):
+        return self.sub_names[check_codes(codes)]
+
+    def contig_name(self, codes):
+        return self.contig_names[check_codes(codes)]
+
+    def contig_counts(self):
+        """Number of subcontigs of every contig, indexed by contig code."""
+        return np.bincount(self.sub2contig, minlength=len(self.contig_names))
+
+    def encode_df(self, id_df, sub_col='subcontig_id', contig_col='contig_id'):
+        """Copy of id_df with its subcontig and contig ID columns (those present) as codes,
+        for tables read back from TSV."""
+        code_df = id_df.copy()
+        if sub_col in code_df.columns:
+            code_df[sub_col] = self.sub_codes(code_df[sub_col].astype(str))
+        if contig_col in code_df.columns:
+            code_df[contig_col] = self.contig_codes(code_df[contig_col].astype(str), add=True)
+        return code_df
+
+    def decode_df(self, code_df, sub_col='subcontig_id', contig_col='contig_id'):
+        """Copy of code_df with its subcontig and contig code columns (those present) as ID strings."""
+        id_df = code_df.copy()
+        if sub_col in id_df.columns:
+            id_df[sub_col] = self.sub_name(id_df[sub_col].values)
+        if contig_col in id_df.columns:
+            id_df[contig_col] = self.contig_name(id_df[contig_col].values)
+        return id_df
+
+
+def check_codes(codes):
+    codes = np.asarray(codes, dtype=np.int64)
+    if (codes < 0).any():
+        raise Exception("**ERROR** " + str((codes < 0).sum()) + " IDs were not found in the ID registry")
+    return codes
+
+
+def from_subcontig_ids(sub_ids):
+    """Registry of subcontig IDs in row order, contig IDs are split off the _<i> suffix once here."""
+    sub_ids = pd.Index(sub_ids, dtype=object).astype(str)
+    contig_ids = sub_ids.str.rsplit('_', n=1).str[0]
+    sub2contig, contig_names = pd.factorize(contig_ids)
+
+    return IdRegistry(sub_ids, contig_names, sub2contig)
+
+
+def from_subcontig_index(sub_idx):
+    """Registry of a subcontig_index.SubcontigIndex, its contig index already is the code."""
+    return IdRegistry(sub_idx.headers(), sub_idx.contig_names, sub_idx.contig_idx)
+
+
+def from_feature_ids(sub_ids, idx_file=None):
+    """Registry of the subcontig IDs of a feature table, in row order.
+
+    Taken from the subcontig index at idx_file when its subcontigs are exactly sub_ids,
+    so contig IDs don't need splitting off, otherwise built from the IDs themselves."""
+    if (idx_file is not None) and os.path.isfile(idx_file):
+        id_reg = from_subcontig_index(s_sidx.load_subcontig_index(idx_file))
+        if np.array_equal(id_reg.sub_names, np.asarray(sub_ids, dtype=object).astype(str)):
+            return id_reg
+    return from_subcontig_ids(sub_ids)
@@ -0,0 +1,206 @@
+__author__ = 'Ryan J McLaughlin'
+
+import hashlib
+import logging
+import multiprocessing
+import os
+from subprocess import Popen, PIPE
+
+import numpy as np
+import pyfastx
+import sourmash
+
+import saber.utilities as s_utils
+
+# FracMinHash sketch of the subcontigs, reads are hashed with the same ksize/scaled so
+# their k-mers land on the same hashes. The MinHash recruiter's k=201 is longer than a short read.
+KMER_ABUND_K = 31
+KMER_ABUND_SCALED = 100
+# read bases hashed per sourmash call, reads are joined with N so no k-mer spans two of them
+READ_BATCH_BASES = 1 << 24
+
+
+def sketch_hashes(seq, ksize=KMER_ABUND_K, scaled=KMER_ABUND_SCALED):
+    mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+    mh.add_sequence(str(seq), force=True)
+    return np.fromiter(mh.hashes, dtype=np.uint64)
+
+
+def sketch_record(p):
+    i, seq, ksize, scaled = p
+    return i, sketch_hashes(seq, ksize, scaled)
+
+
+def sketch_subcontigs(sub_records, nthreads=1, ksize=KMER_ABUND_K, scaled=KMER_ABUND_SCALED):
+    """FracMinHash hashes of every subcontig.
+
+    :param sub_records: (header, seq) subcontig records, e.g. s_sidx.subcontig_records
+    :return: headers, lengths, the sorted unique hashes and (subcontig, hash) pairs as
+    indices into headers and the unique hashes"""
+    header_list = []
+    len_list = []
+    sub_list = []
+    hash_list = []
+    pool = multiprocessing.Pool(processes=nthreads)
+    try:
+        # Pool.imap would read all of its input up front, so about READ_BATCH_BASES of
+        # subcontig sequence are handed to the workers at a time
+        for arg_list in sketch_batches(sub_records, header_list, len_list, ksize, scaled):
+            for i, hash_arr in pool.imap(sketch_record, arg_list, chunksize=64):
+                sub_list.append(np.full(len(hash_arr), i, dtype=np.int32))
+                hash_list.append(hash_arr)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    sub_arr = np.concatenate(sub_list + [np.zeros(0, dtype=np.int32)])
+    pair_hashes = np.concatenate(hash_list + [np.zeros(0, dtype=np.uint64)])
+    uniq_hashes, hash_idx = np.unique(pair_hashes, return_inverse=True)
+
+    return header_list, np.asarray(len_list, dtype=np.int64), uniq_hashes, sub_arr, hash_idx.astype(np.int64)
+
+
+def sketch_batches(sub_records, header_list, len_list, ksize, scaled, batch_bases=READ_BATCH_BASES):
+    # sketch_record args of about batch_bases at a time, headers and lengths are kept on the way
+    arg_list = []
+    arg_len = 0
+    for i, (header, seq) in enumerate(sub_records):
+        header_list.append(header)
+        len_list.append(len(seq))
+        arg_list.append([i, str(seq), ksize, scaled])
+        arg_len += len(seq)
+        if arg_len >= batch_bases:
+            yield arg_list
+            arg_list = []
+            arg_len = 0
+    if arg_list:
+        yield arg_list
+
+
+def save_sketch(sketch_file, header_list, len_arr, uniq_hashes, sub_arr, hash_idx, ksize=KMER_ABUND_K,
+                scaled=KMER_ABUND_SCALED
+                ):
+    with open(sketch_file + '.tmp', 'wb') as sketch_out:
+        np.savez_compressed(sketch_out, headers=np.asarray(header_list, dtype=str), lens=len_arr,
+                            hashes=uniq_hashes, sub_arr=sub_arr, hash_idx=hash_idx,
+                            params=np.array([ksize, scaled])
+                            )
+    os.replace(sketch_file + '.tmp', sketch_file)
+
+    return sketch_file
+
+
+def load_sketch(sketch_file):
+    """:return: headers, lengths, unique hashes, subcontig of each pair, hash of each pair, (ksize, scaled)"""
+    with np.load(sketch_file) as sketch_npz:
+        return (sketch_npz['headers'], sketch_npz['lens'], sketch_npz['hashes'], sketch_npz['sub_arr'],
+                sketch_npz['hash_idx'], tuple(int(x) for x in sketch_npz['params'])
+                )
+
+
+def hash_key(uniq_hashes):
+    # identifies the hash set a sample was counted against
+    return hashlib.blake2b(np.ascontiguousarray(uniq_hashes).tobytes(), digest_size=8).hexdigest()
+
+
+def fastq_seqs(read_file):
+    """Read sequences of a FASTQ, compressed files are streamed through pigz/zstd like get_seqs does."""
+    decomp_cmd = s_utils.decompress_cmd(read_file)
+    if decomp_cmd is None:
+        for rec in pyfastx.Fastq(read_file, build_index=False):
+            yield rec[1]
+        return
+    proc = Popen(decomp_cmd, stdout=PIPE, bufsize=1 << 20)
+    finished = False
+    try:
+        for i, line in enumerate(proc.stdout):
+            if i % 4 == 1:
+                yield line.rstrip().decode()
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise Exception("**ERROR** " + ' '.join(decomp_cmd) + " exited with code " + str(proc.returncode))
+
+
+class KmerCounter:
+    """
+    Occurrences of a fixed set of FracMinHash hashes in streamed reads.
+
+    Reads are hashed in batches by sourmash with abundance tracking and only the counts of
+    the target hashes are kept, in an int64 array aligned with them, so memory doesn't grow
+    with the read errors and novel k-mers of the sample.
+    """
+
+    def __init__(self, uniq_hashes, ksize=KMER_ABUND_K, scaled=KMER_ABUND_SCALED,
+                 batch_bases=READ_BATCH_BASES
+                 ) -> None:
+        self.hashes = np.asarray(uniq_hashes, dtype=np.uint64)
+        self.ksize = ksize
+        self.scaled = scaled
+        self.batch_bases = batch_bases
+        self.counts = np.zeros(len(self.hashes), dtype=np.int64)
+        self.n_reads = 0
+        self.n_bases = 0
+        self.batch = []
+        self.batch_len = 0
+        return
+
+    def add_reads(self, seqs):
+        for seq in seqs:
+            self.batch.append(seq)
+            self.batch_len += len(seq) + 1
+            self.n_reads += 1
+            self.n_bases += len(seq)
+            if self.batch_len >= self.batch_bases:
+                self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        mh = sourmash.MinHash(n=0, ksize=self.ksize, scaled=self.scaled, track_abundance=True)
+        mh.add_sequence('N'.join(self.batch), force=True)
+        abund_dict = mh.hashes
+        batch_hashes = np.fromiter(abund_dict.keys(), dtype=np.uint64, count=len(abund_dict))
+        batch_counts = np.fromiter(abund_dict.values(), dtype=np.int64, count=len(abund_dict))
+        if len(self.hashes) > 0:
+            idx = np.minimum(np.searchsorted(self.hashes, batch_hashes), len(self.hashes) - 1)
+            hit = self.hashes[idx] == batch_hashes
+            np.add.at(self.counts, idx[hit], batch_counts[hit])
+        self.batch = []
+        self.batch_len = 0
+
+    def mean_read_len(self):
+        return self.n_bases / max(self.n_reads, 1)
+
+
+def kmer_depths(counts, sub_arr, hash_idx, n_subs, mean_read_len, ksize=KMER_ABUND_K):
+    """Approximate depth and variance of each subcontig from the read counts of its sampled k-mers.
+
+    A k-mer is seen in L - k + 1 of the L positions of a read covering it, the mean count is
+    scaled by L / (L - k + 1) to read depth. Subcontigs without sampled k-mers get 0.
+    :return: float64 depth and variance arrays"""
+    k_cov = counts[hash_idx].astype(np.float64)
+    n_arr = np.bincount(sub_arr, minlength=n_subs)
+    k_depth = np.bincount(sub_arr, weights=k_cov, minlength=n_subs) / np.maximum(n_arr, 1)
+    k_sq = np.bincount(sub_arr, weights=k_cov * k_cov, minlength=n_subs) / np.maximum(n_arr, 1)
+    k_var = np.maximum(k_sq - k_depth * k_depth, 0)
+    scale = mean_read_len / max(mean_read_len - ksize + 1, 1)
+
+    return k_depth * scale, k_var * scale * scale
+
+
+def count_reads(read_list, uniq_hashes, ksize=KMER_ABUND_K, scaled=KMER_ABUND_SCALED):
+    """One pass over the read files of a sample, counting the target hashes.
+
+    :return: the filled KmerCounter"""
+    counter = KmerCounter(uniq_hashes, ksize, scaled)
+    for read_file in read_list:
+        counter.add_reads(fastq_seqs(read_file))
+    counter.flush()
+    logging.info('Hashed %s reads (%s bp) of %s\n' % (counter.n_reads, counter.n_bases, os.path.basename(read_list[0])))
+
+    return counter
@@ -0,0 +1,231 @@
+__author__ = 'Ryan J McLaughlin'
+
+import fcntl
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+import saber.composition as s_comp
+
+# number of saves an entry is kept for without any run using it
+CACHE_MAX_AGE = 5
+
+
+class KmerCache:
+    """
+    Raw k-mer count vectors of previously counted sequences, keyed on a blake2b
+    hash of the (lower-cased) sequence and the composition profile, so identical
+    subcontigs are never counted twice across runs, files or re-assemblies.
+    Stored as one <prefix>.kmers.npy uint32 matrix, n x (5 + profile.n_cols), the
+    16 byte digest in the first 4 columns, the generation the entry was last used
+    in after it and the counts last, so keys and counts are always replaced together.
+    Every save that changes the store is a new generation, entries that no run
+    has used for max_age generations are dropped then.
+    """
+
+    def __init__(self, cache_prefix, profile=s_comp.TETRA_PROFILE, max_age=CACHE_MAX_AGE,
+                 max_entries=None
+                 ) -> None:
+        self.prefix = cache_prefix
+        self.profile = profile
+        self.max_age = int(max_age)
+        self.max_entries = max_entries
+        # blake2b personalization keeps keys of different profiles apart
+        self.person = (str(profile.k) + profile.mode).encode()
+        self.cache_file = cache_prefix + '.kmers.npy'
+        self.lock_file = cache_prefix + '.kmers.lock'
+        self.load()
+        return
+
+    def __len__(self) -> int:
+        return len(self.key_dict)
+
+    def __contains__(self, key) -> bool:
+        return key in self.key_dict
+
+    def load(self):
+        key_mtx, self.gen_arr, self.count_mtx, self.store_stat = self.read_store()
+        key_bytes = key_mtx.tobytes()
+        self.key_dict = {key_bytes[i * 16:(i + 1) * 16]: i for i in range(len(key_mtx))}
+        self.n_saved = len(key_mtx)
+        self.generation = int(self.gen_arr.max()) if self.n_saved else 0
+        self.used = np.zeros(self.n_saved, dtype=bool)
+        self.new_keys = []
+        self.new_mtx_list = []
+
+    def read_store(self):
+        # keys, generations, counts and the (mtime, size) of the store, empty if there is none
+        if not os.path.isfile(self.cache_file):
+            return (np.zeros((0, 16), dtype=np.uint8), np.zeros(0, dtype=np.uint32),
+                    np.zeros((0, self.profile.n_cols), dtype=np.uint32), None
+                    )
+        store_stat = os.stat(self.cache_file)
+        cache_mtx = np.load(self.cache_file, mmap_mode='r')
+        if (cache_mtx.ndim != 2) or (cache_mtx.shape[1] != self.profile.n_cols + 5):
+            raise Exception("**ERROR** k-mer cache " + self.prefix + " does not match the "
+                            + self.profile.name + " profile, remove it or use another cache path")
+        key_mtx = np.ascontiguousarray(cache_mtx[:, :4]).view(np.uint8)
+
+        store_stat = (store_stat.st_mtime_ns, store_stat.st_size)
+
+        return key_mtx, np.array(cache_mtx[:, 4]), cache_mtx[:, 5:], store_stat
+
+    def seq_key(self, seq):
+        # seq is expected lower-case, counts don't depend on case
+        return hashlib.blake2b(seq.encode('ascii', 'replace'), digest_size=16,
+                               person=self.person).digest()
+
+    def add(self, key_list, kmer_mtx):
+        for key in key_list:
+            self.key_dict[key] = len(self.key_dict)
+        self.new_keys.extend(key_list)
+        self.new_mtx_list.append(np.asarray(kmer_mtx, dtype=np.uint32))
+
+    def get(self, key_list):
+        """Count matrix for key_list, every key must be in the cache.
+
+        :return: (len(key_list) x profile.n_cols) uint32 matrix"""
+        row_arr = np.fromiter((self.key_dict[k] for k in key_list), dtype=np.int64,
+                              count=len(key_list)
+                              )
+        kmer_mtx = np.zeros((len(key_list), self.profile.n_cols), dtype=np.uint32)
+        saved = row_arr < self.n_saved
+        kmer_mtx[saved] = self.count_mtx[row_arr[saved]]
+        self.used[row_arr[saved]] = True
+        if not saved.all():
+            new_mtx = np.concatenate(self.new_mtx_list)
+            kmer_mtx[~saved] = new_mtx[row_arr[~saved] - self.n_saved]
+
+        return kmer_mtx
+
+    def save(self):
+        """Write new entries, mark every entry used since loading with a new generation
+        and drop the ones unused for max_age generations (or the oldest past max_entries).
+
+        Entries another run saved in the meantime are merged in, the lock keeps two
+        runs from replacing the store at the same time."""
+        over_bound = (self.max_entries is not None) and (self.n_saved > self.max_entries)
+        if not self.new_keys and not over_bound and (self.gen_arr[self.used] == self.generation).all():
+            return  # nothing new and every used entry is already in the latest generation
+        with open(self.lock_file, 'w') as lock_out:
+            fcntl.flock(lock_out, fcntl.LOCK_EX)
+            key_mtx = np.frombuffer(b''.join(self.key_dict.keys()), dtype=np.uint8).reshape(-1, 16)
+            gen_arr = np.concatenate([self.gen_arr, np.zeros(len(self.new_keys), dtype=np.uint32)])
+            count_mtx = np.concatenate([self.count_mtx] + self.new_mtx_list)
+            used = np.concatenate([self.used, np.ones(len(self.new_keys), dtype=bool)])
+            disk_keys, disk_gens, disk_counts, disk_stat = self.read_store()
+            generation = self.generation
+            if (disk_stat is not None) and (disk_stat != self.store_stat):
+                disk_bytes = disk_keys.tobytes()
+                other = np.fromiter((disk_bytes[i * 16:(i + 1) * 16] not in self.key_dict
+                                     for i in range(len(disk_keys))), dtype=bool, count=len(disk_keys)
+                                    )
+                logging.info('Merging %s entries another run saved to the k-mer cache %s\n'
+                             % (other.sum(), self.prefix)
+                             )
+                key_mtx = np.concatenate([key_mtx, disk_keys[other]])
+                gen_arr = np.concatenate([gen_arr, disk_gens[other]])
+                count_mtx = np.concatenate([count_mtx, disk_counts[other]])
+                used = np.concatenate([used, np.zeros(other.sum(), dtype=bool)])
+                generation = max(generation, int(disk_gens.max()) if len(disk_gens) else 0)
+            generation += 1
+            gen_arr[used] = generation
+            keep = gen_arr.astype(np.int64) > generation - self.max_age
+            if (self.max_entries is not None) and (keep.sum() > self.max_entries):
+                # newest generations first, the order of the store is kept otherwise
+                newest = np.argsort(-gen_arr.astype(np.int64), kind='stable')[:int(self.max_entries)]
+                keep = np.zeros(len(gen_arr), dtype=bool)
+                keep[newest] = True
+            logging.info('Saving %s new entries to the k-mer cache %s, dropping %s unused ones\n'
+                         % (len(self.new_keys), self.prefix, len(keep) - keep.sum())
+                         )
+            # written under a per process name and moved into place as a whole, a crash
+            # only ever leaves the previous store behind
+            tmp_file = self.cache_file + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_file, 'wb') as npy_out:
+                np.save(npy_out, np.concatenate([key_mtx[keep].view(np.uint32), gen_arr[keep, None],
+                                                 count_mtx[keep]], axis=1
+                                                ))
+            os.replace(tmp_file, self.cache_file)
+        # row numbers changed, start again from what was written
+        self.load()
+
+
+def count_kmer_records_cached(records, cache, nthreads=1):
+    """count_kmer_records that only counts sequences missing from cache.
+
+    :param records: iterable of (header, seq) records, e.g. a pyfastx.Fasta
+    :param cache: KmerCache, new counts are added to it but not saved
+    :param nthreads: number of processes for counting the missing sequences
+    :return: list of headers, list of sequence lengths and the uint32 count matrix"""
+    header_list = []
+    len_list = []
+    key_list = []
+    miss_dict = {}
+    for rec in records:
+        header, seq = rec[0], str(rec[1]).lower()
+        key = cache.seq_key(seq)
+        header_list.append(header)
+        len_list.append(len(seq))
+        key_list.append(key)
+        if (key not in cache) and (key not in miss_dict):
+            miss_dict[key] = (header, seq)
+    logging.info('%s of %s sequences found in the k-mer cache\n'
+                 % (len(key_list) - len(miss_dict), len(key_list))
+                 )
+    if miss_dict:
+        if nthreads > 1:
+            miss_mtx = s_comp.count_kmer_records_mp(miss_dict.values(), nthreads, cache.profile)[2]
+        else:
+            miss_mtx = s_comp.count_kmer_records(miss_dict.values(), cache.profile, len(miss_dict))[2]
+        cache.add(list(miss_dict.keys()), miss_mtx)
+
+    return header_list, len_list, cache.get(key_list)
+
+
+def count_window_records_cached(records, window_func, cache, nthreads=1):
+    """count_window_records that only counts windows missing from cache.
+
+    Windows are hashed on their own sequence, so a contig that gained or lost
+    bases only has its changed windows recounted.
+    :param records: iterable of (header, seq) contig records
+    :param window_func: callable returning the (n x 2) window bounds for a contig length
+    :param cache: KmerCache, new counts are added to it but not saved
+    :param nthreads: number of processes for counting the missing windows
+    :return: list of subcontig headers, list of subcontig lengths and the uint32 count matrix"""
+    header_list = []
+    len_list = []
+    key_list = []
+    n_miss = 0
+    # one window_chunks chunk of contigs at a time, its missing windows are counted
+    # and added to the cache before the next chunk is read
+    for chunk_headers, chunk_lens, contig_list in s_comp.window_chunks(records, window_func):
+        header_list.extend(chunk_headers)
+        len_list.extend(chunk_lens)
+        miss_dict = {}
+        miss_contigs = []
+        for seq, bounds in contig_list:
+            low_seq = seq.lower()
+            miss_rows = []
+            for i, (s, e) in enumerate(bounds):
+                key = cache.seq_key(low_seq[s:e])
+                key_list.append(key)
+                if (key not in cache) and (key not in miss_dict):
+                    miss_dict[key] = len(miss_dict)
+                    miss_rows.append(i)
+            if miss_rows:
+                miss_contigs.append((seq, bounds[miss_rows]))
+        if miss_dict:
+            if nthreads > 1:
+                miss_mtx = s_comp.count_window_list_mp(miss_contigs, len(miss_dict), nthreads, cache.profile)
+            else:
+                miss_mtx = s_comp.count_window_list(miss_contigs, len(miss_dict), cache.profile)
+            cache.add(list(miss_dict.keys()), miss_mtx)
+            n_miss += len(miss_dict)
+    logging.info('%s of %s subcontigs found in the k-mer cache\n'
+                 % (len(key_list) - n_miss, len(key_list))
+                 )
+
+    return header_list, len_list, cache.get(key_list)
@@ -0,0 +1,319 @@
+__author__ = 'Ryan J McLaughlin'
+
+import numpy as np
+
+try:
+    from numba import njit
+
+    HAS_NUMBA = True
+except ImportError:  # numba is optional, everything falls back to the NumPy kernels
+    HAS_NUMBA = False
+
+# All kernels work on 2-bit encoded sequences (see composition.encode_seq) where
+# a=0, t=1, g=2, c=3 and anything else is 4. A k-mer index is the base-4 number
+# of its codes, so complementing a base is code ^ 1.
+
+
+#######################################################################
+# NumPy kernels, also the fallback when numba can't be imported        #
+#######################################################################
+def np_kmer_positions(codes, k):
+    """Rolling k-mer index at every position of an encoded sequence.
+
+    :param codes: 2-bit encoded sequence
+    :param k: k-mer size
+    :return: k-mer indices and a bool array that is False where the k-mer
+    overlaps an ambiguous base"""
+    n_kmers = max(codes.shape[0] - k + 1, 0)
+    kmer_idx = np.zeros(n_kmers, dtype=np.uint8 if k <= 4 else np.uint32)
+    ambig = np.zeros(n_kmers, dtype=bool)
+    for j in range(k):
+        sub_codes = codes[j:j + n_kmers]
+        kmer_idx = (kmer_idx << 2) | (sub_codes & 3)
+        ambig |= sub_codes > 3
+
+    return kmer_idx, ~ambig
+
+
+def np_count_kmers(codes, k, lut, n_cols):
+    kmer_idx, valid = np_kmer_positions(codes, k)
+
+    return np.bincount(lut[kmer_idx[valid]], minlength=n_cols)
+
+
+def np_prefix_kmers(codes, break_arr, k, lut, n_cols):
+    """Cumulative k-mer counts at each breakpoint, i.e. counts of k-mers starting before it.
+
+    :param codes: 2-bit encoded sequence
+    :param break_arr: sorted unique k-mer start positions
+    :param k: k-mer size
+    :param lut: k-mer index to column lookup table
+    :param n_cols: number of columns in lut
+    :return: (n_breakpoints x n_cols) int64 matrix"""
+    kmer_idx, valid = np_kmer_positions(codes, k)
+    n_segs = len(break_arr) - 1
+    prefix_mtx = np.zeros((len(break_arr), n_cols), dtype=np.int64)
+    if n_segs > 0:
+        seg_ids = np.repeat(np.arange(n_segs), np.diff(break_arr))
+        seg_valid = valid[break_arr[0]:break_arr[-1]]
+        seg_kmers = kmer_idx[break_arr[0]:break_arr[-1]]
+        seg_keys = seg_ids[seg_valid] * n_cols + lut[seg_kmers[seg_valid]]
+        seg_mtx = np.bincount(seg_keys, minlength=n_segs * n_cols).reshape(n_segs, n_cols)
+        np.cumsum(seg_mtx, axis=0, out=prefix_mtx[1:])
+
+    return prefix_mtx
+
+
+def np_gc_ambig_count(codes):
+    gc_cnt = np.count_nonzero(codes == 2) + np.count_nonzero(codes == 3)
+    ambig_cnt = np.count_nonzero(codes > 3)
+
+    return gc_cnt, ambig_cnt
+
+
+def np_reverse_kmers(kmer_arr, k):
+    kmer_arr = np.asarray(kmer_arr, dtype=np.int64)
+    rev_arr = np.zeros_like(kmer_arr)
+    for j in range(k):
+        rev_arr |= ((kmer_arr >> (2 * j)) & 3) << (2 * (k - 1 - j))
+
+    return rev_arr
+
+
+def np_revcomp_kmers(kmer_arr, k):
+    comp_mask = sum([1 << (2 * j) for j in range(k)])
+
+    return np_reverse_kmers(np.asarray(kmer_arr, dtype=np.int64) ^ comp_mask, k)
+
+
+def np_window_bounds(len_arr, win_size, o_lap, m_len):
+    """Subcontig windows for many contigs at once, same rules as utilities.kmer_slide.
+
+    :param len_arr: contig lengths
+    :param win_size: max subcontig length
+    :param o_lap: subcontig overlap
+    :param m_len: minimum contig length
+    :return: contig index, start and end arrays with one entry per subcontig"""
+    len_arr = np.asarray(len_arr, dtype=np.int64)
+    step = win_size - o_lap
+    slide = (len_arr >= o_lap) & (len_arr >= win_size)
+    n_full = np.where(slide & (len_arr >= 2 * win_size),
+                      (len_arr - 2 * win_size) // max(step, 1) + 1, 0
+                      )
+    keep = (len_arr >= o_lap) | (len_arr >= m_len)
+    n_win = np.where(slide, n_full + 1, keep.astype(np.int64))
+    contig_idx = np.repeat(np.arange(len(len_arr)), n_win)
+    first_win = np.repeat(np.cumsum(n_win) - n_win, n_win)
+    win_num = np.arange(len(contig_idx)) - first_win
+    rep_len = len_arr[contig_idx]
+    rep_slide = slide[contig_idx]
+    last_win = win_num == n_win[contig_idx] - 1
+    starts = np.where(rep_slide & last_win, rep_len - win_size, win_num * step)
+    ends = np.where(rep_slide, starts + win_size, rep_len)
+
+    return contig_idx, starts, ends
+
+
+#######################################################################
+# numba kernels, plain python loops that get compiled below            #
+#######################################################################
+def nb_count_kmers(codes, k, lut, n_cols):
+    counts = np.zeros(n_cols, dtype=np.int64)
+    kmer_mask = (1 << (2 * k)) - 1
+    kmer = 0
+    run_len = 0  # number of unambiguous bases ending at i
+    for i in range(codes.shape[0]):
+        if codes[i] > 3:
+            run_len = 0
+            kmer = 0
+        else:
+            kmer = ((kmer << 2) | codes[i]) & kmer_mask
+            run_len += 1
+            if run_len >= k:
+                counts[lut[kmer]] += 1
+
+    return counts
+
+
+def nb_prefix_kmers(codes, break_arr, k, lut, n_cols):
+    prefix_mtx = np.zeros((break_arr.shape[0], n_cols), dtype=np.int64)
+    running = np.zeros(n_cols, dtype=np.int64)
+    kmer_mask = (1 << (2 * k)) - 1
+    kmer = 0
+    run_len = 0
+    bp = 0
+    for i in range(codes.shape[0]):
+        if codes[i] > 3:
+            run_len = 0
+            kmer = 0
+        else:
+            kmer = ((kmer << 2) | codes[i]) & kmer_mask
+            run_len += 1
+        kmer_start = i - k + 1
+        if kmer_start < 0:
+            continue
+        while bp < break_arr.shape[0] and break_arr[bp] <= kmer_start:
+            prefix_mtx[bp, :] = running
+            bp += 1
+        if bp == break_arr.shape[0]:
+            break
+        if run_len >= k:
+            running[lut[kmer]] += 1
+    while bp < break_arr.shape[0]:
+        prefix_mtx[bp, :] = running
+        bp += 1
+
+    return prefix_mtx
+
+
+def nb_gc_ambig_count(codes):
+    gc_cnt = 0
+    ambig_cnt = 0
+    for i in range(codes.shape[0]):
+        if codes[i] > 3:
+            ambig_cnt += 1
+        elif codes[i] >= 2:
+            gc_cnt += 1
+
+    return gc_cnt, ambig_cnt
+
+
+def nb_reverse_kmers(kmer_arr, k):
+    rev_arr = np.zeros(kmer_arr.shape[0], dtype=np.int64)
+    for i in range(kmer_arr.shape[0]):
+        kmer = kmer_arr[i]
+        rev = 0
+        for j in range(k):
+            rev = (rev << 2) | (kmer & 3)
+            kmer >>= 2
+        rev_arr[i] = rev
+
+    return rev_arr
+
+
+def nb_revcomp_kmers(kmer_arr, k):
+    rev_arr = np.zeros(kmer_arr.shape[0], dtype=np.int64)
+    for i in range(kmer_arr.shape[0]):
+        kmer = kmer_arr[i]
+        rev = 0
+        for j in range(k):
+            rev = (rev << 2) | ((kmer & 3) ^ 1)
+            kmer >>= 2
+        rev_arr[i] = rev
+
+    return rev_arr
+
+
+def nb_window_bounds(len_arr, win_size, o_lap, m_len):
+    step = win_size - o_lap
+    n_win = np.zeros(len_arr.shape[0], dtype=np.int64)
+    for i in range(len_arr.shape[0]):
+        if len_arr[i] >= o_lap and len_arr[i] >= win_size:
+            n_win[i] = 1
+            if len_arr[i] >= 2 * win_size:
+                n_win[i] += (len_arr[i] - 2 * win_size) // step + 1
+        elif len_arr[i] >= o_lap or len_arr[i] >= m_len:
+            n_win[i] = 1
+    n_total = n_win.sum()
+    contig_idx = np.empty(n_total, dtype=np.int64)
+    starts = np.empty(n_total, dtype=np.int64)
+    ends = np.empty(n_total, dtype=np.int64)
+    j = 0
+    for i in range(len_arr.shape[0]):
+        for w in range(n_win[i]):
+            contig_idx[j] = i
+            if len_arr[i] >= o_lap and len_arr[i] >= win_size:
+                starts[j] = len_arr[i] - win_size if w == n_win[i] - 1 else w * step
+                ends[j] = starts[j] + win_size
+            else:
+                starts[j] = 0
+                ends[j] = len_arr[i]
+            j += 1
+
+    return contig_idx, starts, ends
+
+
+if HAS_NUMBA:
+    nb_count_kmers = njit(nogil=True)(nb_count_kmers)
+    nb_prefix_kmers = njit(nogil=True)(nb_prefix_kmers)
+    nb_gc_ambig_count = njit(nogil=True)(nb_gc_ambig_count)
+    nb_reverse_kmers = njit(nogil=True)(nb_reverse_kmers)
+    nb_revcomp_kmers = njit(nogil=True)(nb_revcomp_kmers)
+    nb_window_bounds = njit(nogil=True)(nb_window_bounds)
+
+
+#######################################################################
+# Dispatchers used by the rest of SABer                                #
+#######################################################################
+def count_kmers(codes, k, lut=None, n_cols=None):
+    """Count all unambiguous k-mers of an encoded sequence.
+
+    :param codes: 2-bit encoded sequence
+    :param k: k-mer size
+    :param lut: optional k-mer index to column lookup table, e.g. to merge
+    canonical k-mers while counting
+    :param n_cols: number of columns in lut
+    :return: int64 array of length n_cols, or 4^k without a lut"""
+    if lut is None:
+        lut, n_cols = np.arange(4 ** k), 4 ** k
+    if HAS_NUMBA:
+        return nb_count_kmers(codes, k, lut, n_cols)
+    return np_count_kmers(codes, k, lut, n_cols)
+
+
+def count_window_kmers(codes, bounds, k, lut=None, n_cols=None):
+    """Count k-mers for a set of (possibly overlapping) windows of one encoded sequence.
+
+    Every position is counted once. The window start and end points split the
+    sequence into disjoint segments whose cumulative counts are kept at each
+    breakpoint, and each window is the difference of two of those prefix sums.
+    :param codes: 2-bit encoded sequence
+    :param bounds: (n_windows x 2) array of [start, end) window coordinates
+    :param k: k-mer size
+    :param lut: optional k-mer index to column lookup table
+    :param n_cols: number of columns in lut
+    :return: (n_windows x n_cols) int64 count matrix"""
+    if lut is None:
+        lut, n_cols = np.arange(4 ** k), 4 ** k
+    bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+    # k-mers starting in [start, end - k + 1) lie entirely inside a window
+    kmer_bounds = np.stack([bounds[:, 0], np.maximum(bounds[:, 0], bounds[:, 1] - k + 1)], axis=1)
+    break_arr = np.unique(kmer_bounds)
+    if HAS_NUMBA:
+        prefix_mtx = nb_prefix_kmers(codes, break_arr, k, lut, n_cols)
+    else:
+        prefix_mtx = np_prefix_kmers(codes, break_arr, k, lut, n_cols)
+    bp_idx = np.searchsorted(break_arr, kmer_bounds)
+
+    return prefix_mtx[bp_idx[:, 1]] - prefix_mtx[bp_idx[:, 0]]
+
+
+def gc_ambig_count(codes):
+    """Number of G/C and of ambiguous (non-ACGT) bases in an encoded sequence."""
+    if HAS_NUMBA:
+        return nb_gc_ambig_count(codes)
+    return np_gc_ambig_count(codes)
+
+
+def reverse_kmers(kmer_arr, k):
+    """Index of the reverse (not complement) of each k-mer index."""
+    if HAS_NUMBA:
+        return nb_reverse_kmers(np.asarray(kmer_arr, dtype=np.int64), k)
+    return np_reverse_kmers(kmer_arr, k)
+
+
+def revcomp_kmers(kmer_arr, k):
+    """Index of the reverse complement of each k-mer index."""
+    if HAS_NUMBA:
+        return nb_revcomp_kmers(np.asarray(kmer_arr, dtype=np.int64), k)
+    return np_revcomp_kmers(kmer_arr, k)
+
+
+def window_bounds(len_arr, win_size, o_lap, m_len):
+    """Subcontig windows for many contigs at once, see np_window_bounds."""
+    if win_size - o_lap <= 0:
+        raise Exception("**ERROR** o_lap must be smaller than win_size.")
+    len_arr = np.asarray(len_arr, dtype=np.int64)
+    if HAS_NUMBA:
+        return nb_window_bounds(len_arr, int(win_size), int(o_lap), int(m_len))
+    return np_window_bounds(len_arr, int(win_size), int(o_lap), int(m_len))
@@ -1,6 +1,8 @@
+import hashlib
 import logging
 import multiprocessing
-from os.path import isfile, getsize
+import os
+from os.path import isfile
 from os.path import join as o_join
 
 import numpy as np
@@ -9,12 +11,17 @@ from tqdm import tqdm
 import sourmash
 from sourmash.sbtmh import SigLeaf
 
+import saber.subcontig_index as s_sidx
 import saber.utilities as s_utils
 
 pd.set_option('display.max_columns', None)
 
 
-def run_minhash_recruiter(sig_path, mhr_path, sag_sub_files, mg_sub_file, nthreads, min_len):
+def run_minhash_recruiter(sig_path, mhr_path, sag_sub_files, mg_sub_file, nthreads, min_len, tc_map=None,
+                          update_ids=None
+                          ):
+    # with update_ids (SAGs new or changed since the last run) an existing recruit table is
+    # updated, only those SAGs are queried again and SAGs no longer given are dropped
     logging.info('Starting MinHash Recruitment\n')
     # Calculate/Load MinHash Signatures with SourMash for MG subseqs
     mg_id = mg_sub_file[0]
@@ -22,10 +29,33 @@ def run_minhash_recruiter(sig_path, mhr_path, sag_sub_files, mg_sub_file, nthrea
     mh_kmer_recruits_dict = {}
     for kmer in kmer_list:
         mh_recruit_file = o_join(mhr_path, mg_id + '.' + str(kmer) + '.mhr_contig_recruits.tsv')
+        run_files = None
         if isfile(mh_recruit_file) == False:
-            build_list, minhash_pass_list = sag_recruit_checker(mhr_path, sag_sub_files, kmer)
+            run_files = sag_sub_files
+            done_df = None
+        elif update_ids is not None:
+            done_df = pd.read_csv(mh_recruit_file, header=0, sep='\t')
+            sag_ids = set(x[0] for x in sag_sub_files)
+            if (len(update_ids) != 0) or (not set(done_df['sag_id']).issubset(sag_ids)):
+                logging.info('Updating MinHash recruits for %s new or changed Trusted Contig sets\n'
+                             % len(update_ids)
+                             )
+                done_df = done_df[done_df['sag_id'].isin(sag_ids - set(update_ids))]
+                for sag_id in update_ids:  # anything left over from an interrupted run is stale
+                    for stale_file in [o_join(sig_path, sag_id + '.' + str(kmer) + '.TC.sig'),
+                                       o_join(mhr_path, sag_id + '.' + str(kmer) + '.mhr_recruits.tsv')]:
+                        if isfile(stale_file):
+                            os.remove(stale_file)
+                run_files = [x for x in sag_sub_files if x[0] in set(update_ids)]
+        if run_files is not None:
+            build_list, minhash_pass_list = sag_recruit_checker(mhr_path, run_files, kmer)
+            if done_df is not None:
+                minhash_pass_list.append(done_df)
             if len(build_list) != 0:
-                sag_sig_dict = build_sag_sig_dict(build_list, nthreads, sig_path, kmer)
+                if tc_map is None:
+                    sag_sig_dict = build_sag_sig_dict(build_list, nthreads, sig_path, kmer)
+                else:
+                    sag_sig_dict = build_tc_sig_dict(build_list, nthreads, sig_path, kmer, tc_map)
                 build_mg_sbt(mg_id, mg_sub_file, sig_path, nthreads, kmer, min_len, checkonly=True)  # make sure SBT exists first
                 pool = multiprocessing.Pool(processes=nthreads)
                 sbt_args = mg_id, mg_sub_file, sig_path, nthreads
@@ -63,7 +93,8 @@ def run_minhash_recruiter(sig_path, mhr_path, sag_sub_files, mg_sub_file, nthrea
         mh_recruit_df = pd.read_csv(mh_recruit_file, header=0, sep='\t')
         mh_kmer_recruits_dict[kmer] = mh_recruit_df
     logging.info('Cleaning up intermediate files...\n')
-    for s in ["*.sig", "*.mhr_recruits.tsv", "*.sbt.zip"]:
+    # the metagenome signatures stay, extract_features skips sketching on later runs when they exist
+    for s in ["*.TC.sig", "*.mhr_recruits.tsv", "*.sbt.zip"]:
         s_utils.runCleaner(mhr_path, s)
 
     logging.info('MinHash Recruitment Algorithm Complete\n')
@@ -88,6 +119,46 @@ def build_sag_sig_dict(build_list, nthreads, sig_path, kmer):
     return sag_sig_dict
 
 
+def build_tc_sig_dict(build_list, nthreads, sig_path, kmer, tc_map):
+    # all SAGs share one multi-FASTA, sketch it in one pass and keep its signatures in one file
+    tc_file = build_list[0][1]
+    sag_ids = set(x[0] for x in build_list)
+    tc_sig_file = o_join(sig_path, s_utils.get_samp_id(tc_file) + '.' + tc_map_key(tc_file, tc_map) + '.'
+                         + str(kmer) + '.TC.sig'
+                         )
+    if isfile(tc_sig_file):
+        logging.info('Loading Trusted Contig Signatures\n')
+        tc_sig_list = tuple(sourmash.signature.load_signatures(tc_sig_file))
+    else:
+        arg_list = ([rec[0], str(rec[1]), kmer] for rec in s_utils.get_seqs(tc_file) if rec[0] in tc_map)
+        pool = multiprocessing.Pool(processes=nthreads)
+        results = pool.imap_unordered(build_signature, arg_list, chunksize=64)
+        logging.info('Building Trusted Contig Signatures:\n')
+        tc_sig_list = tuple(tqdm(results))
+        pool.close()
+        pool.join()
+        with open(tc_sig_file, 'w') as tc_out:
+            sourmash.signature.save_signatures(tc_sig_list, fp=tc_out)
+    sag_sig_dict = {}
+    for tc_sig in tc_sig_list:
+        sag_id = tc_map.get(tc_sig.name)
+        if sag_id in sag_ids:
+            sag_sig_dict.setdefault(sag_id, []).append(tc_sig)
+
+    return sag_sig_dict
+
+
+def tc_map_key(tc_file, tc_map):
+    # a different map, or an edited multi-FASTA, gets its own signature file
+    tc_stat = os.stat(tc_file)
+    map_hash = hashlib.blake2b(digest_size=8)
+    map_hash.update(('%s\t%s\n' % (tc_stat.st_size, tc_stat.st_mtime_ns)).encode())
+    for contig_id in sorted(tc_map):
+        map_hash.update((contig_id + '\t' + tc_map[contig_id] + '\n').encode())
+
+    return map_hash.hexdigest()
+
+
 def compare_sag_sbt(p):  # TODO: needs stdout for user monitoring
     sbt_args, mhr_path, sag_id_list, sag_sig_dict, kmer, min_len = p
     mg_id, mg_sub_file, sig_path, nthreads = sbt_args
@@ -160,7 +231,7 @@ def load_mg_sigs(mg_id, mg_sub_file, nthreads, sig_path, kmer, min_len):
                                                                ))
     else:
         logging.info('Loading subcontigs for %s\n' % mg_id)
-        mg_subcontigs = s_utils.get_seqs(mg_sub_file[1])
+        mg_subcontigs = s_sidx.subcontig_records(mg_sub_file[1])
         mg_sig_list = build_mg_sigs(mg_id, mg_subcontigs, nthreads, sig_path, kmer, min_len)
     return mg_sig_list
 
@@ -213,15 +284,16 @@ def sag_recruit_checker(mhr_path, sag_sub_files, kmer):
     minhash_pass_list = []
     l = 0
     b = 0
+    # one directory scan instead of probing every SAG's recruit file
+    mh_ext = '.' + str(kmer) + '.mhr_recruits.tsv'
+    with os.scandir(mhr_path) as dir_it:
+        mh_size_dict = {ent.name: ent.stat().st_size for ent in dir_it if ent.name.endswith(mh_ext)}
     logging.info('Checking for previously completed Trusted Contigs:\n')
     for sag_rec in tqdm(sag_sub_files):
         sag_id, sag_file = sag_rec
-        mh_file = o_join(mhr_path, sag_id + '.' + str(kmer) + '.mhr_recruits.tsv')
-        if isfile(mh_file):
-            filesize = getsize(mh_file)
-        else:
-            filesize = 0
+        filesize = mh_size_dict.get(sag_id + mh_ext, 0)
         if filesize != 0:
+            mh_file = o_join(mhr_path, sag_id + mh_ext)
             pass_df = pd.read_csv(mh_file, header=0, sep='\t')
             minhash_pass_list.append(pass_df)
             l += 1
@@ -41,19 +41,28 @@ class SABerArgumentParser(argparse.ArgumentParser):
 
     def add_recruit_args(self):
         self.reqs.add_argument("-m", "--metag", required=True, dest="mg_file",
-                               help="Path to a metagenome assembly [FASTA format only]."
+                               help="Path to a metagenome assembly [FASTA format only, may be .gz/.bgz/.zst compressed]."
                                )
         self.reqs.add_argument("-l", "--metaraw", required=True, dest="mg_raw_file_list",
                                help="Text file containing paths to raw FASTQ files for samples.\n"
                                     "One file per line, supports interleaved and separate PE reads.\n"
                                     "For separate PE files, both file paths on one line sep by [tab].\n"
+                                    "FASTQs may be .gz/.bgz/.zst compressed.\n"
                                )
         self.reqs.add_argument("-o", "--output-dir", required=True, dest="save_path",
                                help="Path to directory for all outputs."
                                )
         self.reqs.add_argument("-s", "--trusted-contigs", required=False, dest="trust_path",
                                default=False, help="Path to reference FASTA file or directory "
-                                                   "containing only FASTA files."
+                                                   "containing only FASTA files (.gz/.bgz/.zst allowed)."
+                               )
+        self.reqs.add_argument("--trusted-map", required=False, dest="trust_map", default=None,
+                               help="Tab-separated contig ID and SAG ID per line, splits a single "
+                                    "--trusted-contigs multi-FASTA into SAGs."
+                               )
+        self.reqs.add_argument("--trusted-regex", required=False, dest="trust_regex", default=None,
+                               help="Regex whose first group pulls the SAG ID out of each contig ID, "
+                                    "used instead of --trusted-map."
                                )
         self.optopt.add_argument("--autoopt", dest="auto_params", default='algo_defaults',
                                  help="select which automatic optimization algorithm parameter set to use,\n"
@@ -105,10 +114,73 @@ class SABerArgumentParser(argparse.ArgumentParser):
                                  dest="min_len",
                                  help="minimum length of contigs to include in basepairs [2000]."
                                  )
+        self.optopt.add_argument("--adaptive_windows", required=False, default=False,
+                                 action="store_true", dest="adaptive_windows",
+                                 help="if --max_contig_len/--overlap_len give more than --max_subcontigs,\n"
+                                      "fit them to the assembly's N50 and length distribution [False]."
+                                 )
+        self.optopt.add_argument("--max_subcontigs", required=False, default=1000000,
+                                 dest="max_subcontigs",
+                                 help="cap on the number of subcontigs with --adaptive_windows [1000000]."
+                                 )
+        self.optopt.add_argument("--kmer_size", required=False, default=4,
+                                 dest="kmer_size", choices=['3', '4', '5', '6'],
+                                 help="k-mer size for the composition features [4]."
+                                 )
+        self.optopt.add_argument("--kmer_mode", required=False, default='reverse',
+                                 dest="kmer_mode", choices=['forward', 'reverse', 'revcomp'],
+                                 help="merge each k-mer with its reverse, its reverse complement "
+                                      "or not at all (forward) [reverse]."
+                                 )
         self.miscellany.add_argument("-t", "--num_threads", required=False, default=1,
                                      dest="nthreads",
                                      help="Number of threads [1]."
                                      )
+        self.miscellany.add_argument("--align_jobs", required=False, default=1,
+                                     dest="align_jobs",
+                                     help="Number of read samples aligned at the same time, each gets\n"
+                                          "num_threads/align_jobs threads [1]."
+                                     )
+        self.miscellany.add_argument("--sort_threads", required=False, default=None,
+                                     dest="sort_threads",
+                                     help="Threads given to samtools sort out of each alignment job's share\n"
+                                          "(num_threads/align_jobs), not out of num_threads. The rest map\n"
+                                          "reads with minimap2, so the value is clamped to between 1 and the\n"
+                                          "share minus 1 [a quarter of the share]."
+                                     )
+        self.miscellany.add_argument("--keep_sam", required=False, default=False,
+                                     action="store_true", dest="keep_sam",
+                                     help="Write each alignment to SAM and convert and sort it in separate steps\n"
+                                          "instead of piping minimap2 into samtools sort [False]."
+                                     )
+        self.miscellany.add_argument("--depth_engine", required=False, default='jgi',
+                                     dest="depth_engine", choices=['jgi', 'saber'],
+                                     help="Calculate subcontig depths with MetaBAT's jgi_summarize_bam_contig_depths\n"
+                                          "on sorted BAMs, or stream minimap2's output into SABer's own depth engine\n"
+                                          "without BAMs or samtools (each alignment job holds one int32 per\n"
+                                          "subcontig base) [jgi]."
+                                     )
+        # at most one alternative to aligning the reads to the subcontigs
+        cov_modes = self.miscellany.add_mutually_exclusive_group()
+        cov_modes.add_argument("--contig_coverage", required=False, default=False,
+                               action="store_true", dest="contig_cov",
+                               help="Align reads once to the whole contigs and project their depth profiles\n"
+                                    "onto the subcontig windows instead of aligning to the subcontigs [False]."
+                               )
+        cov_modes.add_argument("--kmer_abundance", required=False, default=False,
+                               action="store_true", dest="kmer_abund",
+                               help="Estimate coverage without alignment by counting sampled subcontig k-mers\n"
+                                    "in the reads, approximate but fast for screening many samples.\n"
+                                    "Can't be combined with --contig_coverage [False]."
+                               )
+        self.miscellany.add_argument("--kmer_cache", required=False, default=None,
+                                     dest="kmer_cache",
+                                     help="Directory for the k-mer count cache reused across runs [output-dir]."
+                                     )
+        self.miscellany.add_argument("--export_tsv", required=False, default=False,
+                                     action="store_true", dest="export_tsv",
+                                     help="Also write feature tables as TSV next to the binary .npy files [False]"
+                                     )
         self.miscellany.add_argument("--force", required=False, default=False,
                                      action="store_true",
                                      help="Force SABer to run even if final recruits files exist [False]"
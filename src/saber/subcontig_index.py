@@ -0,0 +1,119 @@
+__author__ = 'Ryan J McLaughlin'
+
+import logging
+import os
+
+import numpy as np
+import pyfastx
+
+import saber.kmer_kernels as s_kern
+import saber.utilities as s_utils
+
+
+class SubcontigIndex:
+    """
+    Subcontigs as (contig index, start, end) windows over the contig FASTA they were
+    cut from, instead of a materialized <samp_id>.subcontigs.fasta. Windows follow the
+    kmer_slide rules and are stored in contig order, so iterating the index streams
+    the contig FASTA once; fetch() slices a single subcontig out of the indexed FASTA.
+    Saved as <samp_id>.subcontigs.idx.npz next to where the subcontig FASTA would go.
+    """
+
+    def __init__(self, contig_file, contig_names, contig_lens, win_size, o_lap, m_len) -> None:
+        self.contig_file = contig_file
+        self.contig_names = np.asarray(contig_names, dtype=str)
+        self.contig_lens = np.asarray(contig_lens, dtype=np.int64)
+        self.params = (int(win_size), int(o_lap), int(m_len))
+        contig_idx, starts, ends = s_kern.window_bounds(self.contig_lens, *self.params)
+        self.contig_idx = contig_idx.astype(np.int32)
+        self.starts = starts.astype(np.int32)
+        self.ends = ends.astype(np.int32)
+        # window number within its contig, the _<i> suffix of the subcontig header
+        n_win = np.bincount(self.contig_idx, minlength=len(self.contig_lens))
+        self.win_num = (np.arange(len(self.contig_idx)) - np.repeat(np.cumsum(n_win) - n_win, n_win)
+                        ).astype(np.int32)
+        self.fasta = None
+        return
+
+    def __len__(self) -> int:
+        return len(self.contig_idx)
+
+    def __iter__(self):
+        """Yield (header, seq) for every subcontig, same records as the subcontig FASTA."""
+        i = 0
+        for c, rec in enumerate(s_utils.get_seqs(self.contig_file)):
+            if (i == len(self.contig_idx)) or (self.contig_idx[i] != c):
+                continue
+            header, seq = rec[0], str(rec[1])
+            if header != self.contig_names[c]:
+                raise Exception("**ERROR** " + self.contig_file + " has changed since its subcontig index was built")
+            if len(seq) >= self.params[1]:
+                seq = seq.upper()
+            while (i < len(self.contig_idx)) and (self.contig_idx[i] == c):
+                yield header + '_' + str(self.win_num[i]), seq[self.starts[i]:self.ends[i]]
+                i += 1
+
+    def headers(self):
+        return [self.contig_names[c] + '_' + str(w) for c, w in zip(self.contig_idx, self.win_num)]
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def fetch(self, i):
+        """Sequence of subcontig i, read from the indexed contig FASTA."""
+        if self.fasta is None:
+            if self.contig_file.endswith('.zst'):
+                raise Exception("**ERROR** random access needs an uncompressed or gzip FASTA, "
+                                + self.contig_file + " is zstd compressed")
+            self.fasta = pyfastx.Fasta(self.contig_file)
+        c = self.contig_idx[i]
+        seq = self.fasta.fetch(str(self.contig_names[c]), (int(self.starts[i]) + 1, int(self.ends[i])))
+        if self.contig_lens[c] >= self.params[1]:
+            seq = seq.upper()
+
+        return seq
+
+    def save(self, idx_file):
+        with open(idx_file + '.tmp', 'wb') as idx_out:
+            np.savez(idx_out, contig_file=np.array(os.path.abspath(self.contig_file)),
+                     contig_names=self.contig_names, contig_lens=self.contig_lens,
+                     params=np.array(self.params)
+                     )
+        os.replace(idx_file + '.tmp', idx_file)
+
+    def write_fasta(self, sub_file):
+        logging.info('Writing subcontigs of %s to %s\n' % (self.contig_file, sub_file))
+        return s_utils.write_subcontigs(iter(self), sub_file)
+
+
+def load_subcontig_index(idx_file):
+    with np.load(idx_file) as idx_npz:
+        sub_idx = SubcontigIndex(str(idx_npz['contig_file']), idx_npz['contig_names'],
+                                 idx_npz['contig_lens'], *idx_npz['params']
+                                 )
+
+    return sub_idx
+
+
+def index_file(sub_file):
+    """<samp_id>.subcontigs.idx.npz for <samp_id>.subcontigs.fasta"""
+    return os.path.splitext(sub_file)[0] + '.idx.npz'
+
+
+def subcontig_records(sub_file):
+    """(header, seq) subcontig records of sub_file, streamed from its index if it was never written."""
+    if (not os.path.isfile(sub_file)) and os.path.isfile(index_file(sub_file)):
+        return load_subcontig_index(index_file(sub_file))
+    return s_utils.get_seqs(sub_file)
+
+
+def ensure_subcontig_fasta(sub_file):
+    """Write sub_file from its index if it doesn't exist yet, for tools that need a real FASTA.
+
+    :return: sub_file"""
+    if (not os.path.isfile(sub_file)) and os.path.isfile(index_file(sub_file)):
+        load_subcontig_index(index_file(sub_file)).write_fasta(sub_file)
+    if not os.path.isfile(sub_file):
+        raise Exception("**ERROR** neither " + sub_file + " nor its subcontig index exist")
+
+    return sub_file
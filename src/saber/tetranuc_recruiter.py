@@ -1,26 +1,46 @@
 import logging
 import warnings
-from os.path import isfile
 from os.path import join as o_join
 
+import saber.composition as s_comp
+import saber.feature_store as s_fs
+import saber.kmer_cache as s_cache
+import saber.subcontig_index as s_sidx
 import saber.utilities as s_utils
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
-def run_tetra_recruiter(tra_path, mg_sub_file):
+def run_tetra_recruiter(tra_path, mg_sub_file, nthreads=1, mg_file=None,
+                        max_contig_len=10000, overlap_len=2000, min_len=2000, profile=None,
+                        export_tsv=False, cache_path=None
+                        ):
     logging.info('Starting Tetranucleotide Data Transformation\n')
+    if profile is None:
+        profile = s_comp.TETRA_PROFILE
+    if cache_path is None:
+        cache_path = tra_path
     mg_id = mg_sub_file[0]
-    if isfile(o_join(tra_path, mg_id + '.tetras.tsv')):
-        logging.info('Loading tetramer Hz matrix for %s\n' % mg_id)
-        mg_tetra_file = o_join(tra_path, mg_id + '.tetras.tsv')
+    # default profile keeps the .tetras name, others are kept apart, e.g. .k5_revcomp
+    mg_tetra_file = o_join(tra_path, mg_id + '.' + profile.name)
+    # Always rebuilt from the k-mer cache so a changed input is never matched to
+    # a stale table, only new or changed subcontigs are actually counted
+    logging.info('Calculating %s Hz matrix for %s\n' % (profile.name, mg_id))
+    kmer_cache = s_cache.KmerCache(o_join(cache_path, 'kmer_cache.' + profile.name), profile)
+    if mg_file:
+        # count each contig once and derive the overlapping subcontigs from prefix sums
+        mg_contigs = s_utils.get_seqs(mg_file)
+        mg_tetra_df = s_utils.tetra_cnt_contigs(mg_contigs, max_contig_len, overlap_len,
+                                                min_len, nthreads, profile, kmer_cache
+                                                )
     else:
-        logging.info('Calculating tetramer Hz matrix for %s\n' % mg_id)
-        mg_subcontigs = s_utils.get_seqs(mg_sub_file[1])
-        mg_tetra_df = s_utils.tetra_cnt(mg_subcontigs)
-        mg_tetra_df.to_csv(o_join(tra_path, mg_id + '.tetras.tsv'),
-                           sep='\t'
-                           )
-        mg_tetra_file = o_join(tra_path, mg_id + '.tetras.tsv')
+        mg_subcontigs = s_sidx.subcontig_records(mg_sub_file[1])
+        mg_tetra_df = s_utils.tetra_cnt(mg_subcontigs, nthreads, profile, kmer_cache)
+    kmer_cache.save()
+    # keep the normalization so other tables (e.g. SAGs) can be put in the same space
+    norm_meta = s_comp.norm_to_meta(*mg_tetra_df.attrs['norm_params'])
+    s_fs.write_features(mg_tetra_file, mg_tetra_df.index, mg_tetra_df.values,
+                        index_name='contig_id', export_tsv=export_tsv, meta=norm_meta
+                        )
 
     return mg_tetra_file
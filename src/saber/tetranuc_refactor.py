@@ -1,210 +1,182 @@
 import argparse
+import hashlib
+import json
 import logging
+import multiprocessing
+import os
+from multiprocessing import shared_memory
 from os.path import isfile, basename
 from os.path import join as o_join
 
+import numpy as np
 import pandas as pd
+import saber.composition as s_comp
+import saber.feature_store as s_fs
+import saber.id_registry as s_ids
 import saber.logger as s_log
+import saber.subcontig_index as s_sidx
+import saber.tetranuc_recruiter as tra
 import saber.utilities as s_utils
 from sklearn import svm
 
 
 class tetra_recruiter:
-
-    def __init__(self, tra_path, sag_sub_files, mg_sub_file, rpkm_max_df, gmm_per_pass):
+    """
+    Recruits metagenome subcontigs to many SAGs at once with per-SAG OC-SVMs on tetramer Hz.
+    The metagenome tetra matrix is loaded once into shared memory, SAGs are fit
+    in a worker pool and all recruits end up in one <mg_id>.tetra_recruits.tsv.
+    """
+
+    def __init__(self, tra_path, sag_sub_files, mg_sub_file, rpkm_max_df=None, per_pass=0.01,
+                 nthreads=1, nu=0.5, gamma='scale'
+                 ):
         self.tra_path = tra_path
         self.sag_sub_files = sag_sub_files
         self.mg_sub_file = mg_sub_file
         self.rpkm_max_df = rpkm_max_df
-        self.gmm_per_pass = gmm_per_pass
+        self.per_pass = per_pass
+        self.nthreads = nthreads
+        self.nu = nu
+        self.gamma = gamma
 
         self.mg_id = self.mg_sub_file[0]
-        self.predictors = ['ocsvm', 'gmm']
-        # self.total_pass_lists = dict.fromkeys(self.predictors, [])
-        self.ml_functions = {'ocsvm': self.runOCSVM, 'gmm': self.runGMM}  # will be replace with ML package
+        self.recruit_file = o_join(self.tra_path, self.mg_id + '.tetra_recruits.tsv')
+        self.key_file = o_join(self.tra_path, self.mg_id + '.tetra_recruits.json')
 
     def run_tetra_recruiter(self):
-        logging.info('1')
-
-        # tetra files always exist
-        self.mg_tetra_df, self.mg_headers = self.loadMg()
-
-        # iterate through all sags
-        for i, sag_rec in enumerate(self.sag_sub_files):
-
-            sag_id, sag_headers, sag_subs, paths = self.loadSag(sag_rec)
-
-            if all([isfile(x) for x in paths]):
-                pass_lists = self.loadPassLists(sag_id, paths)
+        run_key = self.recruit_key()
+        if isfile(self.recruit_file) and isfile(self.key_file):
+            with open(self.key_file, 'r') as key_in:
+                if json.load(key_in).get('recruit_key') == run_key:
+                    logging.info('[SABer]: Found tetramer Hz recruits for %s, loading them\n' % self.mg_id)
+                    return pd.read_csv(self.recruit_file, header=0, sep='\t')
+            logging.info('[SABer]: SAGs or settings changed since the last tetramer Hz recruits, rebuilding\n')
+
+        # tetra matrix and subcontig totals are built once and shared by every SAG
+        self.mg_headers, mg_tetra_mtx, self.norm_params = self.loadMg()
+        self.id_reg = s_ids.from_feature_ids(self.mg_headers, s_sidx.index_file(self.mg_sub_file[1]))
+        self.mg_tot_cnt_df = self.build_mg_tot_cnt()
+        arg_list = self.buildArgs()
+        logging.info('[SABer]: Recruiting with tetramer Hz for %s SAGs\n' % len(arg_list))
+        mg_shm = shared_memory.SharedMemory(create=True, size=max(mg_tetra_mtx.nbytes, 1))
+        try:
+            shared_mtx = np.ndarray(mg_tetra_mtx.shape, dtype=np.float32, buffer=mg_shm.buf)
+            shared_mtx[:] = mg_tetra_mtx
+            pool = multiprocessing.Pool(processes=self.nthreads, initializer=init_mg_worker,
+                                        initargs=(mg_shm.name, mg_tetra_mtx.shape)
+                                        )
+            sag_list = []
+            pass_list = []
+            for sag_id, pass_rows in pool.imap_unordered(recruit_sag, arg_list):
+                logging.info('[SABer]: Recruited %s subcontigs to %s with OCSVM\n' % (len(pass_rows), sag_id))
+                sag_list.extend([sag_id] * len(pass_rows))
+                pass_list.append(pass_rows)
+            pool.close()
+            pool.join()
+        finally:
+            mg_shm.close()
+            mg_shm.unlink()
+        # feature table rows are the subcontig codes
+        pass_rows = np.concatenate(pass_list).astype(np.int32) if pass_list else np.zeros(0, dtype=np.int32)
+        all_pass_df = pd.DataFrame({'sag_id': sag_list, 'subcontig_id': pass_rows,
+                                    'contig_id': self.id_reg.contig_of(pass_rows)
+                                    })
+        recruit_df = self.updateDF(all_pass_df)
+        with open(self.key_file + '.tmp', 'w') as key_out:
+            json.dump({'recruit_key': run_key, 'sag_ids': sorted(x[0] for x in self.sag_sub_files)}, key_out)
+        os.replace(self.key_file + '.tmp', self.key_file)
+
+        return recruit_df
+
+    def recruit_key(self):
+        # hash of the SAG set (IDs, files, sizes and mtimes), the abundance limits and the
+        # OC-SVM settings, the saved recruits are only reused when it is unchanged
+        r_hash = hashlib.blake2b(digest_size=16)
+        for sag_id, sag_file in sorted(self.sag_sub_files):
+            f_stat = os.stat(sag_file)
+            r_hash.update('\t'.join([sag_id, os.path.abspath(sag_file), str(f_stat.st_size),
+                                     str(f_stat.st_mtime_ns)]).encode() + b'\n')
+        r_hash.update(repr([self.per_pass, self.nu, self.gamma]).encode())
+        if self.rpkm_max_df is not None:
+            r_hash.update(pd.util.hash_pandas_object(self.rpkm_max_df, index=False).values.tobytes())
+
+        return r_hash.hexdigest()
+
+    def buildArgs(self):
+        # row indices of the subcontigs each SAG is allowed to recruit, all of them without rpkm_max_df
+        if self.rpkm_max_df is not None:
+            rpkm_codes = self.id_reg.sub_codes(self.rpkm_max_df['subcontig_id'].astype(str))
+            rpkm_rows = {sag_id: rpkm_codes[sag_rows][rpkm_codes[sag_rows] != -1].astype(np.int64)
+                         for sag_id, sag_rows in self.rpkm_max_df.groupby('sag_id').indices.items()
+                         }
+        all_rows = np.arange(len(self.mg_headers))
+        arg_list = []
+        for sag_id, sag_file in self.sag_sub_files:
+            if self.rpkm_max_df is not None:
+                mg_rows = rpkm_rows.get(sag_id, np.zeros(0, dtype=np.int64))
             else:
-                pass_lists = self.calcPassLists(sag_id, sag_subs, sag_headers)
-
-            # This piece of sag now has a pass_list 
-            self.storePassLists(sag_id, pass_lists)
-
-        return
-
-    def calcPassLists(self, sag_id, sag_subs, sag_headers):
-        logging.info('2')
-        sag_tetra_df = self.loadSagTetra(sag_id, sag_subs, sag_headers)
-        mg_tetra_filter_df, mg_rpkm_contig_list = self.concatSagMg(sag_id)
-        pass_lists = self.Train(sag_id, sag_tetra_df, mg_tetra_filter_df, mg_rpkm_contig_list)
-
-        # for pred_name in self.predictors:
-        #     with open(o_join(self.tra_path, sag_id + '.'+ pred_name+'_recruits.tsv'), 'w') as tra_out:
-        #         tra_out.write('\n'.join(['\t'.join(x) for x in pass_lists[pred_name]]))
-
-        return pass_lists
-
-    def Train(self, sag_id, sag_tetra_df, mg_tetra_filter_df, mg_rpkm_contig_list):
-        logging.info('3')
-        pass_lists = dict.fromkeys(self.predictors)
-        for pred_name in self.predictors:
-            passed_items = self.ml_functions[pred_name](sag_id, sag_tetra_df, mg_tetra_filter_df, mg_rpkm_contig_list)
-            pass_lists[pred_name] = passed_items
-
-        return pass_lists
-
-    def runOCSVM(self, sag_id, sag_tetra_df, mg_tetra_filter_df, mg_rpkm_contig_list):
-        logging.info('4')
-        clf = svm.OneClassSVM()
-        clf.fit(sag_tetra_df.values)
-        sag_pred = clf.predict(sag_tetra_df.values)
-        mg_pred = clf.predict(mg_tetra_filter_df.values)
-        mg_pred_df = pd.DataFrame(data=mg_pred, index=mg_tetra_filter_df.index.values)
-
-        svm_pass_df = mg_pred_df.loc[mg_pred_df[0] != -1]
-        svm_pass_df = svm_pass_df.loc[svm_pass_df.index.isin(mg_rpkm_contig_list)]
-        svm_pass_list = []
-        for md_nm in svm_pass_df.index.values:
-            svm_pass_list.append([sag_id, md_nm, md_nm.rsplit('_', 1)[0]])
-
-        logging.info('[SABer]: Reccruited %s subcontigs to %s with OCSVM\n' % (len(svm_pass_list), sag_id))
-
-        return svm_pass_list
-
-    def runGMM(self, sag_id, sag_tetra_df, mg_tetra_filter_df, mg_rpkm_contig_list):
-        logging.info('4')
-        clf = svm.OneClassSVM()
-        clf.fit(sag_tetra_df.values)
-        sag_pred = clf.predict(sag_tetra_df.values)
-        mg_pred = clf.predict(mg_tetra_filter_df.values)
-        mg_pred_df = pd.DataFrame(data=mg_pred, index=mg_tetra_filter_df.index.values)
-
-        svm_pass_df = mg_pred_df.loc[mg_pred_df[0] != -1]
-        svm_pass_df = svm_pass_df.loc[svm_pass_df.index.isin(mg_rpkm_contig_list)]
-        svm_pass_list = []
-        for md_nm in svm_pass_df.index.values:
-            svm_pass_list.append([sag_id, md_nm, md_nm.rsplit('_', 1)[0]])
+                mg_rows = all_rows
+            arg_list.append([sag_id, sag_file, mg_rows, self.norm_params, self.nu, self.gamma])
 
-        logging.info('[SABer]: Reccruited %s subcontigs to %s with OCSVM\n' % (len(svm_pass_list), sag_id))
-
-        return svm_pass_list
-
-        ########### Begin Helper Function #################
+        return arg_list
 
     def loadMg(self):
-        logging.info('5')
-        if isfile(o_join(self.tra_path, self.mg_id + '.tetras.tsv')):
-            mg_tetra_df = pd.read_csv(o_join(self.tra_path, self.mg_id + '.tetras.tsv'), sep='\t', index_col=0,
-                                      header=0)
-            mg_headers = mg_tetra_df.index.values
-        else:
-            mg_tetra_df, mg_headers = calcMgTetra()
-
-        return mg_tetra_df, mg_headers
+        mg_tetra_file = o_join(self.tra_path, self.mg_id + '.tetras')
+        if not s_fs.feature_exists(mg_tetra_file):
+            mg_tetra_file = self.calcMgTetra()
+        mg_headers, mg_tetra_mtx, meta_dict = s_fs.load_features(mg_tetra_file)
+        if 'keep_cols' not in meta_dict:  # written before normalization was stored, rebuild it
+            mg_tetra_file = self.calcMgTetra()
+            mg_headers, mg_tetra_mtx, meta_dict = s_fs.load_features(mg_tetra_file)
+        # SAGs are normalized with the metagenome columns and scaler so both share one space
+        norm_params = s_comp.norm_from_meta(meta_dict)
+
+        return mg_headers, mg_tetra_mtx, norm_params
 
     def calcMgTetra(self):
-        logging.info('6')
-        mg_subcontigs = s_utils.get_seqs(mg_sub_file)  # TODO: can this be removed?
-        mg_headers = tuple(mg_subcontigs.keys())
-        mg_subs = tuple([r.seq for r in mg_subcontigs])
-        mg_tetra_df = s_utils.tetra_cnt(mg_subs)
-        mg_tetra_df['contig_id'] = mg_headers
-        mg_tetra_df.set_index('contig_id', inplace=True)
-        mg_tetra_df.to_csv(o_join(tra_path, mg_id + '.tetras.tsv'), sep='\t')
-        return mg_headers, mg_tetra_df
-
-    def loadSag(self, sag_rec):
-        logging.info('7')
-        sag_id, sag_file = sag_rec
-        sag_subcontigs = s_utils.get_seqs(sag_file)
-        sag_headers = tuple(sag_subcontigs.keys())
-        sag_subs = tuple([r.seq for r in sag_subcontigs])
-        path = o_join(self.tra_path, sag_id + '.{}_recruits.tsv')
-        paths = [path.format(x) for x in self.predictors]
-        return sag_id, sag_headers, sag_subs, paths
-
-    def loadSagTetra(self, sag_id, sag_subs, sag_headers):
-        logging.info('8')
-        if isfile(o_join(self.tra_path, sag_id + '.tetras.tsv')):
-            sag_tetra_df = pd.read_csv(o_join(tra_path, sag_id + '.tetras.tsv'),
-                                       sep='\t', index_col=0, header=0)
-        else:
-            sag_tetra_df = self.calcSagTetra(sag_id, sag_subs, sag_headers)
-
-        return sag_tetra_df
-
-    def calcSagTetra(self, sag_id, sag_subs, sag_headers):
-        logging.info('9')
-        sag_tetra_df = s_utils.tetra_cnt(sag_subs)
-        sag_tetra_df['contig_id'] = sag_headers
-        sag_tetra_df.set_index('contig_id', inplace=True)
-        sag_tetra_df.to_csv(o_join(self, tra_path, sag_id + '.tetras.tsv'), sep='\t')
-        return sag_tetra_df
-
-    def loadPassLists(self, sag_id, paths):
-        logging.info('10')
-        pass_lists = dict.fromkeys(predictors, [])
-        if all([isfile(x) for x in paths]):
-            logging.info('[SABer]: Found recruit lists. Loading  %s tetramer Hz recruit list\n' % sag_id)
-            for pred_name in self.predictors:
-                with open(o_join(self.tra_path, sag_id + '.' + pred_name + '_recruits.tsv'), 'r') as tra_in:
-                    pass_lists[pred_name] = [x.rstrip('\n').split('\t') for x in tra_in.readlines()]
-        return pass_lists
-
-    def concatSagMg(self, sag_id):
-        logging.info('11')
-        mg_rpkm_contig_list = list(self.rpkm_max_df.loc[self.rpkm_max_df['sag_id'] == sag_id]['subcontig_id'].values)
-        mg_tetra_filter_df = self.mg_tetra_df.loc[self.mg_tetra_df.index.isin(mg_rpkm_contig_list)]
-        return mg_tetra_filter_df, mg_rpkm_contig_list
-
-    def storePassLists(self, sag_id, pass_lists):
-        logging.info('12')
-        all_pass_dict = dict.fromkeys(self.predictors)
-        for pred_name in self.predictors:
-            all_pass_dict[pred_name] = pd.DataFrame(pass_lists[pred_name],
-                                                    columns=['sag_id', 'subcontig_id', 'contig_id'])
-
-        for pred_name in self.predictors:
-            all_pass_df = all_pass_dict[pred_name]
-            mg_max_only_df = self.updateDF(all_pass_df, pred_name)
-
-    def updateDF(self, all_pass_df, pred_name):
-        logging.info('13')
-        mg_tot_cnt_df = self.build_mg_tot_cnt()
-        gmm_cnt_df = self.build_gmm_cnt(all_pass_df)
-        df_output = gmm_cnt_df.merge(mg_tot_cnt_df, how='left', on='contig_id')
+        mg_tetra_file = tra.run_tetra_recruiter(self.tra_path, self.mg_sub_file, self.nthreads)
+        return mg_tetra_file
 
+    def updateDF(self, all_pass_df):
+        recruit_cnt_df = self.build_recruit_cnt(all_pass_df)
+        df_output = recruit_cnt_df.merge(self.mg_tot_cnt_df, how='left', on='contig_id')
         df_output['percent_recruited'] = df_output['subcontig_recruits'] / \
                                          df_output['subcontig_total']
-        df_output.sort_values(by='percent_recruited', ascending=False, inplace=True)
-        df_output.to_csv(o_join(tra_path, mg_id + '.' + pred_name + '.check.tsv'), sep='\t', index=False)
+        df_output = df_output.loc[df_output['percent_recruited'] >= self.per_pass]
+        df_output.sort_values(by=['sag_id', 'percent_recruited'], ascending=[True, False], inplace=True)
+        df_output = self.id_reg.decode_df(df_output)
+        df_output.to_csv(self.recruit_file, sep='\t', index=False)
         return df_output
 
     def build_mg_tot_cnt(self):
-        logging.info('14')
-        mg_contig_list = [x.rsplit('_', 1)[0] for x in self.mg_headers]
-        mg_tot_cnt_df = pd.DataFrame(zip(mg_contig_list, self.mg_headers),
-                                     columns=['contig_id', 'subcontig_id']).groupby(['contig_id']).count().reset_index()
-        mg_tot_cnt_df.columns = ['contig_id', 'subcontig_total']
+        contig_cnts = self.id_reg.contig_counts()
+        mg_tot_cnt_df = pd.DataFrame({'contig_id': np.arange(len(contig_cnts), dtype=np.int32),
+                                      'subcontig_total': contig_cnts
+                                      })
         return mg_tot_cnt_df
 
-    def build_gmm_cnt(self, all_pass_df):
-        logging.info('15')
-        gmm_cnt_df = all_pass_df.groupby(['sag_id', 'contig_id']).count().reset_index()
-        gmm_cnt_df.columns = ['sag_id', 'contig_id', 'subcontig_recruits']
-        return gmm_cnt_df
+    def build_recruit_cnt(self, all_pass_df):
+        recruit_cnt_df = all_pass_df.groupby(['sag_id', 'contig_id']).count().reset_index()
+        recruit_cnt_df.columns = ['sag_id', 'contig_id', 'subcontig_recruits']
+        return recruit_cnt_df
+
+
+def init_mg_worker(shm_name, shape):
+    global mg_shm, shared_mg_mtx
+    mg_shm = shared_memory.SharedMemory(name=shm_name)
+    shared_mg_mtx = np.ndarray(shape, dtype=np.float32, buffer=mg_shm.buf)
+
+
+def recruit_sag(p):
+    sag_id, sag_file, mg_rows, norm_params, nu, gamma = p
+    sag_tetra_mtx = s_utils.tetra_cnt(s_utils.get_seqs(sag_file), norm_params=norm_params).values
+    if (len(mg_rows) == 0) or (len(sag_tetra_mtx) == 0):
+        return sag_id, mg_rows[:0]
+    clf = svm.OneClassSVM(nu=nu, gamma=gamma)
+    clf.fit(sag_tetra_mtx)
+    mg_pred = clf.predict(shared_mg_mtx[mg_rows])
+
+    return sag_id, mg_rows[mg_pred != -1]
 
 
 if __name__ == '__main__':
@@ -214,9 +186,14 @@ if __name__ == '__main__':
         '--tetra_path', help='path to tetrenucleotide output directory',
         required=True
     )
-    parser.add_argument(
-        '--sag_sub_file',
-        help='path to SAG subcontigs file', required=True
+    sag_args = parser.add_mutually_exclusive_group(required=True)
+    sag_args.add_argument(
+        '--sag_sub_file', nargs='+',
+        help='path(s) to SAG subcontigs file(s)'
+    )
+    sag_args.add_argument(
+        '--sag_file', nargs='+',
+        help='path(s) to SAG FASTA file(s), cut into subcontigs in tetra_path'
     )
     # recruite from metagenomes
     parser.add_argument(
@@ -225,31 +202,52 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         '--abund_df',
-        help='path to output dataframe from abundance recruiter', required=True
+        help='path to output dataframe from abundance recruiter, limits each SAG to its abundance recruits',
+        required=False, default=None
     )
     parser.add_argument(
         '--per_pass',
-        help='pass percentage of subcontigs to pass complete contig', required=True,
+        help='pass percentage of subcontigs to pass complete contig', required=False,
         default='0.01'
     )
+    parser.add_argument(
+        '--threads', help='number of worker processes', required=False, default='1'
+    )
+    parser.add_argument(
+        '--max_contig_len', help='max subcontig length for --sag_file', required=False, default='10000'
+    )
+    parser.add_argument(
+        '--overlap_len', help='subcontig overlap for --sag_file', required=False, default='2000'
+    )
+    parser.add_argument(
+        '--min_len', help='minimum contig length for --sag_file', required=False, default='2000'
+    )
     parser.add_argument("-v", "--verbose", action="store_true", default=False,
                         help="Prints a more verbose runtime log"
                         )
     args = parser.parse_args()
     # set args
     tra_path = args.tetra_path
-    sag_sub_file = args.sag_sub_file
     mg_sub_file = args.mg_sub_file
-    abund_recruit_file = args.abund_df
     per_pass = float(args.per_pass)
 
     s_log.prep_logging("tetra_log.txt", args.verbose)
-    sag_id = basename(sag_sub_file).rsplit('.', 2)[0]
+    if args.sag_file:
+        # one cached subcontig file per SAG, the missing ones are cut in a worker pool
+        sag_sub_files = [list(x) for x in s_utils.build_subcontigs('SAGs', args.sag_file, tra_path,
+                                                                   args.max_contig_len, args.overlap_len,
+                                                                   args.min_len, int(args.threads)
+                                                                   )]
+    else:
+        sag_sub_files = [[basename(x).rsplit('.', 2)[0], x] for x in args.sag_sub_file]
     mg_id = basename(mg_sub_file).rsplit('.', 2)[0]
-    abund_recruit_df = pd.read_csv(abund_recruit_file, header=0, sep='\t')
+    if args.abund_df:
+        abund_recruit_df = pd.read_csv(args.abund_df, header=0, sep='\t')
+    else:
+        abund_recruit_df = None
     logging.info('[SABer]: Starting Tetranucleotide Recruitment Step\n')
 
-    tr = tetra_recruiter(tra_path, [[sag_id, sag_sub_file]], [mg_id, mg_sub_file],
-                         abund_recruit_df, per_pass)
+    tr = tetra_recruiter(tra_path, sag_sub_files, [mg_id, mg_sub_file],
+                         abund_recruit_df, per_pass, int(args.threads))
 
     tr.run_tetra_recruiter()
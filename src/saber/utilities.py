@@ -2,14 +2,16 @@ __author__ = 'Ryan J McLaughlin'
 
 import glob
 import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import sys
-from collections import Counter
-from itertools import product, islice
+from functools import partial
+from itertools import islice
 
 import dit
 import hdbscan
@@ -18,10 +20,17 @@ import pandas as pd
 import pyfastx
 import umap
 from dit.other import renyi_entropy
-from skbio.stats.composition import clr
 from sklearn.preprocessing import StandardScaler
 from tqdm import tqdm
 
+import saber.composition as s_comp
+import saber.kmer_cache as s_cache
+import saber.kmer_kernels as s_kern
+
+# FASTA files can be read in place when compressed with any of COMP_EXTS, e.g. contigs.fna.gz
+FASTA_EXTS = ('.fasta', '.fna', '.fa')
+COMP_EXTS = ('.gz', '.bgz', '.zst')
+
 
 def is_exe(fpath):
     return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
@@ -153,15 +162,16 @@ def check_out_dirs(save_path, autoopt, mode):
     return sd_dict
 
 
+def is_fasta_name(file_name):
+    return strip_comp_ext(file_name).endswith(FASTA_EXTS) and ('Sample' not in file_name)
+
+
 def get_SAGs(sag_path):
     # Find the SAGs!
     if os.path.isdir(sag_path):
         logging.info('Directory specified, looking for Trusted Contigs\n')
-        sag_list = [os.path.join(sag_path, f) for f in
-                    os.listdir(sag_path) if ((f.split('.')[-1] == 'fasta' or
-                                              f.split('.')[-1] == 'fna' or
-                                              f.split('.')[-1] == 'fa') and 'Sample' not in f)
-                    ]
+        with os.scandir(sag_path) as dir_it:
+            sag_list = [ent.path for ent in dir_it if is_fasta_name(ent.name) and ent.is_file()]
         logging.info('Found %s Trusted Contig files in directory\n'
                      % str(len(sag_list))
                      )
@@ -177,29 +187,134 @@ def get_SAGs(sag_path):
     return sag_list
 
 
-def build_subcontigs(seq_type, in_fasta_list, subcontig_path, max_contig_len, overlap_len, min_len):
-    sub_list = []
+def scan_SAGs(sag_path, manifest_file):
+    """get_SAGs for a directory, keeping a manifest of each file's size and mtime between runs.
+
+    The directory is scanned once with os.scandir and each file's size and mtime are
+    compared to the old manifest, so files rewritten in place are found too. The
+    directory's own mtime only tells whether files were added or removed.
+    :param sag_path: directory of trusted-contig FASTAs, or a single FASTA
+    :param manifest_file: JSON manifest of the last run
+    :return: list of SAG files, the list of those that are new or changed since the
+    last run (None if there was no manifest to compare with) and the new manifest,
+    to be saved with save_manifest once the SAGs have been processed"""
+    if not os.path.isdir(sag_path):
+        return get_SAGs(sag_path), None, None
+    old_manifest = None
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as man_in:
+            old_manifest = json.load(man_in)
+        if old_manifest.get('path') != os.path.abspath(sag_path):
+            old_manifest = None
+    dir_mtime = os.stat(sag_path).st_mtime_ns
+    logging.info('Directory specified, looking for Trusted Contigs\n')
+    if (old_manifest is not None) and (old_manifest['dir_mtime'] != dir_mtime):
+        logging.info('Trusted Contig files were added or removed since the last run\n')
+    file_dict = {}
+    with os.scandir(sag_path) as dir_it:
+        for ent in dir_it:
+            if is_fasta_name(ent.name) and ent.is_file():
+                ent_stat = ent.stat()
+                file_dict[ent.name] = [ent_stat.st_size, ent_stat.st_mtime_ns]
+    logging.info('Found %s Trusted Contig files in directory\n' % str(len(file_dict)))
+    sag_list = [os.path.join(sag_path, f) for f in file_dict]
+    if old_manifest is None:
+        update_list = None
+    else:
+        update_list = [os.path.join(sag_path, f) for f, f_stat in file_dict.items()
+                       if old_manifest['files'].get(f) != f_stat
+                       ]
+        logging.info('%s Trusted Contig files are new or changed since the last run\n' % len(update_list))
+    manifest = {'path': os.path.abspath(sag_path), 'dir_mtime': dir_mtime, 'files': file_dict}
+
+    return sag_list, update_list, manifest
+
+
+def save_manifest(manifest_file, manifest):
+    if manifest is None:
+        return
+    with open(manifest_file + '.tmp', 'w') as man_out:
+        json.dump(manifest, man_out)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def get_trusted_map(tc_file, map_file=None, header_regex=None):
+    """Assign the contigs of a single multi-FASTA of trusted contigs to their SAGs.
+
+    :param tc_file: multi-FASTA with the trusted contigs of every SAG
+    :param map_file: tab-separated contig ID and SAG ID, one contig per line
+    :param header_regex: regex matched against each contig ID instead of a map_file,
+    its first group (or the whole match without groups) is the SAG ID
+    :return: dict of contig ID to SAG ID, contigs without a SAG are left out"""
+    tc_map = {}
+    if map_file:
+        with open(map_file, 'r') as map_in:
+            for line in map_in:
+                split_line = line.strip('\n').split('\t')
+                if (len(split_line) >= 2) and (split_line[0][:1] != '#'):
+                    tc_map[split_line[0]] = split_line[1]
+    elif header_regex:
+        header_re = re.compile(header_regex)
+        n_miss = 0
+        for rec in get_seqs(tc_file):
+            re_match = header_re.search(rec[0])
+            if re_match is None:
+                n_miss += 1
+                continue
+            tc_map[rec[0]] = re_match.group(1) if header_re.groups else re_match.group(0)
+        if n_miss != 0:
+            logging.warning('%s contigs in %s did not match %s and are not used\n'
+                            % (n_miss, os.path.basename(tc_file), header_regex)
+                            )
+    else:
+        raise Exception("**ERROR** a contig to SAG map file or a header regex is needed "
+                        "to split " + tc_file + " into SAGs")
+    logging.info('Assigned %s trusted contigs to %s SAGs\n' % (len(tc_map), len(set(tc_map.values()))))
+
+    return tc_map
+
+
+def group_trusted_records(tc_file, tc_map, sag_ids=None):
+    """Read a trusted-contig multi-FASTA once and group its records by SAG.
+
+    :param sag_ids: only keep these SAGs, all of them if None
+    :return: dict of SAG ID to a list of (header, seq) records"""
+    tc_rec_dict = {}
+    for rec in get_seqs(tc_file):
+        sag_id = tc_map.get(rec[0])
+        if (sag_id is not None) and ((sag_ids is None) or (sag_id in sag_ids)):
+            tc_rec_dict.setdefault(sag_id, []).append((rec[0], str(rec[1])))
+
+    return tc_rec_dict
+
+
+def build_subcontigs(seq_type, in_fasta_list, subcontig_path, max_contig_len, overlap_len, min_len,
+                     nthreads=1
+                     ):
+    # one <samp_id>.subcontigs.fasta per input, those that already exist are reused
+    # and the rest are built nthreads input files at a time
+    sub_list = [None] * len(in_fasta_list)
+    arg_list = []
     for i, in_fasta in enumerate(in_fasta_list):
-        basename = os.path.basename(in_fasta)
-        samp_id = basename.rsplit('.', 1)[0]
+        samp_id = get_samp_id(in_fasta)
         sub_file = os.path.join(subcontig_path, samp_id + '.subcontigs.fasta')
-        logging.info('\rLoading/Building subcontigs for {}: {}'.format(seq_type, i + 1))
-        if os.path.exists(os.path.join(subcontig_path, samp_id + '.subcontigs.fasta')) == False:
-            # get contigs from fasta file
-            contigs = get_seqs(in_fasta)
-            headers, subs = kmer_slide(contigs, int(max_contig_len),
-                                       int(overlap_len), int(min_len)
-                                       )
-            if len(subs) != 0:
-                with open(sub_file, 'w') as sub_out:
-                    sub_out.write('\n'.join(['\n'.join(['>' + rec[0], rec[1]]) for rec in
-                                             zip(headers, subs)]) + '\n'
-                                  )
-                sub_list.append((samp_id, sub_file))
+        if os.path.exists(sub_file) == False:
+            arg_list.append([i, in_fasta, sub_file, max_contig_len, overlap_len, min_len])
         else:
-            sub_list.append((samp_id, sub_file))
+            sub_list[i] = (samp_id, sub_file)
+    logging.info('Loading %s and building %s subcontig files for %s\n'
+                 % (len(in_fasta_list) - len(arg_list), len(arg_list), seq_type)
+                 )
+    if arg_list:
+        # leaving the with block terminates the workers, also when a build fails
+        with multiprocessing.Pool(processes=max(min(int(nthreads), len(arg_list)), 1)) as pool:
+            for i, sub_file, n_subs in tqdm(pool.imap_unordered(build_subcontig_file, arg_list),
+                                            total=len(arg_list), disable=len(arg_list) < 2
+                                            ):
+                if n_subs != 0:
+                    sub_list[i] = (get_samp_id(in_fasta_list[i]), sub_file)
+    sub_list = [x for x in sub_list if x is not None]
 
-    logging.info('\n')
     if ((seq_type == 'SAGs') & (len(sub_list) == 1)):
         sub_list = tuple(sub_list)
         return sub_list
@@ -211,24 +326,63 @@ def build_subcontigs(seq_type, in_fasta_list, subcontig_path, max_contig_len, ov
         return sub_list
 
 
+def build_subcontig_file(p):
+    # only the file name and record count go back to the parent, the subcontigs go to disk
+    i, in_fasta, sub_file, max_contig_len, overlap_len, min_len = p
+    contigs = get_seqs(in_fasta)
+    sub_recs = iter_subcontigs(contigs, int(max_contig_len), int(overlap_len), int(min_len))
+    n_subs = write_subcontigs(sub_recs, sub_file)
+
+    return i, sub_file, n_subs
+
+
+def iter_subcontigs(scd_db, n, o_lap, m_len):
+    """Yield the (header, seq) subcontigs of each contig in scd_db, one contig in memory at a time."""
+    for rec in scd_db:
+        header, seq = rec[0], str(rec[1])
+        bounds = subcontig_bounds(len(seq), n, o_lap, m_len)
+        if len(seq) >= int(o_lap):
+            seq = seq.upper()
+        for i, (s, e) in enumerate(bounds):
+            yield header + '_' + str(i), seq[s:e]
+
+
+def write_subcontigs(sub_recs, sub_file, buf_size=1 << 24):
+    """Write (header, seq) records to a FASTA in chunks of about buf_size characters.
+
+    Nothing is left behind if there are no records or the write fails part way.
+    :return: number of records written"""
+    tmp_file = sub_file + '.tmp'
+    n_recs = 0
+    try:
+        with open(tmp_file, 'w') as sub_out:
+            buf = []
+            buf_len = 0
+            for header, seq in sub_recs:
+                buf.append('>' + header + '\n' + seq + '\n')
+                buf_len += len(seq)
+                n_recs += 1
+                if buf_len >= buf_size:
+                    sub_out.write(''.join(buf))
+                    buf = []
+                    buf_len = 0
+            sub_out.write(''.join(buf))
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    if n_recs == 0:
+        os.remove(tmp_file)
+    else:
+        os.replace(tmp_file, sub_file)
+
+    return n_recs
+
+
 def kmer_slide(scd_db, n, o_lap, m_len):
-    all_sub_seqs = []
-    all_sub_headers = []
-    for k in scd_db:
-        rec = k
-        header, seq = rec[0], rec[1]
-        if len(str(seq)) >= int(o_lap):
-            clean_seq = str(seq).upper()
-            sub_list = sliding_window(clean_seq, n, o_lap)
-            sub_headers = [header + '_' + str(i) for i, x in
-                           enumerate(sub_list, start=0)
-                           ]
-            all_sub_seqs.extend(sub_list)
-            all_sub_headers.extend(sub_headers)
-        elif len(str(seq)) >= int(m_len):
-            all_sub_seqs.extend([seq])
-            all_sub_headers.extend([header + '_0'])
-    return tuple(all_sub_headers), tuple(all_sub_seqs)
+    sub_recs = tuple(iter_subcontigs(scd_db, n, o_lap, m_len))
+    all_sub_headers = tuple(x[0] for x in sub_recs)
+    all_sub_seqs = tuple(x[1] for x in sub_recs)
+    return all_sub_headers, all_sub_seqs
 
 
 def sliding_window(seq, win_size, o_lap):
@@ -258,6 +412,116 @@ def sliding_window(seq, win_size, o_lap):
     return seq_frags
 
 
+def subcontig_bounds(seq_len, win_size, o_lap, m_len):
+    """[start, end) coordinates of the subcontigs kmer_slide cuts from a contig.
+
+    :param seq_len: length of the contig
+    :param win_size: max subcontig length
+    :param o_lap: subcontig overlap
+    :param m_len: minimum contig length
+    :return: (n x 2) numpy array of window bounds, empty if the contig is filtered out"""
+    contig_idx, starts, ends = s_kern.window_bounds([seq_len], int(win_size), int(o_lap), int(m_len))
+    bounds = np.stack([starts, ends], axis=1)
+
+    return bounds
+
+
+def contig_lengths(fasta_file):
+    return np.fromiter((len(rec[1]) for rec in get_seqs(fasta_file)), dtype=np.int64)
+
+
+def contig_n50(len_arr):
+    sort_arr = np.sort(np.asarray(len_arr, dtype=np.int64))[::-1]
+    if len(sort_arr) == 0:
+        return 0
+    cum_arr = np.cumsum(sort_arr)
+    return int(sort_arr[np.searchsorted(cum_arr, cum_arr[-1] / 2)])
+
+
+def count_subcontigs(len_hist, win_size, o_lap, m_len):
+    """Number of subcontigs kmer_slide would cut, from a (lengths, counts) length histogram."""
+    uniq_lens, len_cnts = len_hist
+    contig_idx = s_kern.window_bounds(uniq_lens, int(win_size), int(o_lap), int(m_len))[0]
+    n_win = np.bincount(contig_idx, minlength=len(uniq_lens))
+
+    return int(np.dot(n_win, len_cnts))
+
+
+def adaptive_window_params(len_arr, win_size, o_lap, min_len, max_subcontigs, min_win=2000,
+                           max_win=100000, o_lap_frac=0.2
+                           ):
+    """Subcontig length, overlap and minimum contig length fitted to an assembly.
+
+    One set of parameters for the whole assembly, contigs are not windowed one by one.
+    The configured window and overlap are kept as long as they give at most max_subcontigs.
+    Otherwise the window starts at the N50 (within [min_win, max_win], and no shorter than
+    the configured one) and grows by half while the subcontig count is over max_subcontigs
+    and still dropping. If that isn't enough, the shortest contigs are dropped by raising
+    the minimum length (up to half the window), with the overlap raised to match since
+    kmer_slide keeps every contig at least as long as the overlap.
+    :param len_arr: contig lengths
+    :param win_size: configured subcontig length
+    :param o_lap: configured subcontig overlap
+    :param min_len: minimum contig length asked for
+    :param max_subcontigs: cap on the total number of subcontigs
+    :param o_lap_frac: overlap as a fraction of a fitted window, 0.2 like the 10000/2000 defaults
+    :return: window size, overlap and minimum length"""
+    len_arr = np.asarray(len_arr, dtype=np.int64)
+    len_hist = np.unique(len_arr, return_counts=True)
+    win_size, o_lap, m_len = int(win_size), int(o_lap), int(min_len)
+    cfg_o_lap = o_lap
+    n_subs = count_subcontigs(len_hist, win_size, o_lap, m_len)
+    if n_subs <= max_subcontigs:
+        logging.info('%s subcontigs with subcontig length %s and overlap %s, under the cap of %s\n'
+                     % (n_subs, win_size, o_lap, max_subcontigs)
+                     )
+        return win_size, o_lap, m_len
+    n50 = contig_n50(len_arr[len_arr >= m_len])
+    next_win = int(min(max(round(n50, -3), min_win, win_size), max_win))
+    if next_win != win_size:
+        win_size, o_lap = next_win, int(next_win * o_lap_frac)
+        n_subs = count_subcontigs(len_hist, win_size, o_lap, m_len)
+    while (n_subs > max_subcontigs) and (win_size < max_win):
+        next_win = int(min(round(win_size * 1.5, -3), max_win))
+        next_subs = count_subcontigs(len_hist, next_win, int(next_win * o_lap_frac), m_len)
+        if next_subs > 0.99 * n_subs:  # mostly single-window contigs, longer windows won't help
+            break
+        win_size, o_lap, n_subs = next_win, int(next_win * o_lap_frac), next_subs
+    uniq_lens, len_cnts = len_hist
+    best_params = (n_subs, o_lap, m_len)
+    for i in range(5):
+        if n_subs <= max_subcontigs:
+            break
+        # contigs are taken longest first until the cap, the next length becomes the minimum
+        n_win = np.bincount(s_kern.window_bounds(uniq_lens, win_size, o_lap, m_len)[0],
+                            minlength=len(uniq_lens)
+                            ) * len_cnts
+        cum_win = np.cumsum(n_win[::-1])
+        n_keep = np.searchsorted(cum_win, max_subcontigs, side='right')
+        if n_keep < len(uniq_lens):
+            m_len = int(min(max(uniq_lens[::-1][n_keep] + 1, m_len), win_size // 2))
+        # kmer_slide keeps every contig at least as long as the overlap
+        o_lap = max(o_lap, m_len)
+        n_subs = count_subcontigs(len_hist, win_size, o_lap, m_len)
+        best_params = min(best_params, (n_subs, o_lap, m_len))
+    n_subs, o_lap, m_len = best_params
+    if n_subs > max_subcontigs:
+        logging.warning('Could not get under %s subcontigs, %s will be used\n' % (max_subcontigs, n_subs))
+    # kmer_slide keeps a contig if it is at least the overlap or the minimum length long
+    n_dropped = np.count_nonzero(((len_arr >= cfg_o_lap) | (len_arr >= int(min_len)))
+                                 & (len_arr < o_lap) & (len_arr < m_len)
+                                 )
+    if n_dropped:
+        logging.warning('%s contigs shorter than %s bp are dropped to stay under %s subcontigs\n'
+                        % (n_dropped, m_len, max_subcontigs)
+                        )
+    logging.info('Adaptive windows for N50 %s: subcontig length %s, overlap %s, minimum length %s, '
+                 '%s subcontigs\n' % (n50, win_size, o_lap, m_len, n_subs)
+                 )
+
+    return win_size, o_lap, m_len
+
+
 def slidingWindow(sequence, winSize, step):
     # pulled source from https://scipher.wordpress.com/2010/12/02/simple-sliding-window-iterator-in-python/
     seq_frags = []
@@ -282,11 +546,79 @@ def slidingWindow(sequence, winSize, step):
 
 
 def get_seqs(fasta_file):
+    # compressed files are decompressed by pigz/zstd in a separate process while they are parsed
+    decomp_cmd = decompress_cmd(fasta_file)
+    if decomp_cmd is not None:
+        return FastaStream(fasta_file, decomp_cmd)
     fasta = pyfastx.Fasta(fasta_file, build_index=False)
 
     return fasta
 
 
+def strip_comp_ext(seq_file):
+    for ext in COMP_EXTS:
+        if seq_file.endswith(ext):
+            return seq_file[:-len(ext)]
+    return seq_file
+
+
+def get_samp_id(seq_file):
+    """Sample ID of a sequence file, its basename without the compression and file extensions."""
+    return os.path.basename(strip_comp_ext(seq_file)).rsplit('.', 1)[0]
+
+
+def decompress_cmd(seq_file):
+    """Command streaming seq_file decompressed to stdout.
+
+    :return: command list, None if seq_file isn't compressed or pyfastx should read it
+    (gzip without pigz installed)"""
+    if seq_file.endswith('.zst'):
+        if which('zstd') is None:
+            raise Exception("**ERROR** zstd must be installed to read " + seq_file)
+        return ['zstd', '-dcq', seq_file]
+    elif seq_file.endswith(('.gz', '.bgz')) and (which('pigz') is not None):
+        return ['pigz', '-dc', seq_file]
+    return None
+
+
+class FastaStream:
+    """
+    (header, seq) records of a FASTA read from the stdout of decomp_cmd, like an unindexed
+    pyfastx.Fasta. Every iteration starts a new decompression process.
+    """
+
+    def __init__(self, fasta_file, decomp_cmd) -> None:
+        self.fasta_file = fasta_file
+        self.decomp_cmd = decomp_cmd
+        return
+
+    def __iter__(self):
+        proc = subprocess.Popen(self.decomp_cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+        finished = False
+        try:
+            header = None
+            seq_buf = []
+            for line in proc.stdout:
+                if line[:1] == b'>':
+                    if header is not None:
+                        yield header, b''.join(seq_buf).decode()
+                    # pyfastx names records by the first word of the header
+                    header = (line[1:].split(None, 1) or [b''])[0].decode()
+                    seq_buf = []
+                else:
+                    seq_buf.append(line.rstrip())
+            if header is not None:
+                yield header, b''.join(seq_buf).decode()
+            finished = True
+        finally:
+            if not finished:  # stopped early, the rest of the stream isn't needed
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise Exception("**ERROR** " + ' '.join(self.decomp_cmd) + " exited with code " + str(proc.returncode))
+
+
 def get_kmer(seq, n):
     "Returns a sliding window (of width n) over data from the iterable"
     "   s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...                "
@@ -299,64 +631,71 @@ def get_kmer(seq, n):
         yield result
 
 
-def tetra_cnt(fasta):  # TODO: add multi-processing to this function
-    # Dict of all tetramers
-    tetra_cnt_dict = {''.join(x): [] for x in product('atgc', repeat=4)}
-    header_list = []
-    # count up all tetramers and also populate the tetra dict
-    subcontig_len_dict = {}
-    for rec in fasta:
-        header = rec[0]
-        header_list.append(header)
-        seq = rec[1]
-        subcontig_len_dict[header] = len(seq)
-        tmp_dict = {k: 0 for k, v in tetra_cnt_dict.items()}
-        clean_seq = seq.strip('\n').lower()
-        kmer_list = [''.join(x) for x in get_kmer(clean_seq, 4)]
-        tetra_counter = Counter(kmer_list)
-        # add counter to tmp_dict
-        for tetra in tmp_dict.keys():
-            count_tetra = int(tetra_counter[tetra])
-            tmp_dict[tetra] = count_tetra
-        # map tetras to their reverse tetras (not compliment)
-        dedup_dict = {}
-        for tetra in tmp_dict.keys():
-            if (tetra not in dedup_dict.keys()) & (tetra[::-1] not in dedup_dict.keys()):
-                dedup_dict[tetra] = ''
-            elif tetra[::-1] in dedup_dict.keys():
-                dedup_dict[tetra[::-1]] = tetra
-        # combine the tetras and their reverse (not compliment)
-        tetra_prop_dict = {}
-        for tetra in dedup_dict.keys():
-            if dedup_dict[tetra] != '':
-                tetra_prop_dict[tetra] = tmp_dict[tetra] + tmp_dict[dedup_dict[tetra]]
-            else:
-                tetra_prop_dict[tetra] = tmp_dict[tetra]
-        # add to tetra_cnt_dict
-        for k in tetra_cnt_dict.keys():
-            if k in tetra_prop_dict.keys():
-                tetra_cnt_dict[k].append(tetra_prop_dict[k])
-            else:
-                tetra_cnt_dict[k].append(0.0)
-    # convert the final dict into a pd dataframe for ease
-    tetra_cnt_dict['contig_id'] = header_list
-    tetra_cnt_df = pd.DataFrame.from_dict(tetra_cnt_dict).set_index('contig_id')
-    dedupped_df = tetra_cnt_df.loc[:, (tetra_cnt_df != 0.0).any(axis=0)]
-    dedupped_df += 1  # TODO: adds pseudo-count, is there a better way?
-    first_val = dedupped_df.columns[0]
-    last_val = dedupped_df.columns[-1]
-    dedupped_df['sum'] = dedupped_df.sum(axis=1)
-    # Covert to proportion
-    prop_df = dedupped_df.loc[:, first_val:last_val].div(dedupped_df['sum'], axis=0)
-    # Normalize proportions to length of subcontig
-    normal_list = [prop_df.loc[i] / subcontig_len_dict[i] for i in subcontig_len_dict.keys()]
-    normal_df = pd.DataFrame(normal_list, columns=prop_df.columns, index=prop_df.index)
-    # Transform using CLR
-    clr_df = normal_df.apply(clr)
-    # Standardize the mg tetra DF
-    scale = StandardScaler().fit(clr_df.values)  # TODO this should be added to the tetra_cnt step
-    scaled_data = scale.transform(clr_df.values)
-    std_tetra_df = pd.DataFrame(scaled_data, index=clr_df.index)
+def tetra_cnt(fasta, nthreads=1, profile=None, cache=None, norm_params=None):
+    # count up all k-mers into an (n_subcontigs x profile.n_cols) matrix, tetramers by default
+    if profile is None:
+        profile = s_comp.TETRA_PROFILE
+    if cache is not None:
+        header_list, len_list, kmer_mtx = s_cache.count_kmer_records_cached(fasta, cache, nthreads)
+    elif nthreads > 1:
+        header_list, len_list, kmer_mtx = s_comp.count_kmer_records_mp(fasta, nthreads, profile)
+    else:
+        header_list, len_list, kmer_mtx = s_comp.count_kmer_records(fasta, profile)
+    std_tetra_df = tetra_norm(header_list, len_list, kmer_mtx, norm_params)
+
+    return std_tetra_df
+
+
+def tetra_cnt_contigs(fasta, max_contig_len, overlap_len, min_len, nthreads=1, profile=None,
+                      cache=None, norm_params=None
+                      ):
+    """Same output as tetra_cnt on the build_subcontigs output, computed from the contigs.
+
+    k-mers are counted once per contig and each subcontig window is taken as a
+    prefix-sum difference, so the overlaps between windows are never recounted.
+    :param fasta: contig records, e.g. the pyfastx.Fasta of the metagenome
+    :param max_contig_len: max subcontig length
+    :param overlap_len: subcontig overlap
+    :param min_len: minimum contig length
+    :param nthreads: number of processes for counting
+    :param profile: composition.CompositionProfile, tetramers by default
+    :param cache: optional kmer_cache.KmerCache holding counts of previously seen windows,
+    its profile is used instead of profile
+    :param norm_params: (keep_cols, scaler) of another table to normalize into, see tetra_norm
+    :return: standardized composition DataFrame indexed by subcontig_id"""
+    if profile is None:
+        profile = s_comp.TETRA_PROFILE
+    window_func = partial(subcontig_bounds, win_size=int(max_contig_len),
+                          o_lap=int(overlap_len), m_len=int(min_len)
+                          )
+    if cache is not None:
+        header_list, len_list, kmer_mtx = s_cache.count_window_records_cached(fasta, window_func, cache,
+                                                                              nthreads
+                                                                              )
+    elif nthreads > 1:
+        header_list, len_list, kmer_mtx = s_comp.count_window_records_mp(fasta, window_func, nthreads,
+                                                                         profile
+                                                                         )
+    else:
+        header_list, len_list, kmer_mtx = s_comp.count_window_records(fasta, window_func, profile)
+    std_tetra_df = tetra_norm(header_list, len_list, kmer_mtx, norm_params)
+
+    return std_tetra_df
+
+
+def tetra_norm(header_list, len_list, kmer_mtx, norm_params=None):
+    # drop empty k-mers, add pseudo-count, convert to proportions normalized to
+    # subcontig length, then CLR and standardize, all in one float32 matrix.
+    # With norm_params the columns and scaler of an earlier table are reused as is,
+    # the ones used are kept in std_tetra_df.attrs['norm_params'] either way
+    if norm_params is None:
+        norm_mtx, keep_cols, scale = s_comp.normalize_kmers(kmer_mtx, len_list)
+    else:
+        norm_mtx, keep_cols, scale = s_comp.normalize_kmers(kmer_mtx, len_list, norm_params[1],
+                                                            keep_cols=norm_params[0], fit=False
+                                                            )
+    std_tetra_df = pd.DataFrame(norm_mtx, index=pd.Index(header_list, name='contig_id'))
+    std_tetra_df.attrs['norm_params'] = (keep_cols, scale)
 
     return std_tetra_df
 
@@ -0,0 +1,149 @@
+import json
+from functools import partial
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import pyfastx
+from sklearn.preprocessing import StandardScaler
+
+import saber.composition as s_comp
+import saber.kmer_kernels as s_kern
+import saber.utilities as s_utils
+from dev_utils.benchmark_tetra_cnt import legacy_tetra_counts
+
+WIN_PARAMS = (500, 100, 300)
+
+
+def write_fasta(fasta_file, rng, n_contigs=30):
+    # mixed case, N runs and IUPAC codes, a few contigs shorter than a tetramer
+    contigs = []
+    with open(fasta_file, 'w') as fa_out:
+        for i in range(n_contigs):
+            seq = ''.join(rng.choice(list('ACGTACGTacgtNRY'), size=int(rng.integers(2, 2500))))
+            contigs.append(('c_' + str(i), seq))
+            fa_out.write('>c_' + str(i) + '\n' + seq + '\n')
+    return contigs
+
+
+def legacy_counts(records):
+    # the pre-NumPy tetra_cnt counts with every tetramer column kept, in profile column order
+    legacy_df = legacy_tetra_counts(records)
+    return legacy_df.reindex(columns=list(s_comp.TETRA_PROFILE.columns), fill_value=0)
+
+
+def test_count_kmer_records_match_legacy(tmp_path):
+    write_fasta(str(tmp_path / 'mg.fasta'), np.random.default_rng(7))
+    fasta = pyfastx.Fasta(str(tmp_path / 'mg.fasta'), build_index=False)
+    records = [(h, s) for h, s in fasta]
+    legacy_df = legacy_counts(records)
+    headers, lens, kmer_mtx = s_comp.count_kmer_records(fasta)
+    assert headers == list(legacy_df.index)
+    assert lens == [len(s) for h, s in records]
+    assert np.array_equal(kmer_mtx, legacy_df.values)
+    mp_headers, mp_lens, mp_mtx = s_comp.count_kmer_records_mp(fasta, 3)
+    assert (mp_headers, mp_lens) == (headers, lens)
+    assert np.array_equal(mp_mtx, kmer_mtx)
+    # tetra_cnt gives the same table whichever way it counts
+    tetra_df = s_utils.tetra_cnt(records)
+    assert list(tetra_df.index) == headers
+    assert np.array_equal(s_utils.tetra_cnt(records, nthreads=3).values, tetra_df.values)
+
+
+def test_count_window_records_match_kmer_slide(tmp_path):
+    contigs = write_fasta(str(tmp_path / 'mg.fasta'), np.random.default_rng(9))
+    sub_headers, sub_seqs = s_utils.kmer_slide(contigs, *WIN_PARAMS)
+    sub_records = list(zip(sub_headers, sub_seqs))
+    window_func = partial(s_utils.subcontig_bounds, win_size=WIN_PARAMS[0], o_lap=WIN_PARAMS[1],
+                          m_len=WIN_PARAMS[2]
+                          )
+    headers, lens, kmer_mtx = s_comp.count_window_records(contigs, window_func)
+    assert headers == list(sub_headers)
+    assert lens == [len(x) for x in sub_seqs]
+    assert np.array_equal(kmer_mtx, legacy_counts(sub_records).values)
+    mp_headers, mp_lens, mp_mtx = s_comp.count_window_records_mp(contigs, window_func, 3)
+    assert (mp_headers, mp_lens) == (headers, lens)
+    assert np.array_equal(mp_mtx, kmer_mtx)
+    tetra_df = s_utils.tetra_cnt(sub_records)
+    window_df = s_utils.tetra_cnt_contigs(contigs, *WIN_PARAMS)
+    assert list(window_df.index) == list(tetra_df.index)
+    assert np.array_equal(window_df.values, tetra_df.values)
+
+
+def test_numba_kernels_match_numpy():
+    # the nb_ kernels run as plain python when numba is missing, either way they must agree
+    rng = np.random.default_rng(13)
+    codes = s_comp.encode_seq(''.join(rng.choice(list('ACGTACGTN'), size=3000)))
+    len_arr = rng.integers(1, 3000, size=50)
+    for k in s_comp.KMER_SIZES:
+        kmer_arr = np.arange(4 ** k)
+        assert np.array_equal(s_kern.nb_reverse_kmers(kmer_arr, k), s_kern.np_reverse_kmers(kmer_arr, k))
+        assert np.array_equal(s_kern.nb_revcomp_kmers(kmer_arr, k), s_kern.np_revcomp_kmers(kmer_arr, k))
+        for mode in s_comp.KMER_MODES:
+            profile = s_comp.CompositionProfile(k, mode)
+            kern_args = (k, profile.lut, profile.n_cols)
+            assert np.array_equal(s_kern.nb_count_kmers(codes, *kern_args),
+                                  s_kern.np_count_kmers(codes, *kern_args)
+                                  )
+            n_kmers = len(codes) - k + 1
+            break_arr = np.unique(np.concatenate([[0, n_kmers], rng.integers(0, n_kmers, size=20)]))
+            assert np.array_equal(s_kern.nb_prefix_kmers(codes, break_arr, *kern_args),
+                                  s_kern.np_prefix_kmers(codes, break_arr, *kern_args)
+                                  )
+    assert s_kern.nb_gc_ambig_count(codes) == s_kern.np_gc_ambig_count(codes)
+    for win_params in [WIN_PARAMS, (1000, 200, 100), (250, 0, 1)]:
+        for nb_arr, np_arr in zip(s_kern.nb_window_bounds(len_arr, *win_params),
+                                  s_kern.np_window_bounds(len_arr, *win_params)
+                                  ):
+            assert np.array_equal(nb_arr, np_arr)
+
+
+def test_profile_columns_match_product_order():
+    # a merged k-mer pair is keyed on whichever comes first in product('atgc', repeat=k)
+    seq = 'aacgtttgcaaggtcnacg'
+    for k in s_comp.KMER_SIZES:
+        kmer_list = [''.join(x) for x in product(s_comp.BASE_ORDER, repeat=k)]
+        for mode, pair_func in [('forward', lambda x: x), ('reverse', lambda x: x[::-1]),
+                                ('revcomp', lambda x: x[::-1].translate(str.maketrans('atgc', 'tacg')))]:
+            profile = s_comp.CompositionProfile(k, mode)
+            col_idx = {c: i for i, c in enumerate(profile.columns)}
+            expected = np.zeros(profile.n_cols, dtype=np.int64)
+            for i in range(len(seq) - k + 1):
+                kmer = seq[i:i + k]
+                if 'n' not in kmer:
+                    expected[col_idx[min(kmer, pair_func(kmer), key=kmer_list.index)]] += 1
+            assert np.array_equal(profile.count(seq), expected)
+
+
+def legacy_normalize(count_df, len_list):
+    # the DataFrame steps of the old tetra_cnt, with skbio's clr applied column by column
+    dedupped_df = count_df.loc[:, (count_df != 0.0).any(axis=0)] + 1
+    prop_df = dedupped_df.div(dedupped_df.sum(axis=1), axis=0)
+    normal_df = prop_df.div(pd.Series(len_list, index=prop_df.index), axis=0)
+    log_df = np.log(normal_df)
+    clr_df = log_df - log_df.mean(axis=0)
+    return StandardScaler().fit_transform(clr_df.values)
+
+
+def test_normalize_kmers_match_legacy(tmp_path):
+    contigs = write_fasta(str(tmp_path / 'mg.fasta'), np.random.default_rng(17), n_contigs=200)
+    contigs = [x for x in contigs if len(x[1]) >= 300]
+    headers, lens, kmer_mtx = s_comp.count_kmer_records(contigs)
+    legacy_mtx = legacy_normalize(legacy_counts(contigs), lens)
+    norm_mtx, keep_cols, scaler = s_comp.normalize_kmers(kmer_mtx, lens)
+    assert norm_mtx.dtype == np.float32
+    assert np.allclose(norm_mtx, legacy_mtx, atol=1e-3)
+    # chunked partial_fit gives the same table
+    chunk_mtx = s_comp.normalize_kmers(kmer_mtx, lens, chunk_size=7)[0]
+    assert np.allclose(chunk_mtx, norm_mtx, atol=1e-4)
+    # the JSON record rebuilds the same feature space
+    meta_dict = json.loads(json.dumps(s_comp.norm_to_meta(keep_cols, scaler)))
+    meta_cols, meta_scaler = s_comp.norm_from_meta(meta_dict)
+    assert np.array_equal(meta_cols, keep_cols)
+    meta_mtx = s_comp.normalize_kmers(kmer_mtx, lens, meta_scaler, keep_cols=meta_cols, fit=False)[0]
+    assert np.allclose(meta_mtx, norm_mtx, atol=1e-5)
+    # rows normalized into another table's space keep its columns and scaling
+    sub_mtx = s_comp.normalize_kmers(kmer_mtx[:20], lens[:20], meta_scaler, keep_cols=meta_cols,
+                                     fit=False
+                                     )[0]
+    assert np.allclose(sub_mtx, norm_mtx[:20], atol=1e-5)
@@ -0,0 +1,85 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import saber.depth_engine as s_depth
+from dev_utils.validate_depth_engine import sim_alignments
+
+HAND_CONTIGS = [('c_0', 400), ('c_1', 100)]
+# c_0 is longer than 2 * MAX_EDGE_BASES so only 75..325 counts, c_1 counts whole
+HAND_RECORDS = [
+    ('r1', 0, 'c_0', 1, '100M', 0),  # 0..100
+    ('r2', 16, 'c_0', 201, '100M', 2),  # 98% identity, 200..300
+    ('r3', 0, 'c_0', 201, '100M', 4),  # 96% identity, filtered
+    ('r4', 256, 'c_0', 51, '100M', 0),  # secondary, filtered
+    ('r5', 0, 'c_1', 1, '10S90M', 0),  # soft clip counts against identity, 90%, filtered
+    ('r6', 0, 'c_1', 11, '90M', 0),  # 10..100
+]
+
+
+def sam_lines(contigs, records):
+    head = ['@SQ\tSN:{}\tLN:{}\n'.format(n, l) for n, l in contigs]
+    body = ['\t'.join([r, str(f), c, str(p), '60', cig, '*', '0', '0', '*', '*', 'NM:i:' + str(nm)]) + '\n'
+            for r, f, c, p, cig, nm in records
+            ]
+    return head + body
+
+
+def test_stream_depths_hand_counted():
+    names, lens, depth_arr, var_arr = s_depth.stream_depths(sam_lines(HAND_CONTIGS, HAND_RECORDS))
+    assert names == ['c_0', 'c_1']
+    assert lens == [400, 100]
+    # c_0: depth 1 on 75..100 and 200..300, 125 of 250 bases
+    np.testing.assert_allclose(depth_arr, [0.5, 0.9])
+    np.testing.assert_allclose(var_arr, [0.25, 0.09])
+
+
+def test_stream_depths_matches_accumulator_order():
+    rng = np.random.default_rng(7)
+    contigs = [('c_' + str(i), int(x)) for i, x in enumerate(rng.integers(300, 3000, size=20))]
+    lines = sam_lines(contigs, []) + sim_alignments([x[1] for x in contigs], 3000, rng)
+    acc = s_depth.DepthAccumulator([x[0] for x in contigs], [x[1] for x in contigs], buf_size=128)
+    acc.add_sam(lines[::-1])  # record order must not matter
+    names, lens, depth_arr, var_arr = s_depth.stream_depths(lines)
+    np.testing.assert_allclose(np.stack([depth_arr, var_arr], 1), np.stack(acc.depths(), 1))
+
+
+def test_profile_accumulator_bins():
+    rng = np.random.default_rng(9)
+    contigs = [('c_' + str(i), int(x)) for i, x in enumerate(rng.integers(300, 5000, size=40))]
+    lines = sam_lines(contigs, []) + sim_alignments([x[1] for x in contigs], 10000, rng)
+    names, lens = [x[0] for x in contigs], [x[1] for x in contigs]
+    acc = s_depth.DepthAccumulator(names, lens)
+    acc.add_sam(lines)
+    bin_acc = s_depth.ProfileAccumulator(names, lens, buf_size=500)
+    bin_acc.add_sam(lines[::-1])
+    # bin sums are exact, squared sums only miss the variation within a bin
+    sum_arr, sq_arr = bin_acc.profile()
+    np.testing.assert_array_equal(sum_arr, acc.profile()[0])
+    assert bin_acc.full_diff.nbytes + bin_acc.part_arr.nbytes < acc.diff_arr.nbytes / 5
+    depth_arr, var_arr = bin_acc.depths()
+    np.testing.assert_allclose(depth_arr, acc.depths()[0], rtol=0.02)
+
+
+@pytest.mark.skipif((shutil.which('samtools') is None) or (shutil.which('jgi_summarize_bam_contig_depths') is None),
+                    reason='needs samtools and MetaBAT jgi_summarize_bam_contig_depths')
+def test_parity_with_jgi(tmp_path):
+    rng = np.random.default_rng(42)
+    contigs = [('c_' + str(i), int(x)) for i, x in enumerate(rng.integers(1000, 10000, size=200))]
+    lines = sam_lines(contigs, []) + sim_alignments([x[1] for x in contigs], 50000, rng)
+    sam_file = str(tmp_path / 'sim.sam')
+    bam_file = str(tmp_path / 'sim.sorted.bam')
+    jgi_file = str(tmp_path / 'sim.jgi.tsv')
+    with open(sam_file, 'w') as sam_out:
+        sam_out.write(''.join(lines))
+    subprocess.run(['samtools', 'sort', '-o', bam_file, sam_file], check=True)
+    subprocess.run(['jgi_summarize_bam_contig_depths', '--outputDepth', jgi_file, bam_file], check=True)
+    jgi_df = pd.read_csv(jgi_file, sep='\t', index_col=0)
+    names, lens, depth_arr, var_arr = s_depth.stream_depths(lines)
+    jgi_df = jgi_df.loc[names]
+    # jgi names the columns after the BAM path it was given
+    np.testing.assert_allclose(depth_arr, jgi_df[bam_file].values, rtol=1e-3, atol=1e-3)
+    np.testing.assert_allclose(var_arr, jgi_df[bam_file + '-var'].values, rtol=1e-2, atol=1e-3)
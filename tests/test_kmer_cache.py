@@ -0,0 +1,97 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+import saber.composition as s_comp
+import saber.kmer_cache as s_cache
+import saber.utilities as s_utils
+
+WIN_PARAMS = (500, 100, 300)
+
+
+def random_contigs(rng, n_contigs, prefix='c_'):
+    return [(prefix + str(i), ''.join(rng.choice(list('ACGTN'), size=int(rng.integers(300, 2000)))))
+            for i in range(n_contigs)
+            ]
+
+
+def test_cache_hit_miss_and_invalidation(tmp_path):
+    contigs = random_contigs(np.random.default_rng(21), 20)
+    expected = s_comp.count_kmer_records(contigs)
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'))
+    assert np.array_equal(s_cache.count_kmer_records_cached(contigs, cache)[2], expected[2])
+    assert len(cache) == 20
+    cache.save()
+    # a new cache object reads every count back from the store
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'))
+    assert all(cache.seq_key(seq.lower()) in cache for h, seq in contigs)
+    assert np.array_equal(s_cache.count_kmer_records_cached(contigs, cache)[2], expected[2])
+    assert not cache.new_keys
+    # an edited sequence is a miss, case is not
+    edited = [(h, s.lower()) for h, s in contigs]
+    edited[3] = (edited[3][0], edited[3][1][:-1] + ('a' if edited[3][1][-1] != 'a' else 'c'))
+    cached = s_cache.count_kmer_records_cached(edited, cache)[2]
+    assert len(cache.new_keys) == 1
+    assert np.array_equal(cached, s_comp.count_kmer_records(edited)[2])
+    # windows share the same store
+    window_func = partial(s_utils.subcontig_bounds, win_size=WIN_PARAMS[0], o_lap=WIN_PARAMS[1],
+                          m_len=WIN_PARAMS[2]
+                          )
+    window_mtx = s_cache.count_window_records_cached(contigs, window_func, cache)[2]
+    assert np.array_equal(window_mtx, s_comp.count_window_records(contigs, window_func)[2])
+    # another profile can't read the store
+    cache.save()
+    with pytest.raises(Exception, match='does not match'):
+        s_cache.KmerCache(str(tmp_path / 'kmer_cache'), s_comp.CompositionProfile(3, 'forward'))
+
+
+def test_cache_prunes_unused_entries(tmp_path):
+    rng = np.random.default_rng(23)
+    old_contigs = random_contigs(rng, 10, 'old_')
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'), max_age=2)
+    s_cache.count_kmer_records_cached(old_contigs, cache)
+    cache.save()
+    for run in range(3):
+        cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'), max_age=2)
+        s_cache.count_kmer_records_cached(random_contigs(rng, 5, 'run' + str(run) + '_'), cache)
+        cache.save()
+        old_kept = sum(cache.seq_key(s.lower()) in cache for h, s in old_contigs)
+        assert old_kept == (10 if run == 0 else 0)
+    # the last two runs are kept
+    assert len(cache) == 10
+    # entries that are only read are kept as well
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'), max_age=1)
+    kept_contigs = random_contigs(rng, 4, 'kept_')
+    s_cache.count_kmer_records_cached(kept_contigs, cache)
+    cache.save()
+    for run in range(2):
+        cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'), max_age=1)
+        s_cache.count_kmer_records_cached(kept_contigs, cache)
+        s_cache.count_kmer_records_cached(random_contigs(rng, 1, 'new' + str(run) + '_'), cache)
+        cache.save()
+    assert len(cache) == 5
+    # a bounded cache keeps its most recently used entries
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'), max_entries=3)
+    s_cache.count_kmer_records_cached(kept_contigs[:3], cache)
+    cache.save()
+    assert len(cache) == 3
+    assert all(cache.seq_key(s.lower()) in cache for h, s in kept_contigs[:3])
+
+
+def test_concurrent_saves_are_merged(tmp_path):
+    rng = np.random.default_rng(25)
+    contigs_a = random_contigs(rng, 6, 'a_')
+    contigs_b = random_contigs(rng, 7, 'b_')
+    cache_a = s_cache.KmerCache(str(tmp_path / 'kmer_cache'))
+    cache_b = s_cache.KmerCache(str(tmp_path / 'kmer_cache'))
+    s_cache.count_kmer_records_cached(contigs_a, cache_a)
+    s_cache.count_kmer_records_cached(contigs_b, cache_b)
+    cache_a.save()
+    cache_b.save()
+    cache = s_cache.KmerCache(str(tmp_path / 'kmer_cache'))
+    assert len(cache) == 13
+    both = contigs_a + contigs_b
+    both_mtx = s_cache.count_kmer_records_cached(both, cache)[2]
+    assert np.array_equal(both_mtx, s_comp.count_kmer_records(both)[2])
+    assert not cache.new_keys
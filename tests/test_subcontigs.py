@@ -0,0 +1,94 @@
+from functools import partial
+
+import numpy as np
+
+import saber.composition as s_comp
+import saber.subcontig_index as s_sidx
+import saber.utilities as s_utils
+
+WIN_PARAMS = (500, 100, 300)
+
+
+def write_contigs(fasta_file, rng, n_contigs=40):
+    contigs = []
+    with open(fasta_file, 'w') as fa_out:
+        for i in range(n_contigs):
+            seq = ''.join(rng.choice(list('ACGTacgtN'), size=int(rng.integers(50, 3000))))
+            contigs.append(('c_' + str(i), seq))
+            fa_out.write('>c_' + str(i) + '\n' + seq + '\n')
+    return contigs
+
+
+def test_streamed_subcontigs_match_kmer_slide(tmp_path):
+    contigs = write_contigs(str(tmp_path / 'mg.fasta'), np.random.default_rng(3))
+    headers, seqs = s_utils.kmer_slide(contigs, *WIN_PARAMS)
+    sub_file = s_utils.build_subcontigs('Metagenomes', [str(tmp_path / 'mg.fasta')], str(tmp_path),
+                                        *WIN_PARAMS
+                                        )[1]
+    # a small write buffer flushes many times
+    s_utils.write_subcontigs(s_utils.iter_subcontigs(contigs, *WIN_PARAMS), str(tmp_path / 'buf.fasta'),
+                             buf_size=1000
+                             )
+    # the recruit path writes the subcontig FASTA from its index
+    sub_idx = s_sidx.SubcontigIndex(str(tmp_path / 'mg.fasta'), [x[0] for x in contigs],
+                                    [len(x[1]) for x in contigs], *WIN_PARAMS
+                                    )
+    sub_idx.write_fasta(str(tmp_path / 'idx.fasta'))
+    expected = ''.join('>' + h + '\n' + s + '\n' for h, s in zip(headers, seqs))
+    for out_file in [sub_file, str(tmp_path / 'buf.fasta'), str(tmp_path / 'idx.fasta')]:
+        with open(out_file) as sub_in:
+            assert sub_in.read() == expected
+
+
+def test_window_chunks_are_bounded(tmp_path):
+    contigs = write_contigs(str(tmp_path / 'mg.fasta'), np.random.default_rng(5))
+    window_func = partial(s_utils.subcontig_bounds, win_size=WIN_PARAMS[0], o_lap=WIN_PARAMS[1],
+                          m_len=WIN_PARAMS[2]
+                          )
+    whole = list(s_comp.window_chunks(contigs, window_func))
+    chunks = list(s_comp.window_chunks(contigs, window_func, chunk_bases=4000))
+    assert len(whole) == 1
+    assert len(chunks) > 5
+    # no chunk holds more than chunk_bases plus its last contig
+    assert max(sum(len(seq) for seq, bounds in x[2]) for x in chunks) < 4000 + 3000
+    assert sum([x[0] for x in chunks], []) == whole[0][0]
+    assert sum([x[1] for x in chunks], []) == whole[0][1]
+    headers, seqs = s_utils.kmer_slide(contigs, *WIN_PARAMS)
+    assert whole[0][0] == list(headers)
+
+
+def test_build_subcontigs_pool_and_cache(tmp_path):
+    rng = np.random.default_rng(11)
+    fasta_list = []
+    for s in ['sagA', 'sagB', 'sagC']:
+        write_contigs(str(tmp_path / (s + '.fasta')), rng, n_contigs=5)
+        fasta_list.append(str(tmp_path / (s + '.fasta')))
+    out_path = tmp_path / 'subs'
+    out_path.mkdir()
+    sub_list = s_utils.build_subcontigs('SAGs', fasta_list, str(out_path), *WIN_PARAMS, nthreads=2)
+    assert [x[0] for x in sub_list] == ['sagA', 'sagB', 'sagC']
+    serial = s_utils.build_subcontigs('SAGs', fasta_list[:1], str(tmp_path), *WIN_PARAMS)
+    with open(sub_list[0][1]) as pool_in, open(serial[0][1]) as serial_in:
+        assert pool_in.read() == serial_in.read()
+    # existing outputs are reused without reading the input again
+    (tmp_path / 'sagB.fasta').write_text('not a fasta')
+    assert s_utils.build_subcontigs('SAGs', fasta_list, str(out_path), *WIN_PARAMS, nthreads=2) == sub_list
+
+
+def test_adaptive_window_params(caplog):
+    rng = np.random.default_rng(13)
+    len_arr = np.concatenate([rng.integers(1000, 5000, size=20000), rng.integers(5000, 200000, size=500)])
+    len_hist = np.unique(len_arr, return_counts=True)
+    # the configured windows are kept while they are under the cap
+    assert s_utils.adaptive_window_params(len_arr, 10000, 2000, 2000, 10 ** 9) == (10000, 2000, 2000)
+    win_size, o_lap, m_len = s_utils.adaptive_window_params(len_arr, 10000, 2000, 2000, 20000)
+    assert (win_size > 10000) and (m_len == 2000)
+    assert s_utils.count_subcontigs(len_hist, win_size, o_lap, m_len) <= 20000
+    assert 'dropped' not in caplog.text
+    # a lower cap raises the minimum length, the dropped contigs are reported
+    win_size, o_lap, m_len = s_utils.adaptive_window_params(len_arr, 10000, 2000, 2000, 2000)
+    assert m_len > 2000
+    assert s_utils.count_subcontigs(len_hist, win_size, o_lap, m_len) <= 2000
+    n_dropped = np.count_nonzero((len_arr >= 2000) & (len_arr < m_len))
+    assert [r.levelname for r in caplog.records if 'dropped' in r.message] == ['WARNING']
+    assert str(n_dropped) + ' contigs shorter than ' + str(m_len) in caplog.text